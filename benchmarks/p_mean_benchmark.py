@@ -0,0 +1,57 @@
+"""
+Times tf_p_mean against the previous implementation (stabilized_p_mean) on the shapes the
+composers see in pi_update, forward and backward, and reports how far their results are apart.
+
+    python -m benchmarks.p_mean_benchmark --batch_size 256 --objectives 6
+"""
+import argparse
+import timeit
+import numpy as np
+import tensorflow as tf
+from cmorl.utils.loss_composition import np_p_mean, stabilized_p_mean, tf_p_mean
+
+
+def time_graph(p_mean_fn, values, p, axis, repeats):
+    """Mean seconds of one forward and backward pass through p_mean_fn, compiled into a graph"""
+
+    @tf.function
+    def step(values):
+        with tf.GradientTape() as tape:
+            tape.watch(values)
+            result = p_mean_fn(values, p, axis=axis)
+        return result, tape.gradient(result, values)
+
+    step(values)  # trace
+    return timeit.timeit(lambda: step(values), number=repeats) / repeats
+
+
+def main(args):
+    np_random = np.random.default_rng(args.seed)
+    values = tf.constant(np_random.uniform(0.0, 1.0, (args.batch_size, args.objectives)), dtype=tf.float32)
+    print(f"{'p':>6} {'axis':>5} {'previous (us)':>14} {'log space (us)':>15} {'speedup':>8} {'max diff':>9}")
+    for p in args.ps:
+        for axis in (0, 1, None):
+            previous = time_graph(stabilized_p_mean, values, p, axis, args.repeats)
+            fused = time_graph(tf_p_mean, values, p, axis, args.repeats)
+            difference = np.max(np.abs(stabilized_p_mean(values, p, axis=axis) - tf_p_mean(values, p, axis=axis)))
+            print(f"{p:>6} {str(axis):>5} {previous * 1e6:>14.1f} {fused * 1e6:>15.1f} {previous / fused:>8.2f} {difference:>9.2e}")
+
+    # the per-step reward fns run the NumPy version on a handful of values
+    small = np_random.uniform(0.0, 1.0, args.objectives)
+    eager = timeit.timeit(lambda: tf_p_mean(small, -4.0), number=args.repeats) / args.repeats
+    numpy = timeit.timeit(lambda: np_p_mean(small, -4.0), number=args.repeats) / args.repeats
+    print(f"single reward vector, p=-4: tf_p_mean {eager * 1e6:.1f} us, np_p_mean {numpy * 1e6:.1f} us")
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description="Microbenchmark of the p_mean implementations")
+    parser.add_argument("--batch_size", type=int, default=256, help="rows of the benchmarked tensor")
+    parser.add_argument("--objectives", type=int, default=6, help="columns of the benchmarked tensor")
+    parser.add_argument("--ps", type=float, nargs="+", default=[-4.0, -1.0, 0.0, 1.0, 20.0], help="powers to time")
+    parser.add_argument("--repeats", type=int, default=1000, help="calls timed per case")
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args(args)
+
+
+if __name__ == "__main__":
+    main(parse_args())
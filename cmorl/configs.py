@@ -48,6 +48,10 @@ class FixLander(gymnasium.Wrapper):
         return obs, reward, done, truncated, info
 
 
+def fixed_lander(env):
+    return TimeLimit(FixLander(env), max_episode_steps=400)
+
+
 class ForcedTimeLimit(TimeLimit):
     def step(self, action):
         obs, reward, done, _, info = super().step(action)
@@ -173,7 +177,10 @@ env_configs: dict[str, Config] = {
         ),
     ),
     "Pendulum-v1": Config(
-        CMORL(partial(reward_fns.multi_dim_pendulum, setpoint=0.0)),
+        CMORL(
+            partial(reward_fns.multi_dim_pendulum, setpoint=0.0),
+            batched_reward_fn=partial(reward_fns.multi_dim_pendulum_batch, setpoint=0.0),
+        ),
         # None,
         HyperParams(
             ac_kwargs={
@@ -196,10 +203,17 @@ env_configs: dict[str, Config] = {
         ),
     ),
     "Pendulum-custom": Config(
-        CMORL(partial(reward_fns.multi_dim_pendulum, setpoint=0.0))
+        CMORL(
+            partial(reward_fns.multi_dim_pendulum, setpoint=0.0),
+            batched_reward_fn=partial(reward_fns.multi_dim_pendulum_batch, setpoint=0.0),
+        )
     ),
     "LunarLanderContinuous-v2": Config(
-        CMORL(reward_fns.lunar_lander_rw, reward_fns.lander_composer),
+        CMORL(
+            reward_fns.lunar_lander_rw,
+            reward_fns.lander_composer,
+            batched_reward_fn=reward_fns.lunar_lander_rw_batch,
+        ),
         HyperParams(
             ac_kwargs={
                 "obs_normalizer": gymnasium.make(
@@ -223,10 +237,14 @@ env_configs: dict[str, Config] = {
             threshold=1.5,
             # before_clip = 0.01
         ),
-        wrapper=lambda x: TimeLimit(FixLander(x), max_episode_steps=400),
+        wrapper=fixed_lander,
     ),
     "Bittle-custom": Config(
-        CMORL(reward_fns.bittle_rw),
+        CMORL(
+            reward_fns.bittle_rw,
+            batched_reward_fn=reward_fns.bittle_rw_batch,
+            info_keys=("forward", "change_direction"),
+        ),
         HyperParams(
             max_ep_len=400,
             env_args={"observe_joints": True},
@@ -242,9 +260,12 @@ env_configs: dict[str, Config] = {
 }
 
 
+def make_env(env_name: str, wrapper, env_args: dict, **kwargs) -> gymnasium.Env:
+    return wrapper(gymnasium.make(env_name, **{**kwargs, **env_args}))
+
+
 def get_env_and_config(env_name: str) -> tuple[Callable[..., gymnasium.Env], Config]:
     config = env_configs.get(env_name, Config())
-    make_env = lambda **kwargs: config.wrapper(
-        gymnasium.make(env_name, **{**kwargs, **config.hypers.env_args})
-    )
-    return make_env, config
+    # a partial of a module level function, unlike a closure over the config (and its traced
+    # composer) it pickles into spawned actor processes
+    return partial(make_env, env_name, config.wrapper, config.hypers.env_args), config
@@ -0,0 +1,30 @@
+import argparse
+from cmorl.configs import get_env_and_config
+from cmorl.utils import dataset_utils
+import envs # for the gym registrations
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(
+        description="Recomputes the CMORL rewards of stored episodes with the env's current reward fn "
+        "and writes them into the replay library folder of that reward fn"
+    )
+    parser.add_argument("env_name", type=str, help="environment name (used in gym.make)")
+    parser.add_argument("source", type=str, help="folder of shards stored with another reward fn")
+    parser.add_argument("--library", type=str, required=True, help="replay library to write into")
+    parser.add_argument("--chunk_size", type=int, default=65536, help="steps relabeled at a time")
+    return parser.parse_args(args)
+
+def parse_args_and_relabel(args=None):
+    """Returns the number of steps relabeled and the library folder they were written into"""
+    args = parse_args(args)
+    env_fn, config = get_env_and_config(args.env_name)
+    spec = dataset_utils.env_spec(args.env_name, config.hypers.env_args, config.cmorl)
+    target = dataset_utils.library_folder(args.library, spec)
+    steps = dataset_utils.relabel_shards(
+        args.source, target, config.cmorl, env_fn(), spec, chunk_size=args.chunk_size
+    )
+    print(f"Relabeled {steps} steps into {target}")
+    return steps, target
+
+if __name__ == "__main__":
+    parse_args_and_relabel()
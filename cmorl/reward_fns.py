@@ -2,7 +2,8 @@ from functools import partial
 import numpy as np
 import tensorflow as tf
 
-from cmorl.utils.loss_composition import clip_to, curriculum, importance, inv_mean, offset, p_mean, then, weaken
+from cmorl.utils.composition import AND, CLIP, OFFSET, POW, Composer, objective
+from cmorl.utils.loss_composition import clip_to, curriculum, importance, inv_mean, offset, p_mean, per_config, then, weaken
 from cmorl.utils.reward_utils import  CMORL, Transition
 from gymnasium.envs.box2d.lunar_lander import LunarLander
 from gymnasium.envs.mujoco.reacher import ReacherEnv
@@ -11,7 +12,7 @@ from gymnasium.envs.mujoco.mujoco_env import MujocoEnv
 from envs.Bittle.opencat_gym_env import OpenCatGymEnv
 
 def mujoco_multi_dim_reward_joints_x_velocity(transition: Transition, env: MujocoEnv, speed_multiplier=1.0, action_multiplier=1.0):
-    action = np.clip((1.0 - tf.abs(transition.action*action_multiplier)**2.0), 0.0, 1.0)
+    action = np.clip((1.0 - np.abs(transition.action*action_multiplier)**2.0), 0.0, 1.0)
     if not hasattr(env, "prev_xpos"):
         env.prev_xpos = np.copy(env.data.xpos) # type: ignore
     x_velocities = (env.data.xpos - env.prev_xpos) / env.dt # type: ignore
@@ -27,8 +28,8 @@ def mujoco_CMORL(num_actions, speed_multiplier=1.0, action_multiplier=1.0):
         q_x_batch = tf.transpose(q_values)
         speed_batch =p_mean(q_x_batch[0:-num_actions], p=-1.0, axis=0)
         action_batch = tf.clip_by_value(p_mean(q_x_batch[-num_actions:], p=0.0, axis=0), 0.0, 1.0)
-        combined_batch = p_mean([speed_batch, action_batch], p=p_objectives, axis=0)
-        combined = p_mean(combined_batch, p=p_batch, axis=0)
+        combined_batch = p_mean([speed_batch, action_batch], p=per_config(p_objectives), axis=0)
+        combined = p_mean(combined_batch, p=p_batch, axis=-1)
         # qs_c = p_mean(q_values, p=p_batch, axis=0)
         # speed = p_mean(qs_c[0:-num_actions], p=-2.0)
         # action = tf.clip_by_value(p_mean(qs_c[-num_actions:], p=0.0)/0.7, 0.0, 1.0)
@@ -53,27 +54,29 @@ def halfcheetah_CMORL():
 
     @tf.function
     def composer(q_values, p_batch=0, p_objectives=-4.0):
-        qs_c = p_mean(q_values, p=p_batch, axis=0)
-        slow = qs_c[0]
-        fast = qs_c[1]
-        action = p_mean(qs_c[-num_actions:], p=-1.0)
+        qs_c = p_mean(q_values, p=per_config(p_batch), axis=0)
+        slow = qs_c[..., 0]
+        fast = qs_c[..., 1]
+        action = p_mean(qs_c[..., -num_actions:], p=-1.0, axis=-1)
         # q_c = then(forward, action, slack=0.5) 
         # q_c = forward
         # q_c = curriculum([action, slow, fast], slack=0.3, p=p_objectives)
-        q_c = then(slow, p_mean([action**0.5, fast], p=p_objectives))
-        return tf.stack([action, slow, fast]), q_c
+        speed_and_action = p_mean([action**0.5, fast], p=p_objectives, axis=0)
+        # slow only has the configuration axis of p_batch, not the one of p_objectives
+        q_c = then(tf.broadcast_to(slow, tf.shape(speed_and_action)), speed_and_action)
+        return tf.stack([action, slow, fast], axis=-1), q_c
     return CMORL(reward, composer)
 
 def walker_CMORL(speed_multiplier=0.5):
     @tf.function
     def walker_composer(q_values, p_batch=0, p_objectives=-4.0):
-        qs_c = p_mean(q_values, p=p_batch, axis=0)
-        speed = p_mean(qs_c[0:-6], p=0.0)
-        action = p_mean(qs_c[-6:], p=0.0)
+        qs_c = p_mean(q_values, p=per_config(p_batch), axis=0)
+        speed = p_mean(qs_c[..., 0:-6], p=0.0, axis=-1)
+        action = p_mean(qs_c[..., -6:], p=0.0, axis=-1)
         # q_c = then(forward, action, slack=0.5) 
         # q_c = forward
-        q_c = p_mean([speed, action], p=p_objectives)
-        return tf.stack([speed, action]), q_c
+        q_c = p_mean([speed, action], p=p_objectives, axis=0)
+        return tf.stack([speed, action], axis=-1), q_c
     return CMORL(partial(mujoco_multi_dim_reward_joints_x_velocity, speed_multiplier=speed_multiplier), walker_composer)
 
 
@@ -86,6 +89,12 @@ def bittle_rw(transition: Transition, env: OpenCatGymEnv):
     return np.hstack([[forward], change_direction])
     # return np.array([forward])
 
+def bittle_rw_batch(transitions: Transition, env: OpenCatGymEnv):
+    steps = len(transitions.action)
+    forward = transitions.info.get("forward", np.zeros(steps))
+    change_direction = transitions.info.get("change_direction", np.zeros((steps, *env.action_space.shape)))
+    return np.column_stack([forward, change_direction])
+
 def composed_reward_fn(transition, env):
     rew_vec = mujoco_multi_dim_reward_joints_x_velocity(transition, env)
     reward = p_mean(rew_vec, p=-4.0)
@@ -99,28 +108,31 @@ def multi_dim_reacher(transition: Transition, env: ReacherEnv) -> np.ndarray:
     rw_vec = np.concatenate([[reward_performance], reward_actuation], dtype=np.float32)
     return rw_vec
 
-@tf.function
-def reacher_composer(q_values, p_batch=0, p_objectives=-1.0):
-    qs_batch = tf.transpose(q_values)
-    reach = qs_batch[0]**2.0
-    smoothness = p_mean(qs_batch[1:], p=0.0, axis=0)
-    combined = p_mean([reach, smoothness], p=p_objectives, axis=0)
-    q_c = p_mean(combined, p=p_batch, axis=0)
-    return p_mean([smoothness, reach], p=p_batch, axis=-1), q_c
+def multi_dim_reacher_batch(transitions: Transition, env: ReacherEnv) -> np.ndarray:
+    reward_performance = 1.0 - np.clip(np.linalg.norm(transitions.next_state[:, -3:-1], axis=-1)/0.4, 0.0, 1.0)
+    reward_actuation = np.clip((1 - (transitions.action/0.4)**2.0), 0.0, 1.0)
+    return np.concatenate([reward_performance[:, None], reward_actuation], axis=-1, dtype=np.float32)
+
+# the smoothness of both joints and reach, in the order the Q columns were logged in
+reacher_composer = Composer(
+    AND(AND(objective(1), objective(2), p=0.0), POW(objective(0), 2.0)),
+    p_batch=0.0,
+    p_objectives=-1.0,
+)
 
 reacher_cmorl = CMORL(
-    multi_dim_reacher, reacher_composer 
+    multi_dim_reacher, reacher_composer, batched_reward_fn=multi_dim_reacher_batch
 )
 
 def normed_angular_distance(a, b):
     diff = (b - a + np.pi) % (2 * np.pi) - np.pi
-    return np.abs(diff + 2 * np.pi if diff < -np.pi else diff) / np.pi
+    return np.abs(np.where(diff < -np.pi, diff + 2 * np.pi, diff)) / np.pi
 
 def multi_dim_pendulum(transition: Transition, env, setpoint) -> np.ndarray:
     # check if action is an array or a scalar
     u = np.squeeze(transition.action)
     th, thdot = env.state  # th := theta
-    angle_rw = 1.0 - tf.clip_by_value(normed_angular_distance(th, setpoint)*2.0, 0.0, 1.0)
+    angle_rw = 1.0 - np.clip(normed_angular_distance(th, setpoint)*2.0, 0.0, 1.0)
 
     # Normalizing the torque to be in the range [0, 1]
     normalized_u = abs(u / env.max_torque)
@@ -131,6 +143,15 @@ def multi_dim_pendulum(transition: Transition, env, setpoint) -> np.ndarray:
     rw_vec = np.array([angle_rw, actuation_rw], dtype=np.float32)
     return rw_vec
 
+def multi_dim_pendulum_batch(transitions: Transition, env, setpoint) -> np.ndarray:
+    # the angle is recovered from the (cos, sin, thdot) observation instead of env.state
+    th = np.arctan2(transitions.next_state[:, 1], transitions.next_state[:, 0])
+    angle_rw = 1.0 - np.clip(normed_angular_distance(th, setpoint)*2.0, 0.0, 1.0)
+    u = np.reshape(transitions.action, (len(transitions.action), -1))[:, 0]
+    normalized_u = np.abs(u / env.max_torque)
+    actuation_rw = 1.0 - normalized_u**2.0
+    return np.stack([angle_rw, actuation_rw], axis=-1).astype(np.float32)
+
 # APS Specification for Pendulum:
 # 
 # \begin{align}
@@ -140,13 +161,7 @@ def multi_dim_pendulum(transition: Transition, env, setpoint) -> np.ndarray:
 # This specification represents a conjunction between the angle alignment and 
 # minimal actuation objectives using a power mean with p=-1.0 (harmonic mean).
 # The agent must balance both objectives, with neither being severely sacrificed.
-@tf.function
-def pendulum_composer(q_values, p_batch=0, p_objectives=-4.0):
-    qs_batch = tf.transpose(q_values)
-    angle = qs_batch[0]**2.0
-    actuation = qs_batch[1]
-    q_c = p_mean(p_mean([angle, actuation], p=p_objectives, axis=0), p=p_batch, axis=0)
-    return p_mean([angle, actuation], p=p_batch, axis=0), q_c
+pendulum_composer = Composer(AND(POW(objective(0), 2.0), objective(1)), p_batch=0.0, p_objectives=-4.0)
 
 def are_bodies_in_contact(world, body1, body2):
     # Get the contact list from the world
@@ -173,12 +188,25 @@ def lunar_lander_rw(transition: Transition, env: LunarLander)  -> np.ndarray:
     # land_stop = p_mean([(legs_contact[0] or legs_contact[1])*1.0, fuel_cost], p=0.0)
     # legs = p_mean(np.concatenate([legs_contact, [fuel_cost_bottom, fuel_cost_lr]]), p=0.5)
     legs = p_mean(legs_contact, p=0.1)
-    fuel_cost = p_mean([fuel_cost_lr, fuel_cost_bottom], p=0.5, dtype=tf.float32)
-    landed = p_mean([legs, fuel_cost, tf.cast(very_nearness, tf.float32)], p=0.0, dtype=tf.float32)
+    fuel_cost = p_mean([fuel_cost_lr, fuel_cost_bottom], p=0.5, dtype=np.float32)
+    landed = p_mean([legs, fuel_cost, very_nearness], p=0.0, dtype=np.float32)
     # return np.concatenate([[nearness**4.0, very_nearness**2.0], fuel_costs, legs])
     # return np.concatenate([[nearness, very_nearness, fuel_cost_lr, fuel_cost_bottom], legs])
     return np.array([nearness, very_nearness, fuel_cost_lr, fuel_cost_bottom, legs, landed])
 
+def lunar_lander_rw_batch(transitions: Transition, env: LunarLander) -> np.ndarray:
+    next_states, actions = transitions.next_state, transitions.action
+    legs_contact = next_states[:, -2:]
+    fuel_cost_bottom = 1.0 - ((actions[:, 0]+1.0)/2.0)
+    fuel_cost_lr = 1.0 - np.abs(actions[:, 1])
+    distance = np.linalg.norm(next_states[:, 0:2], axis=-1)
+    nearness = 1.0 - np.clip(distance, 0, 1)
+    very_nearness = (1.0 - np.clip(2*distance, 0.0, 1.0))**2.0
+    legs = p_mean(legs_contact, p=0.1, axis=1)
+    fuel_cost = p_mean(np.stack([fuel_cost_lr, fuel_cost_bottom], axis=1), p=0.5, axis=1, dtype=np.float32)
+    landed = p_mean(np.stack([legs, fuel_cost, very_nearness], axis=1), p=0.0, axis=1, dtype=np.float32)
+    return np.stack([nearness, very_nearness, fuel_cost_lr, fuel_cost_bottom, legs, landed], axis=-1)
+
 @tf.function
 def clip_objectives(qs_c):
     nearness=tf.clip_by_value(qs_c[0]/0.8, 0.0, 1.0)
@@ -189,21 +217,22 @@ def clip_objectives(qs_c):
     return (nearness, very_nearness, legs_touch, fuel_cost, landed)
 
 
-@tf.function
-def lander_composer(q_values, p_batch=0, p_objectives=-4.0):
-    q_x_batch = tf.transpose(q_values)
-    # qs_c = p_mean(q_values, p=p_batch, axis=0)
-    clipped = clip_objectives(q_x_batch)
-    # (nearness, very_nearness, legs_touch, fuel_cost, landed) = clipped
-    combined_batch = p_mean(clipped, p=p_objectives, axis=0)
-    q_c = p_mean(combined_batch, p=p_batch, axis=0)
-    qs_c = p_mean(clipped, p=p_batch, axis=1)
-    # q_c = p_mean([nearness, very_nearness, legs_touch, fuel_cost, landed], p=p_objectives)
-    return qs_c, q_c
+# the objectives of clip_objectives: nearness, very_nearness, legs_touch, fuel_cost, landed
+lander_composer = Composer(
+    AND(
+        CLIP(objective(0), 0.0, 0.8),
+        OFFSET(CLIP(objective(1), 0.0, 0.6), 0.1),
+        OFFSET(CLIP(objective(4), 0.0, 0.6), 0.1),
+        OFFSET(CLIP(AND(objective(2), objective(3), p=1.0), 0.0, 0.7), 0.5),
+        OFFSET(CLIP(objective(5), 0.0, 0.7), 0.1),
+    ),
+    p_batch=0.0,
+    p_objectives=-4.0,
+)
 
 @tf.function
 def lander_composer2(q_values, p_batch=0, p_objectives=-4.0):
-    qs_c = p_mean(q_values, p=p_batch, axis=0)
-    (nearness, very_nearness, legs_touch, fuel_cost) = clip_objectives(qs_c)
-    q_c = p_mean([nearness, very_nearness, legs_touch, fuel_cost], p=p_objectives)
-    return tf.concat([qs_c, [nearness, very_nearness, legs_touch]],axis=0), q_c
\ No newline at end of file
+    qs_c = p_mean(q_values, p=per_config(p_batch), axis=0)
+    (nearness, very_nearness, legs_touch, fuel_cost, _) = clip_objectives(tf.experimental.numpy.moveaxis(qs_c, -1, 0))
+    q_c = p_mean([nearness, very_nearness, legs_touch, fuel_cost], p=p_objectives, axis=0)
+    return tf.concat([qs_c, tf.stack([nearness, very_nearness, legs_touch], axis=-1)], axis=-1), q_c
\ No newline at end of file
@@ -158,3 +158,80 @@ def mlp_actor_critic(
         actor(obs_space, act_space, actor_hidden_sizes, obs_normalizer, seed=seed, push_strength=actor_keep_in_range),
         critic(obs_space, act_space, critic_hidden_sizes, obs_normalizer, rwds_dim, seed=seed, push_strength=critic_keep_in_range),
     )
+
+
+class PerturbedActor:
+    """
+    A persistent copy of an actor whose weights are the actor's weights plus gaussian noise.
+    The noise is only redrawn when ``resample`` is called, so the per step cost is a single
+    compiled forward pass instead of copying and noising every weight.
+    """
+
+    def __init__(self, actor: Model, action_space: spaces.Box, seed=42):
+        self.actor = actor
+        self.perturbed = keras.models.clone_model(actor)
+        self.generator = tf.random.Generator.from_seed(seed)
+        self.low = tf.constant(action_space.low, dtype=tf.float32)
+        self.high = tf.constant(action_space.high, dtype=tf.float32)
+        self.resample(0.0)
+
+    def resample(self, noise_scale):
+        self._perturb(tf.constant(noise_scale, dtype=tf.float32))
+
+    @tf.function
+    def _perturb(self, noise_scale):
+        for w, perturbed_w in zip(self.actor.weights, self.perturbed.weights):
+            noise = self.generator.normal(tf.shape(w), dtype=w.dtype)
+            perturbed_w.assign(w + noise * tf.cast(noise_scale, w.dtype))
+
+    def _scale(self, minus_1_to_1):
+        a = minus_1_to_1 * (self.high - self.low) / 2.0 + (self.high + self.low) / 2.0
+        return tf.clip_by_value(a, self.low, self.high)
+
+    @tf.function
+    def act(self, o):
+        return self._scale(self.perturbed(tf.cast(tf.expand_dims(o, 0), tf.float32))[0])
+
+    @tf.function
+    def act_batch(self, obs):
+        return self._scale(self.perturbed(tf.cast(obs, tf.float32)))
+
+
+class NumpyActor:
+    """
+    A NumPy forward pass of the networks built by ``actor``, for processes that only act and
+    shouldn't run TF. ``weights`` are in the order of ``actor.get_weights()``, the noise used for
+    exploration is redrawn on the host by ``resample``.
+    """
+
+    def __init__(self, obs_scale, obs_offset, action_space: spaces.Box, weights):
+        self.obs_scale = np.asarray(obs_scale, dtype=np.float32)
+        self.obs_offset = np.asarray(obs_offset, dtype=np.float32)
+        self.low = action_space.low
+        self.high = action_space.high
+        self.set_weights(weights)
+
+    @staticmethod
+    def from_keras(actor: Model, action_space: spaces.Box):
+        rescaling = next(layer for layer in actor.layers if isinstance(layer, Rescaling))
+        return NumpyActor(rescaling.scale, rescaling.offset, action_space, actor.get_weights())
+
+    def set_weights(self, weights):
+        self.weights = [np.asarray(w, dtype=np.float32) for w in weights]
+        self.noised = self.weights
+
+    def resample(self, noise_scale, np_random: np.random.Generator):
+        self.noised = [
+            w + np_random.standard_normal(w.shape, dtype=np.float32) * noise_scale
+            for w in self.weights
+        ]
+
+    def __call__(self, obs):
+        x = np.asarray(obs, dtype=np.float32) * self.obs_scale + self.obs_offset
+        kernels, biases = self.noised[0::2], self.noised[1::2]
+        for kernel, bias in zip(kernels[:-1], biases[:-1]):
+            x = np.maximum(x @ kernel + bias, 0.0)
+        x = x @ kernels[-1] + biases[-1]
+        minus_1_to_1 = 2.0 / (1.0 + np.exp(-3.5 * x)) - 1.0  # ClipLayer(-1.0, 1.0)
+        a = minus_1_to_1 * (self.high - self.low) / 2.0 + (self.high + self.low) / 2.0
+        return np.clip(a, self.low, self.high)
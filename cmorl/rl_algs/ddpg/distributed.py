@@ -0,0 +1,262 @@
+"""
+
+Ape-X style experience collection: actor processes step their own env with a NumPy copy
+of the policy and write straight into a SharedReplayBuffer, the learner only trains.
+
+"""
+import queue
+import numpy as np
+import multiprocess as mp
+from multiprocess import shared_memory
+import gymnasium.utils.seeding as seeding
+from cmorl.rl_algs.ddpg.core import NumpyActor
+from cmorl.rl_algs.ddpg.replay_buffer import (
+    Episode,
+    SharedReplayBuffer,
+    attach_shared_memory,
+)
+from cmorl.utils import dataset_utils, reward_utils
+
+
+class SharedWeights:
+    """
+    The latest actor weights, flattened into shared memory together with a version counter
+    so actor processes can tell when the learner published new ones.
+    """
+
+    def __init__(self, weights, lock):
+        self.shapes = [np.shape(w) for w in weights]
+        self.total = int(sum(np.prod(shape) for shape in self.shapes))
+        self.memory = shared_memory.SharedMemory(create=True, size=self.total * 4 + 8)
+        self.lock = lock
+        self.owner = True
+        self._attach_arrays()
+        self.version[0] = 0
+        self.publish(weights)
+
+    def _attach_arrays(self):
+        self.version = np.ndarray((1,), dtype=np.int64, buffer=self.memory.buf)
+        self.flat = np.ndarray(
+            (self.total,), dtype=np.float32, buffer=self.memory.buf, offset=8
+        )
+
+    def publish(self, weights):
+        with self.lock:
+            self.flat[:] = np.concatenate([np.ravel(w) for w in weights])
+            self.version[0] += 1
+
+    def pull(self, version):
+        """Returns (weights, version), weights is None when ``version`` is still the latest"""
+        with self.lock:
+            latest = int(self.version[0])
+            if latest == version:
+                return None, version
+            flat = np.copy(self.flat)
+        splits = np.cumsum([int(np.prod(shape)) for shape in self.shapes])[:-1]
+        return [
+            w.reshape(shape) for w, shape in zip(np.split(flat, splits), self.shapes)
+        ], latest
+
+    def __getstate__(self):
+        return dict(
+            shapes=self.shapes, total=self.total, name=self.memory.name, lock=self.lock
+        )
+
+    def __setstate__(self, state):
+        self.shapes = state["shapes"]
+        self.total = state["total"]
+        self.lock = state["lock"]
+        self.memory = attach_shared_memory(state["name"])
+        self.owner = False
+        self._attach_arrays()
+
+    def close(self):
+        del self.version, self.flat
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
+
+
+def actor_process(
+    actor_id,
+    env_fn,
+    cmorl,
+    replay_buffer: SharedReplayBuffer,
+    shared_weights: SharedWeights,
+    actor: NumpyActor,
+    hp,
+    total_steps,
+    env_steps,
+    q_composed,
+    stats_queue,
+    episode_outputs=(),
+    episode_spec=None,
+):
+    """
+    Runs whole episodes until the actors collectively took total_steps env steps, storing each
+    finished episode into the shared replay buffer and its returns into stats_queue. Every
+    actor writes the episodes into the (folder, shard_steps) shard sets of episode_outputs
+    with writers of its own.
+    """
+    np_random, _ = seeding.np_random(hp.seed + actor_id + 1)
+    env = env_fn()
+    o, _ = env.reset(seed=hp.seed + actor_id + 1)
+    env.action_space._np_random = np_random
+    act_dim = env.action_space.shape[0]
+    rew_dims = replay_buffer.rews_buf.shape[1]
+    version = -1
+    steps_since_pull = hp.actor_sync_every
+    writers = [
+        dataset_utils.ShardWriter(folder, episode_spec, shard_steps)
+        for folder, shard_steps in episode_outputs
+    ]
+    # the step infos are only kept when the shards get them
+    keep_infos = bool(writers) and cmorl is not None and bool(cmorl.info_keys)
+    while env_steps.value < total_steps:
+        episode = Episode(o, act_dim, rew_dims, capacity=hp.max_ep_len or 1000)
+        noise_drawn = False
+        while True:
+            if steps_since_pull >= hp.actor_sync_every:
+                weights, version = shared_weights.pull(version)
+                if weights is not None:
+                    actor.set_weights(weights)
+                    noise_drawn = False
+                steps_since_pull = 0
+            with env_steps.get_lock():
+                env_steps.value += 1
+                t = env_steps.value
+            if t > hp.start_steps:
+                if not noise_drawn:
+                    randomization_amount = (
+                        cmorl.randomization_schedule(t, total_steps, q_composed.value)
+                        if cmorl
+                        else 1.0
+                    )
+                    actor.resample(hp.act_noise * randomization_amount, np_random)
+                    noise_drawn = True
+                action = actor(o)
+            else:
+                action = env.action_space.sample()
+            last_o = o
+            o, reward, done, truncated, info = env.step(action)
+            steps_since_pull += 1
+            if cmorl is None:
+                episode.append(action, o, reward, reward)
+            elif cmorl.batched:
+                episode.append(action, o, reward, info=info)
+            else:
+                cmorl_reward = cmorl(
+                    reward_utils.Transition(last_o, action, o, done, info), env
+                )
+                episode.append(action, o, reward, cmorl_reward, info=info if keep_infos else None)
+            truncated = truncated or episode.length == hp.max_ep_len
+            done = done and not truncated
+            if done or truncated:
+                break
+
+        ep_len = episode.length
+        if cmorl is not None and cmorl.batched:
+            episode.compute_cmorl_rewards(cmorl, done, env)
+        cmorl_rewards = episode.cmorl_rewards[:ep_len]
+        estimated_values = reward_utils.values(cmorl_rewards, hp.gamma, done=done)
+        replay_buffer.store_episode(
+            episode.observations[: ep_len + 1],
+            episode.actions[:ep_len],
+            cmorl_rewards,
+            episode.dones(done),
+            estimated_values,
+        )
+        if writers:
+            infos = reward_utils.stack_infos(
+                [{key: info[key] for key in cmorl.info_keys if key in info} for info in episode.infos]
+                if cmorl is not None
+                else []
+            )
+            for writer in writers:
+                writer.add_episode(
+                    episode.observations[: ep_len + 1],
+                    episode.actions[:ep_len],
+                    episode.rewards[:ep_len],
+                    cmorl_rewards,
+                    done,
+                    infos,
+                )
+        stats_queue.put(
+            (np.sum(episode.rewards[:ep_len]), ep_len, np.sum(cmorl_rewards, axis=0))
+        )
+        o, _ = env.reset()
+    for writer in writers:
+        writer.close()
+
+
+class DistributedActors:
+    """
+    Starts hp.num_actor_processes actor processes writing into ``replay_buffer``,
+    the learner hands them new policy weights with ``publish``.
+    """
+
+    def __init__(
+        self,
+        env_fn,
+        cmorl,
+        replay_buffer: SharedReplayBuffer,
+        pi_network,
+        action_space,
+        hp,
+        total_steps,
+        episode_outputs=(),
+        episode_spec=None,
+    ):
+        ctx = mp.get_context("spawn")
+        self.shared_weights = SharedWeights(pi_network.get_weights(), ctx.Lock())
+        self.env_steps = ctx.Value("q", 0)
+        self.q_composed = ctx.Value("d", 0.0)
+        self.stats_queue = ctx.Queue()
+        # the actors only need the reward fn, composers hold tf.functions that don't pickle well
+        actor_cmorl = None if cmorl is None else cmorl.with_q_composer(None)
+        self.processes = [
+            ctx.Process(
+                target=actor_process,
+                args=(
+                    actor_id,
+                    env_fn,
+                    actor_cmorl,
+                    replay_buffer,
+                    self.shared_weights,
+                    NumpyActor.from_keras(pi_network, action_space),
+                    hp,
+                    total_steps,
+                    self.env_steps,
+                    self.q_composed,
+                    self.stats_queue,
+                    episode_outputs,
+                    episode_spec,
+                ),
+                daemon=True,
+            )
+            for actor_id in range(hp.num_actor_processes)
+        ]
+
+    def start(self):
+        for process in self.processes:
+            process.start()
+
+    def publish(self, pi_network, q_c):
+        self.shared_weights.publish(pi_network.get_weights())
+        self.q_composed.value = float(q_c)
+
+    def running(self):
+        return any(process.is_alive() for process in self.processes)
+
+    def drain_stats(self):
+        stats = []
+        while True:
+            try:
+                stats.append(self.stats_queue.get_nowait())
+            except queue.Empty:
+                return stats
+
+    def close(self):
+        for process in self.processes:
+            process.join()
+        self.shared_weights.close()
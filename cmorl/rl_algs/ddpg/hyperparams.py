@@ -34,6 +34,32 @@ class HyperParams(Namespace):
     before_clip      : float
     env_args         : dict[str, object]
     ignore_aps       : bool
+    num_envs         : int
+    fused_update     : bool
+    noise_resample_every : int
+    async_learner    : bool
+    update_to_data   : float
+    queue_size       : int
+    num_actor_processes : int
+    actor_sync_every : int
+    replay_sampling  : str
+    per_alpha        : float
+    per_beta         : float
+    deficit_uniform_fraction : float
+    replay_dir       : str
+    episode_replay   : bool
+    n_step           : int
+    replay_dtype     : str
+    save_replay      : bool
+    load_replay      : str
+    checkpoint       : bool
+    resume           : bool
+    replay_library   : str
+    relabel_replay   : bool
+    offline          : str
+    offline_test_episodes : int
+    export_episodes  : bool
+    export_shard_steps : int
     # noise_schedule : tf.keras.optimizers.schedules.LearningRateSchedule
 
 descriptions: dict[str,  str] = {
@@ -49,7 +75,7 @@ descriptions: dict[str,  str] = {
     "q_lr": "Learning rate for Q-networks",
     "batch_size": "Minibatch size for SGD",
     "start_steps": "Number of steps for uniform-random action selection, before running real policy. Helps exploration",
-    "act_noise": "Stddev for Gaussian exploration noise added to policy at training time. (At test time, no noise is added)",
+    "act_noise": "Stddev for Gaussian exploration noise added to the policy's weights at training time. (At test time, no noise is added)",
     "max_ep_len": "Maximum length of an episode",
     "train_every": "Number of steps to wait before training",
     "train_steps": "Number of training steps to take",
@@ -61,6 +87,32 @@ descriptions: dict[str,  str] = {
     "threshold": "The threshold for the loss to keep the actions in range",
     "before_clip": "The loss weight for the clip loss",
     "ignore_aps": "Whether to ignore the APS specification and train on original rewards, ala standard DDPG",
+    "num_envs": "Number of copies of the environment stepped together, the policy is evaluated once per step for all of them",
+    "fused_update": "Whether to keep the replay buffer in tf variables and run all train_steps of an update in a single compiled graph",
+    "noise_resample_every": "Number of env steps between redrawing the policy's weight noise, 0 redraws it once per episode",
+    "async_learner": "Whether to collect experience on a separate thread while the learner trains continuously",
+    "update_to_data": "Gradient steps per collected env step the learner is allowed to take when async_learner or num_actor_processes is set",
+    "queue_size": "Maximum number of finished episodes waiting for the learner before collection blocks, when async_learner is set",
+    "num_actor_processes": "Number of processes collecting experience into a shared memory replay buffer, 0 collects in the learner's process",
+    "actor_sync_every": "Number of env steps an actor process takes between pulls of the latest policy weights",
+    "replay_sampling": "How minibatches are drawn from the replay buffer: uniform, prioritized by the critic's per-sample TD errors, or deficit, favoring transitions that achieve the objectives the composer is most sensitive to",
+    "per_alpha": "How strongly prioritized replay follows the priorities, 0 is uniform sampling",
+    "per_beta": "Initial exponent of prioritized replay's importance weights, annealed to 1 over training",
+    "deficit_uniform_fraction": "Fraction of every minibatch deficit sampling still draws uniformly",
+    "replay_dir": "Directory to keep the replay buffer in as memory mapped files instead of RAM, a buffer left there by a previous run with the same shapes is reused. Empty keeps it in memory",
+    "episode_replay": "Whether the replay buffer keeps whole episodes so each observation is stored once and the estimated values follow the current gamma",
+    "n_step": "Number of rewards the critic's targets sum before bootstrapping, more than 1 needs episode_replay",
+    "save_replay": "Whether every save also writes a snapshot of the replay buffer next to the epoch folders, in the background",
+    "load_replay": "Folder holding a replay snapshot (the replay folder's parent) to start the replay buffer from, memory mapped. Empty starts empty",
+    "checkpoint": "Whether every save also writes the full training state (networks, targets, optimizers, replay buffer, RNG states and step counter) for --resume",
+    "resume": "Continue from the checkpoint of a previous run with the same hyperparameters and --seed, without --seed from the only seed that has a checkpoint. Fails when there is none. Implies --checkpoint",
+    "replay_library": "Folder of episodes shared between runs, keyed by env name, env_args and reward fn. The replay buffer starts with the newest of them (skipping start_steps once there are enough) and the run adds its own. Empty disables it",
+    "relabel_replay": "Whether to recompute the rewards and estimated values of a replay buffer loaded with --load_replay with this run's reward fn and gamma, from the stored transitions and info keys",
+    "offline": "Folder of stored episodes (a replay library folder or shards exported by a run) to train on without collecting any experience. Empty trains online",
+    "offline_test_episodes": "Number of test episodes run at the end of every epoch of offline training",
+    "export_episodes": "Whether to write every finished episode into shards in the episodes folder of the run's output directory, for analysis or offline training",
+    "export_shard_steps": "Number of steps per shard written by --export_episodes",
+    "replay_dtype": "Storage dtype of the replay buffer's fields: float32, float16, or uint8 / uint16 quantizing the bounded observations, actions and CMORL rewards over their bounds",
 }
 
 abbreviations = {
@@ -107,8 +159,61 @@ def default_hypers():
         threshold       = 1.0,
         env_args        = {},
         ignore_aps      = False,
+        num_envs        = 1,
+        fused_update    = False,
+        noise_resample_every = 0,
+        async_learner   = False,
+        update_to_data  = 1.0,
+        queue_size      = 16,
+        num_actor_processes = 0,
+        actor_sync_every = 1000,
+        replay_sampling = "uniform",
+        per_alpha       = 0.6,
+        per_beta        = 0.4,
+        deficit_uniform_fraction = 0.5,
+        replay_dir      = "",
+        episode_replay  = False,
+        n_step          = 1,
+        replay_dtype    = "float32",
+        save_replay     = False,
+        load_replay     = "",
+        checkpoint      = False,
+        resume          = False,
+        replay_library  = "",
+        relabel_replay  = False,
+        offline         = "",
+        offline_test_episodes = 5,
+        export_episodes = False,
+        export_shard_steps = 100_000,
     )
 
+replay_samplings = ("uniform", "prioritized", "deficit")
+replay_dtypes = ("float32", "float16", "uint8", "uint16")
+
+def validate(hp: HyperParams):
+    """Raises a ValueError for hyperparameters that don't work together, returns hp otherwise"""
+    # fused_update and the actor processes keep the replay buffer in tf variables or shared memory
+    host_buffer = not (hp.fused_update or hp.num_actor_processes > 0)
+    if hp.fused_update and hp.num_actor_processes > 0:
+        raise ValueError("num_actor_processes needs the shared memory replay buffer, it can't be used with fused_update")
+    if hp.offline and (hp.async_learner or hp.num_actor_processes > 0):
+        raise ValueError("offline training has no experience collection to run async_learner or num_actor_processes for")
+    if hp.replay_sampling not in replay_samplings:
+        raise ValueError(f"unknown replay_sampling {hp.replay_sampling}, one of {replay_samplings}")
+    if hp.replay_sampling != "uniform" and not host_buffer:
+        raise ValueError(f"replay_sampling {hp.replay_sampling} only works without fused_update and num_actor_processes")
+    if hp.replay_dir and not host_buffer:
+        raise ValueError("replay_dir only works without fused_update and num_actor_processes")
+    if hp.episode_replay and not (hp.replay_sampling == "uniform" and host_buffer):
+        raise ValueError("episode_replay only works with uniform replay_sampling, without fused_update and num_actor_processes")
+    if hp.n_step != 1 and not hp.episode_replay:
+        raise ValueError("n_step targets need episode_replay")
+    if hp.replay_dtype not in replay_dtypes:
+        raise ValueError(f"unknown replay_dtype {hp.replay_dtype}, one of {replay_dtypes}")
+    if hp.replay_dtype != "float32" and not host_buffer:
+        raise ValueError("replay_dtype only works without fused_update and num_actor_processes")
+    return hp
+
 def combine(*hps: HyperParams):
     """Combine multiple hyperparams objects into one. The later objects override the earlier ones."""
     return reduce(lambda x, y: HyperParams(**{**vars(x), **vars(y)}), hps, HyperParams())
@@ -131,6 +236,6 @@ def rl_alg_serializer(experiment_name=None):
 def default_serializer(hypers=HyperParams(), experiment_name=None):
     combined_hypers = combine(default_hypers(), hypers)
     return Arg_Serializer.join(
-        namespace_serializer(combined_hypers, ignored={"seed"}, descriptions=descriptions, abbrevs=abbreviations),
+        namespace_serializer(combined_hypers, ignored={"seed", "replay_dir", "save_replay", "load_replay", "checkpoint", "resume", "export_episodes", "export_shard_steps"}, descriptions=descriptions, abbrevs=abbreviations),
         rl_alg_serializer(experiment_name=experiment_name),
     )
@@ -0,0 +1,315 @@
+import numpy as np
+import tensorflow as tf  # type: ignore
+import keras  # type: ignore
+from cmorl.rl_algs.ddpg.hyperparams import HyperParams
+from cmorl.utils.logx import MetricsAccumulator
+from cmorl.utils.loss_composition import move_towards_range, p_mean, scale_gradient
+
+
+class Learner:
+    """
+    The actor and critic, their target networks and optimizers, and the compiled graphs that
+    train them on minibatches of ``replay_buffer``.
+
+    Every update accumulates its metrics into ``update_metrics`` on the device, and into
+    ``logger_metrics`` (the epoch logger's accumulator) when one is given, the caller reads and
+    resets them.
+    """
+
+    def __init__(
+        self,
+        hp: HyperParams,
+        pi_network: keras.Model,
+        q_network: keras.Model,
+        pi_targ_network: keras.Model,
+        q_targ_network: keras.Model,
+        replay_buffer,
+        rew_dims: int,
+        q_composer=None,
+        logger_metrics: MetricsAccumulator | None = None,
+    ):
+        self.hp = hp
+        self.pi_network, self.q_network = pi_network, q_network
+        self.pi_targ_network, self.q_targ_network = pi_targ_network, q_targ_network
+        self.replay_buffer = replay_buffer
+        self.rew_dims = rew_dims
+        self.q_composer = q_composer
+        self.logger_metrics = logger_metrics
+
+        self.pi_and_before_clip = keras.Model(
+            pi_network.input,
+            {"pi": pi_network.output, "before_clip": pi_network.layers[-2].output},
+        )
+        self.pi_and_before_clip.compile()
+        self.q_and_before_clip = keras.Model(
+            q_network.input,
+            {"q": q_network.output, "before_clip": q_network.layers[-2].output},
+        )
+        self.q_and_before_clip.compile()
+        # Note that the action placeholder going to actor_critic here is
+        # irrelevant, because we only need q_targ(s, pi_targ(s)).
+        self.q_targ_and_before_clip = keras.Model(
+            q_targ_network.input,
+            {
+                "q": q_targ_network.output,
+                "before_clip": q_targ_network.layers[-2].output,
+            },
+        )
+        # make sure network and target network is using the same weights
+        pi_targ_network.set_weights(pi_network.get_weights())
+        q_targ_network.set_weights(q_network.get_weights())
+
+        # Separate train ops for pi, q
+        self.pi_optimizer = keras.optimizers.Adam(learning_rate=hp.pi_lr)
+        self.q_optimizer = keras.optimizers.Adam(learning_rate=hp.q_lr)
+        # build the optimizer slots now so no variables get created inside the fused update's loop
+        self.pi_optimizer.build(pi_network.trainable_variables)
+        self.q_optimizer.build(q_network.trainable_variables)
+
+        # the update graphs accumulate their metrics into tf.Variables, those have to exist before tracing
+        self.n_qs = (
+            len(
+                q_composer(
+                    tf.zeros([hp.batch_size, rew_dims]),
+                    p_batch=hp.p_batch,
+                    p_objectives=hp.p_objectives,
+                )[0]
+            )
+            if q_composer is not None
+            else 1
+        )
+        self.update_metrics = MetricsAccumulator()
+        for key in ["Q-Loss", "Q-before_clip_c", "Q-bellman_c", "Q-direct_c", "Q-composed", "before_clip"]:
+            self.update_metrics.add_key(key)
+        self.update_metrics.add_key("Q", [self.n_qs])
+        if logger_metrics is not None:
+            for key in ["LossQ", "Q_before_clip_c", "Q_bellman_c", "Q_direct_c", "actor_before_clip_c", "Q_comp"]:
+                logger_metrics.add_key(key)
+            for i in range(self.n_qs):
+                logger_metrics.add_key(f"Q{i}")
+        # running |d q_c / d q_values| per objective, which objectives the composer is bottlenecked by
+        self.objective_sensitivity = tf.Variable(tf.fill([rew_dims], 1.0 / rew_dims), trainable=False)
+
+    def trackables(self):
+        """Everything of the learner with state in tf variables, by the name a checkpoint keeps it under"""
+        return dict(
+            pi=self.pi_network,
+            q=self.q_network,
+            pi_targ=self.pi_targ_network,
+            q_targ=self.q_targ_network,
+            pi_optimizer=self.pi_optimizer,
+            q_optimizer=self.q_optimizer,
+            objective_sensitivity=self.objective_sensitivity,
+        )
+
+    def _log(self, **values):
+        if self.logger_metrics is not None:
+            self.logger_metrics.update(**values)
+
+    # Polyak averaging for target variables
+    @tf.function
+    def target_update(self):
+        hp = self.hp
+        for v_main, v_targ in zip(
+            self.pi_network.trainable_variables, self.pi_targ_network.trainable_variables
+        ):
+            v_targ.assign(hp.polyak * v_targ + (1 - hp.polyak) * v_main)
+        for v_main, v_targ in zip(
+            self.q_network.trainable_variables, self.q_targ_network.trainable_variables
+        ):
+            v_targ.assign(hp.polyak * v_targ + (1 - hp.polyak) * v_main)
+
+    @tf.function
+    def q_update(self, obs1, obs2, acts, rews, discounts, estimated_values, weights):
+        """
+        The targets are rews, normalized by 1 - gamma, plus discounts * Q(obs2, pi(obs2)).
+        discounts is gamma * (1 - done) for single steps, see n_step_batch for more steps.
+        weights are the per-sample importance weights of the batch, ones for uniform sampling
+        """
+        hp = self.hp
+        pi_targ = self.pi_targ_network(obs2)
+        q_pi_targ = self.q_targ_and_before_clip(tf.concat([obs2, pi_targ], axis=-1))["q"]
+        batch_size = tf.shape(discounts)[0]
+        normalization_factor = 1.0 - hp.gamma
+        broadcasted_discounts = tf.broadcast_to(
+            tf.expand_dims(discounts, -1), (batch_size, self.rew_dims)
+        )
+        backup = tf.stop_gradient(
+            rews * normalization_factor
+            + broadcasted_discounts * q_pi_targ
+        )
+        with tf.GradientTape() as tape:
+            outputs = self.q_and_before_clip(tf.concat([obs1, acts], axis=-1))
+            q, before_clip = outputs["q"], outputs["before_clip"]
+
+            keep_in_range = tf.reduce_mean(
+                move_towards_range(before_clip, -1.0, 1.0)
+            )
+            td0_error = (q - backup)
+            estimated_tdinf_error = (q - estimated_values)
+            sample_weights = tf.expand_dims(weights, -1)
+            q_bellman_c = tf.reduce_mean(tf.sqrt(tf.reduce_mean(sample_weights*td0_error**2.0, axis=0)))
+            q_direct_c = tf.reduce_mean(tf.sqrt(tf.reduce_mean(sample_weights*estimated_tdinf_error**2.0, axis=0)))
+
+            q_loss = q_bellman_c + q_direct_c * hp.qd_power #- keep_in_range
+
+        grads = tape.gradient(q_loss, self.q_network.trainable_variables)
+        clipped = [tf.clip_by_norm(grad, 1.0) for grad in grads]
+        grads_and_vars = zip(clipped, self.q_network.trainable_variables)
+        self.q_optimizer.apply_gradients(grads_and_vars)
+        self._log(
+            LossQ=q_loss,
+            Q_before_clip_c=1.0 - keep_in_range,
+            Q_bellman_c=1.0 - q_bellman_c,
+            Q_direct_c=1.0 - q_direct_c,
+        )
+        self.update_metrics.update(
+            **{
+                "Q-Loss": q_loss,
+                "Q-before_clip_c": 1.0 - keep_in_range,
+                "Q-bellman_c": 1.0 - q_bellman_c,
+                "Q-direct_c": 1.0 - q_direct_c,
+            }
+        )
+        return q_loss, q_bellman_c, q_direct_c, keep_in_range, td0_error, estimated_tdinf_error
+
+    @tf.function
+    def pi_update(self, obs1, obs2, debug=False):
+        hp = self.hp
+        with tf.GradientTape() as tape:
+            outputs = self.pi_and_before_clip(obs1)
+            pi, before_clip = outputs["pi"], outputs["before_clip"]
+            before_clip_c = p_mean(
+                move_towards_range(before_clip, -hp.threshold, hp.threshold), p=0.0
+            )
+
+            if self.q_composer is not None:
+                q_values = tf.clip_by_value(self.q_network(tf.concat([obs1, pi], axis=-1)), 0.0, 1.0)
+                with tf.GradientTape(watch_accessed_variables=False) as composer_tape:
+                    composer_tape.watch(q_values)
+                    qs_c, q_c = self.q_composer(
+                        q_values, p_batch=hp.p_batch, p_objectives=hp.p_objectives
+                    )
+                all_c = p_mean([q_c, scale_gradient(before_clip_c, hp.before_clip)], p=0.0)
+            else:
+                q_values = self.q_network(tf.concat([obs1, pi], axis=-1))
+                q_c = tf.reduce_mean(q_values)
+                qs_c = [q_c]
+                all_c = q_c + hp.before_clip*before_clip_c
+
+            pi_loss = 1.0 - all_c
+        grads = tape.gradient(pi_loss, self.pi_network.trainable_variables)
+
+        # gradient clipping
+        clipped = [tf.clip_by_norm(grad, 1.0) for grad in grads]
+        grads_and_vars = zip(clipped, self.pi_network.trainable_variables)
+        self.pi_optimizer.apply_gradients(grads_and_vars)
+        if self.q_composer is not None and hp.replay_sampling == "deficit":
+            sensitivity = tf.reduce_mean(
+                tf.abs(composer_tape.gradient(q_c, q_values)), axis=0
+            )
+            self.objective_sensitivity.assign(
+                0.9 * self.objective_sensitivity
+                + 0.1 * sensitivity / (tf.reduce_sum(sensitivity) + 1e-12)
+            )
+        qs_c = tf.reshape(tf.convert_to_tensor(qs_c), [self.n_qs])
+        self._log(
+            actor_before_clip_c=1.0 - before_clip_c,
+            Q_comp=q_c,
+            **{f"Q{i}": qs_c[i] for i in range(self.n_qs)},
+        )
+        self.update_metrics.update(
+            **{"Q-composed": q_c, "before_clip": 1.0 - before_clip_c, "Q": qs_c}
+        )
+        return all_c, qs_c, q_c, before_clip_c
+
+    @tf.function
+    def fused_update(self, train_steps):
+        """
+        Runs train_steps iterations of sampling, q_update, pi_update and target_update in a
+        single graph, on a TensorflowReplayBuffer. Returns the metrics of every iteration stacked
+        per phase: "q" holds [q_loss, q_bellman_c, q_direct_c, keep_in_range] and "pi"
+        [all_c, q_c, before_clip_c] per row, "qs_c" the qs_c of every row.
+        """
+        hp = self.hp
+        q_metrics = tf.TensorArray(tf.float32, size=train_steps)
+        pi_metrics = tf.TensorArray(tf.float32, size=train_steps)
+        qs_cs = tf.TensorArray(tf.float32, size=train_steps)
+        for step in tf.range(train_steps):
+            batch = self.replay_buffer.gather(self.replay_buffer.sample_indices(hp.batch_size))
+            q_loss, q_bellman_c, q_direct_c, keep_in_range, _, _ = self.q_update(
+                batch["obs1"],
+                batch["obs2"],
+                batch["acts"],
+                batch["rews"],
+                hp.gamma * (1.0 - batch["done"]),
+                batch["estimated_values"],
+                tf.ones([hp.batch_size]),
+            )
+            all_c, qs_c, q_c, before_clip_c = self.pi_update(batch["obs1"], batch["obs2"])
+            self.target_update()
+            q_metrics = q_metrics.write(step, tf.stack([q_loss, q_bellman_c, q_direct_c, keep_in_range]))
+            pi_metrics = pi_metrics.write(step, tf.stack([all_c, q_c, before_clip_c]))
+            qs_cs = qs_cs.write(step, qs_c)
+        return dict(q=q_metrics.stack(), pi=pi_metrics.stack(), qs_c=qs_cs.stack())
+
+    def n_step_batch(self, np_random=np.random):
+        """A uniform batch whose targets bootstrap hp.n_step steps later, from the episode replay buffer"""
+        hp = self.hp
+        idxs = self.replay_buffer.sample_indices(hp.batch_size, np_random)
+        batch = self.replay_buffer.gather(idxs)
+        rews_n, obs_n, discounts = self.replay_buffer.n_step(idxs, hp.n_step)
+        # q_update normalizes the rewards of the target itself
+        batch.update(obs2=obs_n, rews=rews_n / (1.0 - hp.gamma), discounts=discounts)
+        return batch
+
+    def update(self, np_random=np.random, progress=0.0):
+        """
+        Runs hp.train_steps updates and returns the qs_c and q_c of the last one. progress is
+        the fraction of the training done, prioritized replay anneals its beta to 1 with it.
+        """
+        hp = self.hp
+        replay_buffer = self.replay_buffer
+        if hp.fused_update:
+            replay_buffer.flush()
+            metrics = self.fused_update(tf.constant(hp.train_steps))
+            return metrics["qs_c"][-1].numpy(), metrics["pi"][-1, 1].numpy()
+        if hp.replay_sampling == "deficit":
+            replay_buffer.objective_weights = self.objective_sensitivity.numpy()
+        for train_step in range(hp.train_steps):
+            if hp.replay_sampling == "prioritized":
+                replay_buffer.beta = hp.per_beta + (1.0 - hp.per_beta) * min(progress, 1.0)
+            if hp.n_step > 1:
+                batch = self.n_step_batch(np_random)
+            else:
+                batch = replay_buffer.sample_batch(hp.batch_size, np_random=np_random)
+                batch["discounts"] = hp.gamma * (1.0 - batch["done"])
+            obs1 = tf.constant(batch["obs1"])
+            obs2 = tf.constant(batch["obs2"])
+            acts = tf.constant(batch["acts"])
+            rews = tf.constant(batch["rews"])
+            discounts = tf.constant(batch["discounts"], dtype=tf.float32)
+            estimated_values = tf.constant(batch["estimated_values"])
+            weights = tf.constant(batch.get("weights", np.ones(hp.batch_size, dtype=np.float32)))
+            # Q-learning update, its metrics are accumulated inside the graph
+            *_, td0_error, estimated_tdinf_error = self.q_update(
+                obs1, obs2, acts, rews, discounts, estimated_values, weights
+            )
+            if hp.replay_sampling == "prioritized":
+                # the same per-sample errors the critic's loss is made of
+                replay_buffer.update_priorities(
+                    batch["idxs"],
+                    np.sqrt(np.mean(np.square(td0_error), axis=1))
+                    + hp.qd_power * np.sqrt(np.mean(np.square(estimated_tdinf_error), axis=1)),
+                )
+            # Policy update
+            (
+                all_c,
+                qs_c,
+                q_c,
+                before_clip_c,
+            ) = self.pi_update(obs1, obs2, (train_step + 1) % 20 == 0)
+
+            # target update
+            self.target_update()
+        return np.asarray(qs_c), q_c
@@ -0,0 +1,898 @@
+import json
+import os
+from pathlib import Path
+import numpy as np
+import tensorflow as tf  # type: ignore
+import multiprocess as mp
+from multiprocess import shared_memory
+from cmorl.rl_algs.ddpg.sum_tree import SumTree
+from cmorl.utils import return_utils, reward_utils
+
+
+class Episode:
+    """
+    The in-progress trajectory of a single env. The transitions are written into arrays that
+    double in size when they fill up, so the finished episode goes to ``store_episode`` as slices.
+    """
+
+    def __init__(self, first_obs, act_dim, rew_dims, capacity=1000):
+        self.length = 0
+        self.observations = np.zeros([capacity + 1, *np.shape(first_obs)], dtype=np.float32)
+        self.observations[0] = first_obs
+        self.actions = np.zeros([capacity, act_dim], dtype=np.float32)
+        self.rewards = np.zeros(capacity, dtype=np.float32)
+        self.cmorl_rewards = np.zeros([capacity, rew_dims], dtype=np.float32)
+        # only kept for batched reward fns, which compute the cmorl rewards at the end
+        self.infos = []
+
+    def append(self, action, next_obs, reward, cmorl_reward=0.0, info=None):
+        if self.length == len(self.actions):
+            self._grow()
+        self.actions[self.length] = action
+        self.rewards[self.length] = reward
+        self.cmorl_rewards[self.length] = cmorl_reward
+        if info is not None:
+            self.infos.append(info)
+        self.length += 1
+        self.observations[self.length] = next_obs
+
+    def compute_cmorl_rewards(self, cmorl, done, env):
+        """Fills in the cmorl rewards of the whole episode with a single batched call"""
+        n = self.length
+        self.cmorl_rewards[:n] = cmorl.batch(
+            self.observations[:n],
+            self.actions[:n],
+            self.observations[1 : n + 1],
+            self.dones(done),
+            self.infos,
+            env,
+        )
+
+    def _grow(self):
+        extra = len(self.actions)
+        for name in ("observations", "actions", "rewards", "cmorl_rewards"):
+            array = getattr(self, name)
+            padding = np.zeros([extra, *array.shape[1:]], dtype=array.dtype)
+            setattr(self, name, np.concatenate([array, padding]))
+
+    def dones(self, done):
+        dones = np.zeros(self.length, dtype=np.float32)
+        dones[-1] = done
+        return dones
+
+
+class FieldCodec:
+    """
+    How a replay field is stored. Floating dtypes are a plain cast, unsigned integer dtypes
+    given the field's bounds map [low, high] affinely onto their whole range (values outside
+    are clipped). ``decode`` always gives back float32.
+    """
+
+    def __init__(self, dtype=np.float32, low=None, high=None):
+        self.dtype = np.dtype(dtype)
+        self.quantized = np.issubdtype(self.dtype, np.unsignedinteger) and low is not None
+        if self.quantized:
+            self.levels = np.iinfo(self.dtype).max
+            self.low = np.asarray(low, dtype=np.float32)
+            scale = (np.asarray(high, dtype=np.float32) - self.low) / self.levels
+            # dimensions with low == high only ever hold low
+            self.levels = np.where(scale > 0.0, self.levels, 0).astype(np.float32)
+            self.scale = np.where(scale > 0.0, scale, 1.0).astype(np.float32)
+
+    def encode(self, values):
+        values = np.asarray(values, dtype=np.float32)
+        if not self.quantized:
+            return values.astype(self.dtype, copy=False)
+        return np.rint(np.clip((values - self.low) / self.scale, 0, self.levels)).astype(self.dtype)
+
+    def decode(self, stored):
+        if not self.quantized:
+            return np.asarray(stored).astype(np.float32, copy=False)
+        return np.asarray(stored, dtype=np.float32) * self.scale + self.low
+
+
+FLOAT32 = FieldCodec()
+
+
+def make_codecs(dtype, observation_space, action_space, reward_space=None, obs_normalizer=None):
+    """
+    The codecs of a buffer storing its fields as ``dtype``. float16 casts every field,
+    uint8 / uint16 quantize the fields with finite bounds and keep the others as float16.
+    Unbounded observation dimensions count as bounded by +-obs_normalizer when it's given.
+    Rewards and estimated values use the bounds of reward_space, CMORL rewards are in [0, 1].
+    """
+    dtype = np.dtype(dtype)
+    if dtype == np.float32:
+        return {}
+
+    def codec(low, high):
+        if np.issubdtype(dtype, np.floating):
+            return FieldCodec(dtype)
+        if low is None or not (np.all(np.isfinite(low)) and np.all(np.isfinite(high))):
+            return FieldCodec(np.float16)
+        return FieldCodec(dtype, low, high)
+
+    obs_low, obs_high = observation_space.low, observation_space.high
+    if obs_normalizer is not None:
+        obs_normalizer = np.broadcast_to(np.asarray(obs_normalizer, dtype=np.float32), obs_low.shape)
+        obs_low = np.where(np.isfinite(obs_low), obs_low, -obs_normalizer)
+        obs_high = np.where(np.isfinite(obs_high), obs_high, obs_normalizer)
+    rew_low, rew_high = (None, None) if reward_space is None else (reward_space.low, reward_space.high)
+    return dict(
+        obs=codec(obs_low, obs_high),
+        acts=codec(action_space.low, action_space.high),
+        rews=codec(rew_low, rew_high),
+        estimated_values=codec(rew_low, rew_high),
+        done=FieldCodec(np.uint8),
+    )
+
+
+class ReplayBuffer:
+    """
+    A simple FIFO experience replay buffer for DDPG agents.
+
+    With a ``storage_dir`` every field is a memory mapped .npy file in that directory and
+    ``flush`` writes ptr and size next to them into header.json, so the buffer can grow past
+    the RAM and a buffer with the same shapes is picked up again by the next process.
+
+    ``codecs`` maps the kinds of fields (obs, acts, rews, done, estimated_values) to the
+    FieldCodec they are stored with, see make_codecs. Fields are decoded as they are gathered.
+
+    The values of ``info_keys`` in the step infos are kept in info_<key> fields, allocated by the
+    first episode that has them, so ``relabel`` can recompute the rewards with another CMORL.
+    """
+
+    # buffer name -> the kind of field it holds
+    fields = dict(
+        obs1_buf="obs",
+        obs2_buf="obs",
+        acts_buf="acts",
+        rews_buf="rews",
+        done_buf="done",
+        estimated_values_buf="estimated_values",
+    )
+
+    def __init__(self, obs_dim, act_dim, size, rwds_dim=1, storage_dir=None, codecs=None, info_keys=()):
+        self._open_storage(size, storage_dir, codecs, info_keys)
+        self.obs1_buf = self._allocate("obs1_buf", [size, obs_dim])
+        self.obs2_buf = self._allocate("obs2_buf", [size, obs_dim])
+        self.acts_buf = self._allocate("acts_buf", [size, act_dim])
+        self.rews_buf = self._allocate("rews_buf", [size, rwds_dim])
+        self.done_buf = self._allocate("done_buf", [size])
+        self.estimated_values_buf = self._allocate("estimated_values_buf", [size, rwds_dim])
+        self._restore_counters(size)
+
+    def _open_storage(self, size, storage_dir, codecs, info_keys):
+        self.max_size = size
+        self.codecs = codecs or {}
+        self.info_keys = tuple(info_keys)
+        # the info fields are added to the instance's copy
+        self.fields = dict(type(self).fields)
+        self.storage_dir = None if storage_dir is None else Path(storage_dir)
+        if self.storage_dir is not None:
+            os.makedirs(self.storage_dir, exist_ok=True)
+            for key in self.info_keys:
+                if (self.storage_dir / f"info_{key}.npy").exists():
+                    self._add_info_field(key, np.load(self.storage_dir / f"info_{key}.npy", mmap_mode="r+").shape[1:])
+
+    def _add_info_field(self, key, shape):
+        name = f"info_{key}"
+        self.fields[name] = None
+        setattr(self, name, self._allocate(name, [self.max_size, *shape]))
+
+    def _info_values(self, infos, n):
+        """The values of every info field for n steps, zeros for the keys infos lacks"""
+        infos = infos or {}
+        for key in self.info_keys:
+            if f"info_{key}" not in self.fields and key in infos:
+                self._add_info_field(key, np.shape(infos[key])[1:])
+        return {
+            f"info_{key}": infos[key] if key in infos else np.zeros((n, *getattr(self, f"info_{key}").shape[1:]))
+            for key in self.info_keys
+            if f"info_{key}" in self.fields
+        }
+
+    def _restore_counters(self, size):
+        self.ptr, self.size, self.max_size = 0, 0, size
+        header = self._read_header()
+        if header is not None and header["max_size"] == size:
+            self.ptr, self.size = header["ptr"], header["size"]
+
+    def codec(self, name):
+        return self.codecs.get(self.fields[name], FLOAT32)
+
+    def _write(self, name, where, values):
+        getattr(self, name)[where] = self.codec(name).encode(values)
+
+    def _read(self, name, idxs):
+        return self.codec(name).decode(getattr(self, name)[idxs])
+
+    def _allocate(self, name, shape, dtype=None):
+        dtype = self.codec(name).dtype if dtype is None else np.dtype(dtype)
+        if self.storage_dir is None:
+            return np.zeros(shape, dtype=dtype)
+        path = self.storage_dir / f"{name}.npy"
+        if path.exists():
+            existing = np.load(path, mmap_mode="r+")
+            if existing.shape == tuple(shape) and existing.dtype == dtype:
+                return existing
+            del existing
+        return np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=tuple(shape))
+
+    def _read_header(self):
+        if self.storage_dir is None or not (self.storage_dir / "header.json").exists():
+            return None
+        with open(self.storage_dir / "header.json") as f:
+            return json.load(f)
+
+    def flush(self):
+        """Writes the memory mapped fields and the header to disk, nothing to do in memory"""
+        if self.storage_dir is None:
+            return
+        for name in self.fields:
+            getattr(self, name).flush()
+        header_path = self.storage_dir / "header.json"
+        with open(header_path.with_suffix(".tmp"), "w") as f:
+            json.dump(dict(ptr=self.ptr, size=self.size, max_size=self.max_size), f)
+        os.replace(header_path.with_suffix(".tmp"), header_path)
+
+    def snapshot(self):
+        """Copies of every field and the header needed to restore them with load_snapshot"""
+        # the header first, rows a concurrent store writes meanwhile are past its ptr
+        header = dict(ptr=self.ptr, size=self.size, max_size=self.max_size)
+        return {name: np.array(getattr(self, name)) for name in self.fields}, header
+
+    def load_snapshot(self, arrays, header):
+        """
+        Restores a snapshot of a buffer with the same shapes and dtypes. An in-memory buffer
+        adopts the arrays as they are, so a copy-on-write memory map is only read as it's sampled.
+        """
+        for key in self.info_keys:
+            if f"info_{key}" in arrays and f"info_{key}" not in self.fields:
+                self._add_info_field(key, arrays[f"info_{key}"].shape[1:])
+        for name in self.fields:
+            buf, array = getattr(self, name), arrays[name]
+            if array.shape != buf.shape or array.dtype != buf.dtype:
+                raise ValueError(
+                    f"snapshot field {name} is {array.dtype}{list(array.shape)}, the buffer's is {buf.dtype}{list(buf.shape)}"
+                )
+            if self.storage_dir is None:
+                setattr(self, name, array)
+            else:
+                buf[:] = array
+        self.ptr, self.size = header["ptr"], header["size"]
+        self._reindex()
+
+    def _reindex(self):
+        """Rebuilds whatever a subclass keeps about the stored transitions, after they were replaced"""
+
+    def store(self, obs, act, rew, next_obs, done, estimated_values):
+        self._write("obs1_buf", self.ptr, obs)
+        self._write("obs2_buf", self.ptr, next_obs)
+        self._write("acts_buf", self.ptr, act)
+        self._write("rews_buf", self.ptr, rew)
+        self._write("done_buf", self.ptr, done)
+        self._write("estimated_values_buf", self.ptr, estimated_values)
+        self.ptr = (self.ptr + 1) % self.max_size
+        self.size = min(self.size + 1, self.max_size)
+
+    def store_episode(self, obs, acts, rews, dones, estimated_values, infos=None):
+        """
+        Stores the T transitions of an episode at once, ``obs`` holds its T+1 observations and
+        infos the stacked step infos. Every field is written with at most two slice copies,
+        before and after wrapping around.
+        """
+        n = len(acts)
+        fields = dict(
+            obs1_buf=obs[:-1],
+            obs2_buf=obs[1:],
+            acts_buf=acts,
+            rews_buf=rews,
+            done_buf=dones,
+            estimated_values_buf=estimated_values,
+            **self._info_values(infos, n),
+        )
+        ptr = self.ptr
+        if n > self.max_size:
+            # only the last max_size transitions would survive
+            ptr = (ptr + n - self.max_size) % self.max_size
+            fields = {name: values[-self.max_size :] for name, values in fields.items()}
+        stored = min(n, self.max_size)
+        first = min(stored, self.max_size - ptr)
+        for name, values in fields.items():
+            values = self.codec(name).encode(values)
+            buf = getattr(self, name)
+            buf[ptr : ptr + first] = values[:first]
+            buf[: stored - first] = values[first:]
+        self.ptr = (ptr + stored) % self.max_size
+        self.size = min(self.size + n, self.max_size)
+
+    def gather(self, idxs):
+        restore = None
+        if self.storage_dir is not None:
+            # reading the rows in file order touches every page once and sequentially
+            order = np.argsort(idxs)
+            idxs, restore = np.asarray(idxs)[order], np.argsort(order)
+        batch = dict(
+            obs1=self._read("obs1_buf", idxs),
+            obs2=self._read("obs2_buf", idxs),
+            acts=self._read("acts_buf", idxs),
+            rews=self._read("rews_buf", idxs),
+            done=self._read("done_buf", idxs),
+            estimated_values=self._read("estimated_values_buf", idxs),
+        )
+        if restore is not None:
+            batch = {key: values[restore] for key, values in batch.items()}
+        return batch
+
+    def sample_batch(self, batch_size=32, np_random=np.random):
+        idxs = np_random.integers(0, self.size, size=batch_size)
+        return self.gather(idxs)
+
+    def _stored_rows(self):
+        """The rows holding data, the oldest first"""
+        if self.size < self.max_size:
+            return np.arange(self.size)
+        return (self.ptr + np.arange(self.max_size)) % self.max_size
+
+    def _stored_infos(self, rows):
+        return {
+            key: self._read(f"info_{key}", rows)
+            for key in self.info_keys
+            if f"info_{key}" in self.fields
+        }
+
+    def relabel(self, cmorl, env, gamma, chunk_size=65536):
+        """
+        Recomputes the rewards of every stored transition with cmorl.relabel, chunk_size
+        transitions at a time, then the estimated values of every episode for gamma.
+        Episodes end at a done flag or where obs2 isn't the next row's obs1.
+        """
+        rows = self._stored_rows()
+        ends = np.zeros(len(rows), dtype=bool)
+        for start in range(0, len(rows), chunk_size):
+            chunk = rows[start : start + chunk_size]
+            transitions = reward_utils.Transition(
+                self._read("obs1_buf", chunk),
+                self._read("acts_buf", chunk),
+                self._read("obs2_buf", chunk),
+                self._read("done_buf", chunk),
+                self._stored_infos(chunk),
+            )
+            self._write("rews_buf", chunk, cmorl.relabel(transitions, env))
+            next_obs1 = self._read("obs1_buf", rows[start + 1 : start + chunk_size + 1])
+            ends[start : start + len(next_obs1)] = np.any(
+                transitions.next_state[: len(next_obs1)] != next_obs1, axis=-1
+            )
+        ends |= self._read("done_buf", rows) > 0.0
+        ends[-1:] = True
+        start = 0
+        for end in np.flatnonzero(ends):
+            episode = rows[start : end + 1]
+            self._write(
+                "estimated_values_buf",
+                episode,
+                reward_utils.values(
+                    self._read("rews_buf", episode), gamma, done=bool(self._read("done_buf", rows[end]))
+                ),
+            )
+            start = end + 1
+        self._reindex()
+
+
+class EpisodeReplayBuffer(ReplayBuffer):
+    """
+    A replay buffer that keeps the steps of every episode in consecutive rows, so each
+    observation is stored once: the next observation of row i is in row i + 1 (mod max_size)
+    and the last observation of an episode gets a row of its own that is never sampled.
+    steps_left_buf counts the transitions from a row to the end of its episode.
+
+    Estimated values aren't frozen at insertion, they are computed from the stored rewards for
+    any gamma when first asked for (and kept up to date from then on). ``n_step`` builds
+    multi-step targets from the episode structure at sample time.
+    """
+
+    fields = dict(
+        obs_buf="obs",
+        acts_buf="acts",
+        rews_buf="rews",
+        done_buf="done",
+        valid_buf=None,
+        steps_left_buf=None,
+    )
+
+    def __init__(self, obs_dim, act_dim, size, rwds_dim=1, gamma=0.99, storage_dir=None, codecs=None, info_keys=()):
+        self._open_storage(size, storage_dir, codecs, info_keys)
+        self.obs_buf = self._allocate("obs_buf", [size, obs_dim])
+        self.acts_buf = self._allocate("acts_buf", [size, act_dim])
+        self.rews_buf = self._allocate("rews_buf", [size, rwds_dim])
+        self.done_buf = self._allocate("done_buf", [size])
+        self.valid_buf = self._allocate("valid_buf", [size], dtype=np.bool_)
+        self.steps_left_buf = self._allocate("steps_left_buf", [size], dtype=np.int32)
+        self.gamma = gamma
+        # gamma -> the estimated values of every row for that gamma
+        self.returns = {}
+        # (gamma, n) -> the normalized discounted sums of the next n rewards of every row
+        self.windows = {}
+        # the transitions of the current episode handed to store one at a time
+        self.pending = []
+        self._restore_counters(size)
+
+    def _reindex(self):
+        self.returns = {}
+        self.windows = {}
+
+    def store(self, obs, act, rew, next_obs, done, estimated_values=None):
+        """
+        Buffers a single transition into the current episode, which is stored once it ends: at a
+        done transition, when ``obs`` doesn't continue from the previous next_obs (the env was
+        reset after a truncation) or with ``end_episode``. Buffered transitions aren't sampled yet.
+        """
+        if self.pending and not np.array_equal(obs, self.pending[-1][3]):
+            self.end_episode()
+        self.pending.append((obs, act, rew, next_obs, done))
+        if done or len(self.pending) == self.max_size - 1:
+            self.end_episode()
+
+    def end_episode(self):
+        """Stores the transitions buffered by ``store`` as an episode"""
+        if not self.pending:
+            return
+        obs, acts, rews, next_obs, dones = zip(*self.pending)
+        self.pending = []
+        self.store_episode(
+            np.stack([*obs, next_obs[-1]]),
+            np.stack(acts),
+            np.stack(rews),
+            np.asarray(dones, dtype=np.float32),
+        )
+
+    def store_episode(self, obs, acts, rews, dones, estimated_values=None, infos=None):
+        """
+        Stores the T transitions of an episode in T+1 rows, ``obs`` holds its T+1 observations.
+        estimated_values are accepted for compatibility and recomputed from the rewards.
+        """
+        n = min(len(acts), self.max_size - 1)  # longer episodes only keep their last steps
+        obs, acts, rews, dones = obs[-n - 1 :], acts[-n:], rews[-n:], dones[-n:]
+        rows = (self.ptr + np.arange(n + 1)) % self.max_size
+        steps, last = rows[:-1], rows[-1]
+        for name, values in self._info_values(infos, len(acts)).items():
+            self._write(name, steps, values[-n:])
+        self._write("obs_buf", rows, obs)
+        self._write("acts_buf", steps, acts)
+        self._write("rews_buf", steps, rews)
+        self._write("done_buf", steps, dones)
+        self._write("done_buf", last, 0.0)
+        self.valid_buf[steps] = True
+        self.valid_buf[last] = False
+        self.steps_left_buf[steps] = np.arange(n, 0, -1)
+        self.steps_left_buf[last] = 0
+        for gamma, returns in self.returns.items():
+            returns[steps] = reward_utils.values(np.asarray(rews), gamma, done=bool(dones[-1]))
+        for (gamma, window), windows in self.windows.items():
+            windows[steps] = (1.0 - gamma) * return_utils.truncated_returns(rews, gamma, window)
+        self.ptr = (self.ptr + n + 1) % self.max_size
+        self.size = min(self.size + n + 1, self.max_size)
+
+    def estimated_values(self, gamma=None):
+        """The (1 - gamma) normalized values of every row, as reward_utils.values computes them"""
+        gamma = self.gamma if gamma is None else gamma
+        if gamma not in self.returns:
+            returns = np.zeros(self.rews_buf.shape, dtype=np.float32)
+            for rows, done in self._episodes():
+                returns[rows] = reward_utils.values(self._read("rews_buf", rows), gamma, done=done)
+            self.returns[gamma] = returns
+        return self.returns[gamma]
+
+    def truncated_returns(self, n, gamma=None):
+        """
+        The (1 - gamma) normalized discounted sums of the next n rewards of every row, stopping
+        at the end of the episode, computed when first asked for like the estimated values
+        """
+        gamma = self.gamma if gamma is None else gamma
+        if (gamma, n) not in self.windows:
+            windows = np.zeros(self.rews_buf.shape, dtype=np.float32)
+            for rows, _ in self._episodes():
+                windows[rows] = (1.0 - gamma) * return_utils.truncated_returns(
+                    self._read("rews_buf", rows), gamma, n
+                )
+            self.windows[gamma, n] = windows
+        return self.windows[gamma, n]
+
+    def _episodes(self):
+        """The stored rows of every episode and whether it terminated, the oldest first"""
+        # every episode ends with a row that has 1 step left
+        order = self._stored_rows()
+        valid = self.valid_buf[order]
+        ends = np.flatnonzero(valid & (self.steps_left_buf[order] == 1))
+        start = 0
+        for end in ends:
+            yield order[start : end + 1][valid[start : end + 1]], bool(self.done_buf[order[end]])
+            start = end + 1
+
+    def relabel(self, cmorl, env, gamma=None, chunk_size=65536):
+        """Recomputes the rewards of every stored transition, the estimated values follow lazily"""
+        rows = self._stored_rows()
+        rows = rows[self.valid_buf[rows]]
+        for start in range(0, len(rows), chunk_size):
+            chunk = rows[start : start + chunk_size]
+            transitions = reward_utils.Transition(
+                self._read("obs_buf", chunk),
+                self._read("acts_buf", chunk),
+                self._read("obs_buf", (chunk + 1) % self.max_size),
+                self._read("done_buf", chunk),
+                self._stored_infos(chunk),
+            )
+            self._write("rews_buf", chunk, cmorl.relabel(transitions, env))
+        self._reindex()
+
+    def sample_indices(self, batch_size, np_random=np.random):
+        idxs = np_random.integers(0, self.size, size=batch_size)
+        invalid = ~self.valid_buf[idxs]
+        while np.any(invalid):
+            # the rows holding the last observation of an episode aren't transitions
+            idxs[invalid] = np_random.integers(0, self.size, size=np.count_nonzero(invalid))
+            invalid = ~self.valid_buf[idxs]
+        return idxs
+
+    def gather(self, idxs):
+        next_idxs = (idxs + 1) % self.max_size
+        return dict(
+            obs1=self._read("obs_buf", idxs),
+            obs2=self._read("obs_buf", next_idxs),
+            acts=self._read("acts_buf", idxs),
+            rews=self._read("rews_buf", idxs),
+            done=self._read("done_buf", idxs),
+            estimated_values=self.estimated_values()[idxs],
+        )
+
+    def sample_batch(self, batch_size=32, np_random=np.random):
+        return self.gather(self.sample_indices(batch_size, np_random))
+
+    def n_step(self, idxs, n, gamma=None):
+        """
+        Returns (rews_n, obs_n, discounts) for the targets rews_n + discounts * Q(obs_n, pi(obs_n))
+        of the sampled rows: rews_n is the (1 - gamma) normalized discounted sum of the next n
+        rewards, stopping at the end of the episode, obs_n the observation after them and
+        discounts gamma**steps, or 0 when the episode terminated within the n steps.
+        """
+        gamma = self.gamma if gamma is None else gamma
+        steps = np.minimum(n, self.steps_left_buf[idxs])
+        rews_n = self.truncated_returns(n, gamma)[idxs]
+        obs_n = self._read("obs_buf", (idxs + steps) % self.max_size)
+        terminated = (steps == self.steps_left_buf[idxs]) & (
+            self.done_buf[(idxs + steps - 1) % self.max_size] > 0.0
+        )
+        discounts = np.where(terminated, 0.0, gamma**steps)
+        return rews_n, obs_n, discounts.astype(np.float32)
+
+
+class PrioritizedReplayBuffer(ReplayBuffer):
+    """
+    A ReplayBuffer that samples transitions proportionally to priority**alpha through a SumTree.
+    New transitions get the highest priority seen so far. The batches also hold the sampled
+    ``idxs``, to refresh their priorities with ``update_priorities``, and the importance
+    ``weights`` (size * P(i))**-beta normalized by their max, which undo the sampling bias.
+    """
+
+    def __init__(self, obs_dim, act_dim, size, rwds_dim=1, alpha=0.6, beta=0.4, eps=1e-6, storage_dir=None, codecs=None, info_keys=()):
+        super().__init__(obs_dim, act_dim, size, rwds_dim, storage_dir, codecs, info_keys)
+        self.alpha, self.beta, self.eps = alpha, beta, eps
+        self.max_priority = 1.0
+        self._reindex()
+
+    def _reindex(self):
+        # transitions picked up from storage_dir or a snapshot start out with the same priority
+        self.tree = SumTree(self.max_size)
+        self.tree.update(np.arange(self.size), self.max_priority**self.alpha)
+
+    def store(self, *args, **kwargs):
+        idx = self.ptr
+        super().store(*args, **kwargs)
+        self.tree.update([idx], self.max_priority**self.alpha)
+
+    def store_episode(self, obs, acts, rews, dones, estimated_values, infos=None):
+        super().store_episode(obs, acts, rews, dones, estimated_values, infos)
+        stored = min(len(acts), self.max_size)
+        idxs = (self.ptr - stored + np.arange(stored)) % self.max_size
+        self.tree.update(idxs, self.max_priority**self.alpha)
+
+    def sample_batch(self, batch_size=32, np_random=np.random):
+        idxs = np.minimum(self.tree.sample(batch_size, np_random), self.size - 1)
+        probabilities = self.tree[idxs] / self.tree.total()
+        weights = (self.size * probabilities) ** -self.beta
+        return dict(
+            **self.gather(idxs),
+            idxs=idxs,
+            weights=(weights / np.max(weights)).astype(np.float32),
+        )
+
+    def update_priorities(self, idxs, errors):
+        priorities = np.abs(errors) + self.eps
+        self.max_priority = max(self.max_priority, float(np.max(priorities)))
+        self.tree.update(idxs, priorities**self.alpha)
+
+
+class TensorflowReplayBuffer:
+    """
+    A FIFO experience replay buffer whose storage lives in tf.Variables, so minibatches
+    can be sampled inside a compiled graph. ``store`` and ``store_episode`` only stage
+    transitions on the host, ``flush`` writes everything staged with a single scatter per field.
+    """
+
+    def __init__(self, obs_dim, act_dim, size, rwds_dim=1, seed=0):
+        def variable(shape):
+            return tf.Variable(tf.zeros(shape, dtype=tf.float32), trainable=False)
+
+        self.obs1_buf = variable([size, obs_dim])
+        self.obs2_buf = variable([size, obs_dim])
+        self.acts_buf = variable([size, act_dim])
+        self.rews_buf = variable([size, rwds_dim])
+        self.done_buf = variable([size])
+        self.estimated_values_buf = variable([size, rwds_dim])
+        self.size_var = tf.Variable(0, dtype=tf.int32, trainable=False)
+        self.generator = tf.random.Generator.from_seed(seed)
+        self.ptr, self.size, self.max_size = 0, 0, size
+        self.staged = []
+
+    def bufs(self):
+        return (
+            self.obs1_buf,
+            self.acts_buf,
+            self.rews_buf,
+            self.obs2_buf,
+            self.done_buf,
+            self.estimated_values_buf,
+        )
+
+    def _stage(self, n, fields):
+        # fields in the order of bufs(), each with n rows
+        self.staged.append(fields)
+        self.ptr = (self.ptr + n) % self.max_size
+        self.size = min(self.size + n, self.max_size)
+
+    def store(self, obs, act, rew, next_obs, done, estimated_values):
+        self._stage(
+            1,
+            [
+                np.expand_dims(np.asarray(value, dtype=np.float32), 0)
+                for value in (obs, act, rew, next_obs, done, estimated_values)
+            ],
+        )
+
+    def store_episode(self, obs, acts, rews, dones, estimated_values, infos=None):
+        """Stages the T transitions of an episode, ``obs`` holds its T+1 observations. Infos aren't kept"""
+        self._stage(len(acts), [obs[:-1], acts, rews, obs[1:], dones, estimated_values])
+
+    def flush(self):
+        if not self.staged:
+            return
+        # older transitions would be overwritten anyway
+        fields = [
+            np.concatenate(values)[-self.max_size :].astype(np.float32, copy=False)
+            for values in zip(*self.staged)
+        ]
+        n = len(fields[0])
+        indices = (self.ptr - n + np.arange(n)) % self.max_size
+        for buf, values in zip(self.bufs(), fields):
+            buf.scatter_nd_update(indices[:, None], values)
+        self.size_var.assign(self.size)
+        self.staged = []
+
+    def snapshot(self):
+        self.flush()
+        arrays = dict(
+            zip(
+                ("obs1_buf", "acts_buf", "rews_buf", "obs2_buf", "done_buf", "estimated_values_buf"),
+                (buf.numpy() for buf in self.bufs()),
+            )
+        )
+        return arrays, dict(ptr=self.ptr, size=self.size, max_size=self.max_size)
+
+    def load_snapshot(self, arrays, header):
+        self.staged = []
+        self.obs1_buf.assign(arrays["obs1_buf"])
+        self.obs2_buf.assign(arrays["obs2_buf"])
+        self.acts_buf.assign(arrays["acts_buf"])
+        self.rews_buf.assign(arrays["rews_buf"])
+        self.done_buf.assign(arrays["done_buf"])
+        self.estimated_values_buf.assign(arrays["estimated_values_buf"])
+        self.ptr, self.size = header["ptr"], header["size"]
+        self.size_var.assign(self.size)
+
+    def sample_indices(self, batch_size):
+        return self.generator.uniform(
+            [batch_size], 0, self.size_var, dtype=tf.int32
+        )
+
+    def gather(self, idxs):
+        return dict(
+            obs1=tf.gather(self.obs1_buf, idxs),
+            obs2=tf.gather(self.obs2_buf, idxs),
+            acts=tf.gather(self.acts_buf, idxs),
+            rews=tf.gather(self.rews_buf, idxs),
+            done=tf.gather(self.done_buf, idxs),
+            estimated_values=tf.gather(self.estimated_values_buf, idxs),
+        )
+
+    def sample_batch(self, batch_size=32, np_random=np.random):
+        self.flush()
+        idxs = np_random.integers(0, self.size, size=batch_size)
+        return {k: v.numpy() for k, v in self.gather(idxs).items()}
+
+
+class DeficitReplayBuffer(ReplayBuffer):
+    """
+    A ReplayBuffer that indexes the stored estimated values with one SumTree per objective.
+    A uniform_fraction of every batch is sampled uniformly, the rest is split between the
+    objectives according to ``objective_weights`` and drawn proportionally to the estimated
+    value of that objective, so the transitions that achieve the objectives the composer is
+    bottlenecked by show up more often. The trees are updated on insert, nothing else is tracked.
+
+    Transition i is drawn with probability
+    uniform_fraction / size + (1 - uniform_fraction) * sum_k w_k * v_k(i) / sum_j v_k(j),
+    w being the normalized objective_weights and v_k the estimated values of objective k clipped
+    at 0 plus eps. Unlike PrioritizedReplayBuffer the batches come without importance weights:
+    the critic is meant to be fit more closely where the composer is bottlenecked, and the
+    uniform fraction keeps every transition in the critic's loss.
+    """
+
+    def __init__(self, obs_dim, act_dim, size, rwds_dim=1, uniform_fraction=0.5, eps=1e-3, storage_dir=None, codecs=None, info_keys=()):
+        super().__init__(obs_dim, act_dim, size, rwds_dim, storage_dir, codecs, info_keys)
+        self.objective_weights = np.full(rwds_dim, 1.0 / rwds_dim)
+        self.uniform_fraction, self.eps = uniform_fraction, eps
+        self._reindex()
+
+    def _reindex(self):
+        self.trees = [SumTree(self.max_size) for _ in range(self.rews_buf.shape[1])]
+        self._index(np.arange(self.size))
+
+    def _index(self, idxs):
+        values = np.clip(self._read("estimated_values_buf", idxs), 0.0, None) + self.eps
+        for objective, tree in enumerate(self.trees):
+            tree.update(idxs, values[:, objective])
+
+    def store(self, *args, **kwargs):
+        idx = self.ptr
+        super().store(*args, **kwargs)
+        self._index(np.array([idx]))
+
+    def store_episode(self, obs, acts, rews, dones, estimated_values, infos=None):
+        super().store_episode(obs, acts, rews, dones, estimated_values, infos)
+        stored = min(len(acts), self.max_size)
+        self._index((self.ptr - stored + np.arange(stored)) % self.max_size)
+
+    def sample_batch(self, batch_size=32, np_random=np.random):
+        n_uniform = np_random.binomial(batch_size, self.uniform_fraction)
+        weights = np.clip(self.objective_weights, 0.0, None) + 1e-12
+        counts = np_random.multinomial(batch_size - n_uniform, weights / np.sum(weights))
+        idxs = [np_random.integers(0, self.size, size=n_uniform)] + [
+            np.minimum(tree.sample(count, np_random), self.size - 1)
+            for tree, count in zip(self.trees, counts)
+            if count > 0
+        ]
+        return self.gather(np.concatenate(idxs))
+
+
+def attach_shared_memory(name):
+    """
+    Attaches to an existing shared memory block. The attaching processes are children of the
+    creator and share its resource tracker, where attaching registers the block a second time
+    (a no-op), so the block stays registered exactly once: by the creator, whose unlink
+    unregisters it. Unregistering here as well would make that unlink fail in the tracker.
+    """
+    return shared_memory.SharedMemory(name=name)
+
+
+class SharedReplayBuffer(ReplayBuffer):
+    """
+    A ReplayBuffer whose storage, ptr and size live in shared memory, so actor processes
+    can write transitions straight into it. Pickling it (e.g. as a Process argument)
+    attaches the other process to the same memory. Writes are serialized by a lock.
+    """
+
+    def __init__(self, obs_dim, act_dim, size, rwds_dim=1, lock=None):
+        self.shapes = dict(
+            obs1_buf=(size, obs_dim),
+            obs2_buf=(size, obs_dim),
+            acts_buf=(size, act_dim),
+            rews_buf=(size, rwds_dim),
+            done_buf=(size,),
+            estimated_values_buf=(size, rwds_dim),
+        )
+        self.memories = {
+            name: shared_memory.SharedMemory(
+                create=True, size=max(int(np.prod(shape)) * 4, 1)
+            )
+            for name, shape in self.shapes.items()
+        }
+        self.counters_memory = shared_memory.SharedMemory(create=True, size=16)
+        self.lock = lock if lock is not None else mp.get_context("spawn").Lock()
+        self.storage_dir = None
+        self.codecs = {}
+        self.info_keys = ()
+        self.max_size = size
+        self.owner = True
+        self._attach_arrays()
+        self.ptr, self.size = 0, 0
+
+    def _attach_arrays(self):
+        for name, shape in self.shapes.items():
+            setattr(
+                self,
+                name,
+                np.ndarray(shape, dtype=np.float32, buffer=self.memories[name].buf),
+            )
+        self.counters = np.ndarray((2,), dtype=np.int64, buffer=self.counters_memory.buf)
+
+    @property
+    def ptr(self):
+        return int(self.counters[0])
+
+    @ptr.setter
+    def ptr(self, value):
+        self.counters[0] = value
+
+    @property
+    def size(self):
+        return int(self.counters[1])
+
+    @size.setter
+    def size(self, value):
+        self.counters[1] = value
+
+    def store(self, *args, **kwargs):
+        with self.lock:
+            super().store(*args, **kwargs)
+
+    def store_episode(self, *args, **kwargs):
+        with self.lock:
+            super().store_episode(*args, **kwargs)
+
+    def snapshot(self):
+        with self.lock:
+            return super().snapshot()
+
+    def relabel(self, *args, **kwargs):
+        with self.lock:
+            super().relabel(*args, **kwargs)
+
+    def load_snapshot(self, arrays, header):
+        with self.lock:
+            for name in self.shapes:
+                getattr(self, name)[:] = arrays[name]
+            self.ptr, self.size = header["ptr"], header["size"]
+
+    def __getstate__(self):
+        return dict(
+            shapes=self.shapes,
+            memory_names={name: memory.name for name, memory in self.memories.items()},
+            counters_name=self.counters_memory.name,
+            lock=self.lock,
+            max_size=self.max_size,
+        )
+
+    def __setstate__(self, state):
+        self.shapes = state["shapes"]
+        self.memories = {
+            name: attach_shared_memory(memory_name)
+            for name, memory_name in state["memory_names"].items()
+        }
+        self.counters_memory = attach_shared_memory(state["counters_name"])
+        self.lock = state["lock"]
+        self.storage_dir = None
+        self.codecs = {}
+        self.info_keys = ()
+        self.max_size = state["max_size"]
+        self.owner = False
+        self._attach_arrays()
+
+    def close(self):
+        """Detaches from the shared memory, the creating process also frees it"""
+        for name in self.shapes:
+            delattr(self, name)
+        del self.counters
+        for memory in [*self.memories.values(), self.counters_memory]:
+            memory.close()
+            if self.owner:
+                memory.unlink()
@@ -0,0 +1,53 @@
+import numpy as np
+
+
+class SumTree:
+    """
+    A binary tree over ``capacity`` non-negative leaf values where every node holds the sum of
+    its children, stored as a flat array: node 1 is the root, the children of node i are 2i and
+    2i + 1 and the leaves start at ``self.leaves``. Updates and lookups of a whole batch of
+    leaves walk the tree one level at a time, so both take O(log capacity) vectorized steps.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.leaves = 1 << max(int(np.ceil(np.log2(max(capacity, 1)))), 0)
+        self.tree = np.zeros(2 * self.leaves, dtype=np.float64)
+
+    def total(self):
+        return self.tree[1]
+
+    def __getitem__(self, idxs):
+        return self.tree[np.asarray(idxs) + self.leaves]
+
+    def update(self, idxs, values):
+        """Sets the leaves at idxs to values and recomputes the sums above them"""
+        nodes = np.asarray(idxs, dtype=np.int64) + self.leaves
+        if nodes.size == 0:
+            return
+        self.tree[nodes] = values
+        nodes = np.unique(nodes // 2)
+        while nodes[-1] >= 1:
+            self.tree[nodes] = self.tree[2 * nodes] + self.tree[2 * nodes + 1]
+            if nodes[-1] == 1:
+                return
+            nodes = np.unique(nodes // 2)
+
+    def find(self, values):
+        """The index of the leaf each value in [0, total) falls into, descending for all values at once"""
+        values = np.array(values, dtype=np.float64)
+        nodes = np.ones(values.shape, dtype=np.int64)
+        while self.leaves > 1 and nodes.size and nodes[0] < self.leaves:
+            left = 2 * nodes
+            left_sums = self.tree[left]
+            go_right = values >= left_sums
+            values -= np.where(go_right, left_sums, 0.0)
+            nodes = left + go_right
+        # rounding can push a value past the last leaf with a non-zero value
+        return np.minimum(nodes - self.leaves, self.capacity - 1)
+
+    def sample(self, batch_size, np_random=np.random):
+        """Stratified sampling of batch_size leaf indices, proportional to the leaf values"""
+        segment = self.total() / batch_size
+        values = (np.arange(batch_size) + np_random.random(batch_size)) * segment
+        return self.find(np.minimum(values, np.nextafter(self.total(), 0.0)))
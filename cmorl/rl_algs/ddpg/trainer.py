@@ -0,0 +1,562 @@
+import os
+import queue
+import threading
+import time
+import numpy as np
+import gymnasium as gym
+from cmorl.rl_algs.ddpg import core, distributed
+from cmorl.rl_algs.ddpg.hyperparams import HyperParams
+from cmorl.rl_algs.ddpg.learner import Learner
+from cmorl.rl_algs.ddpg.replay_buffer import Episode
+from cmorl.utils import dataset_utils, reward_utils, save_utils, test_utils
+from cmorl.utils.logx import EpochLogger
+
+
+# how much of the previous estimate the running Q-composed keeps on every update block
+Q_COMPOSED_EMA_DECAY = 0.9
+
+
+def sub_env_info(infos, i):
+    """The info dict sub env i returned, out of the merged infos of a vector env step"""
+    return {
+        key: value[i]
+        for key, value in infos.items()
+        if not key.startswith("_")
+        and key not in ("final_observation", "final_info")
+        and infos["_" + key][i]
+    }
+
+
+def multiples_in_range(start, stop, every, after=-1):
+    """Counts the multiples of ``every`` in [start, stop) that are greater than ``after``"""
+    start = max(start, after + 1)
+    if stop <= start:
+        return 0
+    return (stop - 1) // every - (start - 1) // every
+
+
+def make_vector_env(env_fn, num_envs, cmorl=None, max_ep_len=None):
+    """
+    Creates ``num_envs`` envs and steps them through a SyncVectorEnv, returns both.
+    The CMORL reward and the max_ep_len truncation are applied per sub env so they
+    happen before the vector env autoresets a finished episode. Batched CMORL rewards
+    are computed once the episode is over instead.
+    """
+    envs = [env_fn() for _ in range(num_envs)]
+
+    def wrap(env):
+        if cmorl is not None and not cmorl.batched:
+            env = reward_utils.CMORLRewardWrapper(env, cmorl)
+        if max_ep_len is not None:
+            env = gym.wrappers.TimeLimit(env, max_episode_steps=max_ep_len)
+        return env
+
+    return envs, gym.vector.SyncVectorEnv([lambda env=env: wrap(env) for env in envs])
+
+
+def preload(replay_buffer, folder, hp: HyperParams):
+    """Fills the replay buffer with the newest episodes stored in folder, returns their steps"""
+    preloaded = 0
+    # the newest episodes go in last, so they are the last to be overwritten
+    for observations, actions, _, cmorl_rewards, done, infos in reversed(
+        list(dataset_utils.read_episodes(folder, max_steps=hp.replay_size))
+    ):
+        replay_buffer.store_episode(
+            observations,
+            actions,
+            cmorl_rewards,
+            dataset_utils.episode_dones(len(actions), done),
+            reward_utils.values(cmorl_rewards, hp.gamma, done=done),
+            infos=infos,
+        )
+        preloaded += len(actions)
+    print(f"Preloaded {preloaded} steps from {folder}")
+    return preloaded
+
+
+class Trainer:
+    """
+    Collects experience into the learner's replay buffer and trains on it, in one of four loops:
+    ``learn`` steps the envs and trains in turns, ``learn_async`` trains while a thread steps
+    them, ``learn_distributed`` while actor processes do, and ``learn_offline`` trains on the
+    replay buffer alone. ``train`` picks the one hp asks for.
+
+    Holds the counters of the run (the env step ``t``, the running Q-composed estimate), the ones
+    a checkpoint needs go into the header of its replay snapshot. ``weights_and_biases`` is the
+    run everything is logged to, anything with wandb's ``log`` and ``id`` does.
+    """
+
+    def __init__(
+        self,
+        hp: HyperParams,
+        env_fn,
+        envs: list[gym.Env],
+        vector_env: gym.vector.VectorEnv,
+        learner: Learner,
+        perturbed_actor: core.PerturbedActor,
+        np_random: np.random.Generator,
+        logger: EpochLogger,
+        weights_and_biases,
+        cmorl: None | reward_utils.CMORL = None,
+        save_freq=1,
+        on_save=lambda *_, **__: (),
+        checkpoint_manager=None,
+        checkpoint_dir=None,
+        episode_outputs=(),
+        episode_spec=None,
+        resume_state=None,
+    ):
+        self.hp = hp
+        self.env_fn = env_fn
+        self.env = envs[0]
+        self.vector_env = vector_env
+        self.learner = learner
+        self.replay_buffer = learner.replay_buffer
+        self.perturbed_actor = perturbed_actor
+        self.np_random = np_random
+        self.logger = logger
+        self.weights_and_biases = weights_and_biases
+        self.cmorl = cmorl
+        self.save_freq = save_freq
+        self.on_save = on_save
+        self.checkpoint_manager = checkpoint_manager
+        self.checkpoint_dir = checkpoint_dir
+        # (folder, shard_steps) of the shard sets every finished episode is written into
+        self.episode_outputs = list(episode_outputs)
+        self.episode_spec = episode_spec
+        self.episode_writers = [
+            dataset_utils.ShardWriter(folder, episode_spec, shard_steps)
+            for folder, shard_steps in self.episode_outputs
+        ]
+        # the step infos the reward fns read, kept with the transitions for relabeling
+        self.info_keys = cmorl.info_keys if cmorl is not None else ()
+        self.rew_dims = learner.rew_dims
+        self.act_dim = self.env.action_space.shape[0]
+
+        self.start_t = resume_state["t"] if resume_state else 0
+        self.start_time = time.time() - (resume_state["elapsed"] if resume_state else 0.0)
+        self.total_steps = hp.steps_per_epoch * hp.epochs
+        self.t = self.start_t
+        # running estimate of Q-composed, kept here so the env loop never has to query wandb
+        self.q_composed_ema = resume_state["q_composed_ema"] if resume_state else None
+        self.needs_resample = True
+        self.o = None
+        self.episodes = []
+
+    @property
+    def checkpointing(self):
+        return self.checkpoint_manager is not None
+
+    def replay_snapshot(self):
+        arrays, header = self.replay_buffer.snapshot()
+        return arrays, dict(**header, rng_state=self.np_random.bit_generator.state)
+
+    def save_checkpoint(self, epoch, steps):
+        """
+        Writes the tf state synchronously, then the replay snapshot together with the counters
+        in the background. The snapshot's pointer file is swapped last and the previous tf checkpoint
+        is kept, so a run preempted at any point resumes from a consistent checkpoint.
+        The previous snapshot has to be in place before saving, the manager deletes the checkpoint
+        the snapshot before it refers to.
+        """
+        save_utils.replay_writer.wait()
+        path = self.checkpoint_manager.save(checkpoint_number=epoch)
+        arrays, header = self.replay_snapshot()
+        header["training"] = dict(
+            t=steps,
+            epoch=epoch,
+            checkpoint=os.path.relpath(path, self.checkpoint_dir),
+            q_composed_ema=self.q_composed_ema,
+            wandb_id=self.weights_and_biases.id,
+            elapsed=time.time() - self.start_time,
+        )
+        save_utils.replay_writer.save(self.checkpoint_dir, arrays, header)
+
+    def get_actions(self, o):
+        hp = self.hp
+        if self.t > hp.start_steps:
+            actions = self.perturbed_actor.act_batch(o).numpy()
+        else:
+            self.env.action_space._np_random = self.np_random
+            actions = np.stack([self.env.action_space.sample() for _ in range(hp.num_envs)])
+        if np.isnan(actions).any():
+            print(f"nan detected in action {actions}")
+            # Log the occurrence in Weights and Biases
+            self.weights_and_biases.log({"message": "NaN detected in action"}, step=self.t)
+            self.weights_and_biases.finish()
+            raise ValueError("NaN detected in action")
+        return actions
+
+    def update(self):
+        qs_c, q_c = self.learner.update(self.np_random, self.t / self.total_steps)
+        self.flush_update_metrics()
+        return qs_c, q_c
+
+    def flush_update_metrics(self):
+        """
+        Logs the mean, min and max of the metrics accumulated since the last flush in a single
+        wandb call and moves the running Q-composed estimate used by the randomization schedule.
+        """
+        update_metrics = self.learner.update_metrics
+        row = {}
+        for key, stats in update_metrics.read().items():
+            for stat, suffix in (("mean", ""), ("min", "_min"), ("max", "_max")):
+                if np.ndim(stats[stat]) == 0:
+                    row[key + suffix] = float(stats[stat])
+                else:
+                    row.update(
+                        {f"{key}{i}{suffix}": float(v) for i, v in enumerate(stats[stat])}
+                    )
+        update_metrics.reset()
+        self.weights_and_biases.log(row, step=self.t)
+        q_composed = row["Q-composed"]
+        self.q_composed_ema = (
+            q_composed
+            if self.q_composed_ema is None
+            else Q_COMPOSED_EMA_DECAY * self.q_composed_ema
+            + (1.0 - Q_COMPOSED_EMA_DECAY) * q_composed
+        )
+
+    def log_episode(self, ep_ret, ep_len, cmorl_ret):
+        ret_dict_ = {f"EpRet_{i}": cmorl_ret[i] for i in range(self.rew_dims)}
+        self.logger.store(**ret_dict_)
+        self.logger.store(OrigEpRet=ep_ret)
+        self.logger.store(EpLen=ep_len)
+        self.weights_and_biases.log(
+            {**ret_dict_, "OrigEpRet": ep_ret, "EpLen": ep_len}, step=self.t
+        )
+
+    def new_episode(self, first_obs):
+        return Episode(first_obs, self.act_dim, self.rew_dims, capacity=self.hp.max_ep_len or 1000)
+
+    def store_episode(self, episode: Episode, done):
+        cmorl = self.cmorl
+        ep_len = episode.length
+        if cmorl is not None and cmorl.batched:
+            episode.compute_cmorl_rewards(cmorl, done, self.env)
+        cmorl_rewards = episode.cmorl_rewards[:ep_len]
+        estimated_values = reward_utils.values(cmorl_rewards, self.hp.gamma, done=done)
+        infos = reward_utils.stack_infos(
+            [{key: info[key] for key in self.info_keys if key in info} for info in episode.infos]
+        )
+        self.replay_buffer.store_episode(
+            episode.observations[: ep_len + 1],
+            episode.actions[:ep_len],
+            cmorl_rewards,
+            episode.dones(done),
+            estimated_values,
+            infos=infos,
+        )
+        for writer in self.episode_writers:
+            writer.add_episode(
+                episode.observations[: ep_len + 1],
+                episode.actions[:ep_len],
+                episode.rewards[:ep_len],
+                cmorl_rewards,
+                done,
+                infos,
+            )
+        self.log_episode(
+            np.sum(episode.rewards[:ep_len]), ep_len, np.sum(cmorl_rewards, axis=0)
+        )
+
+    def collect_step(self):
+        """
+        Steps all the sub envs once, returns the (episode, done) pairs that finished.
+        Until start_steps have elapsed, randomly sample actions
+        from a uniform distribution for better exploration. Afterwards,
+        use the learned policy (with some noise, via act_noise).
+        """
+        hp, cmorl, t = self.hp, self.cmorl, self.t
+        if hp.noise_resample_every > 0 and multiples_in_range(
+            t, t + hp.num_envs, hp.noise_resample_every
+        ):
+            self.needs_resample = True
+        if t > hp.start_steps and self.needs_resample:
+            randomization_amount = (
+                cmorl.randomization_schedule(t, self.total_steps, self.q_composed_ema or 0.0)
+                if cmorl
+                else 1.0
+            )
+            self.perturbed_actor.resample(hp.act_noise * randomization_amount)
+            self.needs_resample = False
+        actions = self.get_actions(self.o)
+
+        # Step the envs, finished sub envs are reset automatically and their
+        # last observation and info are moved to "final_observation" and "final_info"
+        self.o, rewards, dones, truncateds, infos = self.vector_env.step(actions)
+
+        finished_episodes = []
+        for i, episode in enumerate(self.episodes):
+            # Ignore the "done" signal if it comes from hitting the time
+            # horizon (that is, when it's an artificial terminal signal
+            # that isn't based on the agent's state)
+            truncated = truncateds[i]
+            done = dones[i] and not truncated
+            finished = done or truncated
+            sub_info = infos["final_info"][i] if finished else None
+            info = None
+            if cmorl is None:
+                cmorl_reward = rewards[i]
+            elif cmorl.batched:
+                # filled in by compute_cmorl_rewards once the episode is over
+                cmorl_reward = 0.0
+            else:
+                cmorl_reward = (
+                    sub_info["cmorl_reward"] if finished else infos["cmorl_reward"][i]
+                )
+            if cmorl is not None and (cmorl.batched or cmorl.info_keys):
+                info = sub_info if finished else sub_env_info(infos, i)
+            episode.append(
+                actions[i],
+                infos["final_observation"][i] if finished else self.o[i],
+                rewards[i],
+                cmorl_reward,
+                info,
+            )
+
+            if finished:
+                finished_episodes.append((episode, done))
+                self.episodes[i] = self.new_episode(self.o[i])
+                # with several sub envs the shared noise is redrawn whenever any of them finishes
+                self.needs_resample = self.needs_resample or hp.noise_resample_every == 0
+        return finished_episodes
+
+    def end_epoch(self, epoch, qs_c, steps):
+        """steps is the number of env steps taken so far, where a resumed run continues"""
+        hp, logger = self.hp, self.logger
+        print(hp.steps_per_epoch)
+
+        # Save model
+        if (epoch % self.save_freq == 0) or (epoch == hp.epochs - 1):
+            self.on_save(
+                self.learner.pi_network,
+                self.learner.q_network,
+                epoch // self.save_freq,
+                # a checkpoint already holds the replay snapshot
+                replay_snapshot=self.replay_snapshot() if hp.save_replay and not self.checkpointing else None,
+            )
+            if self.checkpointing:
+                self.save_checkpoint(epoch, steps)
+            if hp.replay_dir:
+                self.replay_buffer.flush()
+
+        # Log info about epoch
+        self.weights_and_biases.log({"Epoch": epoch}, step=self.t)
+
+        logger.log_tabular("Epoch", epoch)
+        logger.log_tabular("EpLen", average_only=True)
+        logger.log_tabular("OrigEpRet", average_only=True)
+        for i in range(self.rew_dims):
+            logger.log_tabular(f"EpRet_{i}", average_only=True)
+        logger.log_tabular("Time", time.time() - self.start_time)
+        logger.log_tabular("TotalEnvInteracts", self.t)
+        for i in range(qs_c.shape[0]):
+            logger.log_tabular(f"Q{i}", average_only=True)
+        logger.log_tabular("actor_before_clip_c", average_only=True)
+        logger.log_tabular("Q_comp", average_only=True)
+        logger.log_tabular("Q_before_clip_c", average_only=True)
+        logger.log_tabular("Q_bellman_c", average_only=True)
+        logger.log_tabular("Q_direct_c", average_only=True)
+        logger.log_tabular("LossQ", average_only=True)
+        logger.dump_tabular(epoch)
+
+    def learn(self):
+        """
+        Main loop: collect experience in env and update/log each epoch,
+        every iteration steps all the sub envs so t advances by num_envs
+        """
+        hp = self.hp
+        qs_c = None
+        for self.t in range(self.start_t, self.total_steps, hp.num_envs):
+            t = self.t
+            for episode, done in self.collect_step():
+                self.store_episode(episode, done)
+
+            # episodes are only stored once they finish, with several sub envs none may have yet
+            for _ in range(
+                multiples_in_range(t, t + hp.num_envs, hp.train_every, after=hp.start_steps)
+                if self.replay_buffer.size > 0
+                else 0
+            ):
+                """
+                Perform all DDPG updates at the end of the trajectory,
+                in accordance with tuning done by TD3 paper authors.
+                """
+                qs_c, q_c = self.update()
+
+            # End of epoch wrap-up
+            if qs_c is not None and multiples_in_range(
+                t, t + hp.num_envs, hp.steps_per_epoch, after=hp.start_steps
+            ):
+                self.end_epoch((t + hp.num_envs - 1) // hp.steps_per_epoch, qs_c, t + hp.num_envs)
+
+    def learn_continuously(self, poll_collection, after_update=lambda q_c: None):
+        """
+        Trains while experience is collected elsewhere, keeping to hp.update_to_data gradient
+        steps per collected env step. poll_collection() moves what was collected into the
+        replay buffer and returns (env steps collected so far, whether collection is still running).
+        """
+        hp = self.hp
+        qs_c = None
+        handled_steps = self.start_t
+        # the updates a run that reached start_t took already
+        updates = max(
+            int(hp.update_to_data * (self.start_t - hp.start_steps)) // hp.train_steps * hp.train_steps, 0
+        )
+        collecting = True
+        while collecting:
+            steps, collecting = poll_collection()
+            while (
+                steps > hp.start_steps
+                and self.replay_buffer.size > 0
+                and updates + hp.train_steps <= hp.update_to_data * (steps - hp.start_steps)
+            ):
+                qs_c, q_c = self.update()
+                updates += hp.train_steps
+                after_update(self.q_composed_ema)
+            if qs_c is not None and multiples_in_range(
+                handled_steps, steps, hp.steps_per_epoch, after=hp.start_steps
+            ):
+                self.end_epoch((steps - 1) // hp.steps_per_epoch, qs_c, steps)
+            handled_steps = steps
+
+    def learn_async(self):
+        """
+        Trains on the main thread while a collector thread steps the envs. The collector hands
+        finished episodes over through a queue whose put blocks while the learner is behind,
+        the learner is the only one touching the replay buffer.
+        """
+        hp = self.hp
+        transition_queue = queue.Queue(maxsize=hp.queue_size)
+        collected_steps = self.start_t
+        collector_error = None
+
+        def collector():
+            nonlocal collected_steps, collector_error
+            try:
+                for self.t in range(self.start_t, self.total_steps, hp.num_envs):
+                    for finished in self.collect_step():
+                        transition_queue.put(finished)
+                    collected_steps = self.t + hp.num_envs
+            except Exception as e:
+                collector_error = e
+            finally:
+                transition_queue.put(None)
+
+        def poll_collection():
+            try:
+                item = transition_queue.get(timeout=1e-2)
+                while item is not None:
+                    self.store_episode(*item)
+                    item = transition_queue.get_nowait()
+                return collected_steps, False
+            except queue.Empty:
+                return collected_steps, True
+
+        collector_thread = threading.Thread(target=collector, daemon=True)
+        collector_thread.start()
+        self.learn_continuously(poll_collection)
+        collector_thread.join()
+        if collector_error is not None:
+            raise collector_error
+
+    def learn_distributed(self):
+        """Trains while hp.num_actor_processes processes collect into the shared replay buffer"""
+        actors = distributed.DistributedActors(
+            self.env_fn,
+            self.cmorl,
+            self.replay_buffer,
+            self.learner.pi_network,
+            self.env.action_space,
+            self.hp,
+            self.total_steps,
+            episode_outputs=self.episode_outputs,
+            episode_spec=self.episode_spec,
+        )
+        actors.env_steps.value = self.start_t
+        actors.start()
+
+        def poll_collection():
+            running = actors.running()
+            for ep_ret, ep_len, cmorl_ret in actors.drain_stats():
+                self.log_episode(ep_ret, ep_len, cmorl_ret)
+            self.t = min(actors.env_steps.value, self.total_steps)
+            time.sleep(1e-2)
+            return self.t, running
+
+        self.learn_continuously(
+            poll_collection,
+            after_update=lambda q_c: actors.publish(self.learner.pi_network, q_c),
+        )
+        actors.close()
+        self.replay_buffer.close()
+
+    def evaluate(self, eval_env, epoch):
+        """
+        Runs hp.offline_test_episodes episodes of the deterministic policy through test_utils.test,
+        their returns end up in the epoch's EpRet and EpLen, their Q offness goes to wandb.
+        """
+        hp, cmorl = self.hp, self.cmorl
+        pi_network, q_network = self.learner.pi_network, self.learner.q_network
+
+        def actor(o, np_random):
+            return pi_network(np.expand_dims(o, 0).astype(np.float32))[0].numpy()
+
+        def critic(os, acts):
+            return q_network(np.hstack([os, acts]).astype(np.float32))
+
+        offnesses = []
+        for i in range(hp.offline_test_episodes):
+            _, rs, cmorl_rs, rsum, _, offness = test_utils.test(
+                actor,
+                critic,
+                eval_env,
+                seed=hp.seed + epoch * hp.offline_test_episodes + i,
+                render=False,
+                cmorl=cmorl,
+                max_ep_len=hp.max_ep_len,
+                gamma=hp.gamma,
+            )
+            returns = cmorl_rs if cmorl is not None else np.reshape(rs, (-1, 1))
+            self.log_episode(rsum, len(rs), np.sum(returns, axis=0))
+            offnesses.append(offness)
+        self.weights_and_biases.log({"Offness": float(np.mean(offnesses))}, step=self.t)
+
+    def learn_offline(self):
+        """
+        Trains on the dataset in the replay buffer alone, t counts the env steps an online run
+        would have taken so the updates per epoch stay the same. Evaluates every epoch on a
+        separate env.
+        """
+        hp = self.hp
+        # the collection envs may hold reward wrappers that keep state between steps
+        eval_env = self.env_fn()
+        for self.t in range(self.start_t, self.total_steps, hp.train_every):
+            t = self.t
+            qs_c, q_c = self.update()
+            # wraps up the epochs whose last step this update block covered
+            if multiples_in_range(t + 1, t + hp.train_every + 1, hp.steps_per_epoch):
+                epoch = (t + hp.train_every) // hp.steps_per_epoch - 1
+                self.evaluate(eval_env, epoch)
+                self.end_epoch(epoch, qs_c, t + hp.train_every)
+
+    def train(self, o):
+        """Runs the loop hp asks for from the first observations o of the vector env, then closes up"""
+        hp = self.hp
+        self.o = o
+        self.episodes = [self.new_episode(sub_o) for sub_o in o]
+        if hp.offline:
+            self.learn_offline()
+        elif hp.num_actor_processes > 0:
+            self.learn_distributed()
+        elif hp.async_learner:
+            self.learn_async()
+        else:
+            self.learn()
+
+        if hp.replay_dir:
+            self.replay_buffer.flush()
+        save_utils.replay_writer.wait()
+        for writer in self.episode_writers:
+            writer.close()
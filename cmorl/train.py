@@ -15,7 +15,7 @@ def parse_env_name(args=None):
 def parse_args_and_train(env_name, args=None):
     env_fn, config = get_env_and_config(env_name)
     serializer = hyperparams.default_serializer(hypers=config.hypers)
-    cmd_args = serializer.parse_arguments(args)
+    cmd_args = hyperparams.validate(serializer.parse_arguments(args))
     generated_params = train_utils.create_train_folder_and_params(
         env_name, cmd_args, serializer
     )
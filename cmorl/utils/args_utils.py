@@ -100,8 +100,13 @@ def get_minified_args_dict(serializer: Arg_Serializer, hypers: dict[str, Any], s
         serialize_me[arg.id()] = value
     return {"args":serialize_me,"minified": minified, "extra": {**extra_args, **ignored_args}}
 
+def str_to_bool(s: str) -> bool:
+    return s.lower() in ("true", "1", "yes")
+
 def namespace_serializer(namespace: argparse.Namespace, ignored:set[str]=set(), descriptions:dict[str, str]={}, abbrevs:dict[str, str]={}):
     def get_serializer_type(v):
+        if type(v) == bool: # bool("False") is True
+            return str_to_bool
         return json.loads if type(v) == dict else type(v)
     return Arg_Serializer(
         *(
@@ -0,0 +1,284 @@
+"""
+
+Composers written as trees of composition operators instead of hand-written tf.functions.
+
+A tree is built from ``objective(i)`` leaves with ``AND``, ``OR``, ``THEN``, ``CURRICULUM``,
+``OFFSET``, ``CLIP`` and ``POW``, and ``Composer`` compiles it. Compiling lowers every
+operator to four node types (weighted ``Mean``, ``Affine``, ``Clip`` to [0, 1] and ``Power``)
+and simplifies the result: constants like the normalizer of ``THEN`` are folded into affine
+maps, chains of affine maps collapse into one (keeping the unscaled gradient of ``OFFSET``),
+nested means with the same p are flattened into one weighted mean and repeated subtrees are
+evaluated once. The same compiled tree computes the Q composition in TF
+(``Composer.__call__``, a drop-in q_composer) and rewards in NumPy
+(``Composer.reward``).
+
+"""
+from collections import namedtuple
+from dataclasses import dataclass
+from functools import reduce
+import numpy as np
+import tensorflow as tf
+from cmorl.utils.loss_composition import np_p_mean, per_config, tf_p_mean
+
+
+@dataclass(frozen=True)
+class Objective:
+    """Objective ``index`` of the Q values (or rewards)"""
+    index: int
+
+
+@dataclass(frozen=True)
+class Mean:
+    """The p_mean of children with the given relative weights, p None is the composer's p_objectives"""
+    children: tuple
+    p: float | None = None
+    weights: tuple | None = None
+
+
+@dataclass(frozen=True)
+class Affine:
+    """child * scale + shift, whose gradient is scaled by gradient_scale instead of scale if it's given"""
+    child: object
+    scale: float = 1.0
+    shift: float = 0.0
+    gradient_scale: float | None = None
+
+
+@dataclass(frozen=True)
+class Clip:
+    """child clipped to [0, 1]"""
+    child: object
+
+
+@dataclass(frozen=True)
+class Power:
+    """child ** exponent"""
+    child: object
+    exponent: float
+
+
+def objective(index):
+    return Objective(int(index))
+
+
+def AND(*children, p=None):
+    """All the children have to be satisfied, the p_mean of them (p None is the composer's p_objectives)"""
+    return Mean(tuple(children), p)
+
+
+def OR(*children, p=None):
+    """Any of the children satisfies it, the AND of the complements complemented (De Morgan)"""
+    return Affine(Mean(tuple(Affine(child, -1.0, 1.0) for child in children), p), -1.0, 1.0)
+
+
+def OFFSET(child, slack):
+    """
+    loss_composition.offset: positive slack raises the bottom of [0, 1], negative slack lowers
+    the top. Like offset it passes the gradient through unscaled.
+    """
+    return Affine(child, 1.0 - abs(slack), max(slack, 0.0), gradient_scale=1.0)
+
+
+def THEN(first, second, slack=0.5, p=-1.0):
+    """loss_composition.then: first has priority, second (offset by slack) only counts on top of it"""
+    min_p_mean = float(np_p_mean([0.0, slack], p=p))
+    return Affine(Mean((first, OFFSET(second, slack)), p), 1.0 / (1.0 - min_p_mean), -min_p_mean / (1.0 - min_p_mean))
+
+
+def CURRICULUM(*children, slack=0.1, p=-1.0):
+    """
+    loss_composition.curriculum: the children in order of priority, each one offset by a
+    slack that grows towards ``slack`` so the later ones only count on top of the earlier ones
+    """
+    slacks = [slack * (1.0 - 0.5**i) for i in range(len(children))]
+    min_p_mean = float(np_p_mean(slacks, p=p))
+    offset = Mean(tuple(OFFSET(child, child_slack) for child, child_slack in zip(children, slacks)), p)
+    return Affine(offset, 1.0 / (1.0 - min_p_mean), -min_p_mean / (1.0 - min_p_mean))
+
+
+def CLIP(child, low, high, to_low=0.0, to_high=1.0):
+    """loss_composition.clip_to: [low, high] mapped onto [to_low, to_high], values outside clipped"""
+    scaled = Clip(Affine(child, 1.0 / (high - low), -low / (high - low)))
+    return Affine(scaled, to_high - to_low, to_low)
+
+
+def POW(child, exponent):
+    return Power(child, float(exponent))
+
+
+def simplify(node):
+    """
+    node with its affine chains collapsed, nested clips and powers merged, nested means with the
+    same p flattened into one weighted mean and repeated children of a mean merged by weight
+    """
+    if isinstance(node, Objective):
+        return node
+    if isinstance(node, Affine):
+        child = simplify(node.child)
+        scale, shift, gradient_scale = node.scale, node.shift, _gradient_scale(node)
+        if isinstance(child, Affine):
+            child, scale, shift, gradient_scale = (
+                child.child,
+                scale * child.scale,
+                scale * child.shift + shift,
+                gradient_scale * _gradient_scale(child),
+            )
+        if (scale, shift, gradient_scale) == (1.0, 0.0, 1.0):
+            return child
+        return Affine(child, scale, shift, None if gradient_scale == scale else gradient_scale)
+    if isinstance(node, Clip):
+        child = simplify(node.child)
+        return child if isinstance(child, Clip) else Clip(child)
+    if isinstance(node, Power):
+        child = simplify(node.child)
+        exponent = node.exponent
+        if isinstance(child, Power):
+            child, exponent = child.child, exponent * child.exponent
+        return child if exponent == 1.0 else Power(child, exponent)
+    if isinstance(node, Mean):
+        weights = node.weights or (1.0,) * len(node.children)
+        total = sum(weights)
+        merged = {}
+        for child, weight in zip(node.children, weights):
+            child = simplify(child)
+            # the weights of a nested mean with the same p are shares of its own weight
+            if isinstance(child, Mean) and child.p == node.p:
+                child_total = sum(child.weights)
+                grandchildren = zip(child.children, (weight * w / child_total for w in child.weights))
+            else:
+                grandchildren = [(child, weight)]
+            for grandchild, grandchild_weight in grandchildren:
+                merged[grandchild] = merged.get(grandchild, 0.0) + grandchild_weight / total
+        if len(merged) == 1:
+            return next(iter(merged))
+        return Mean(tuple(merged), node.p, tuple(merged.values()))
+    raise TypeError(f"not a composition node: {node!r}")
+
+
+def _gradient_scale(node: Affine):
+    return node.scale if node.gradient_scale is None else node.gradient_scale
+
+
+def operands(node):
+    """The nodes whose values a composer reports as qs_c: the children of the top mean"""
+    while isinstance(node, (Affine, Clip, Power)):
+        node = node.child
+    return node.children if isinstance(node, Mean) else (node,)
+
+
+def _tf_stack(values, axis=0):
+    """tf.stack of values broadcast against each other, children of a mean can differ in configuration axes"""
+    if any(value.shape != values[0].shape for value in values):
+        shape = reduce(tf.broadcast_dynamic_shape, [tf.shape(value) for value in values])
+        values = [tf.broadcast_to(value, shape) for value in values]
+    return tf.stack(values, axis=axis)
+
+
+def _np_stack(values, axis=0):
+    return np.stack(np.broadcast_arrays(*values), axis=axis)
+
+
+def _np_gather(values, indices):
+    return np.take(values, indices, axis=0)
+
+
+def _tf_with_gradient(x, value, gradient_scale):
+    """value, with the gradient of x * gradient_scale"""
+    return x * gradient_scale + tf.stop_gradient(value - x * gradient_scale)
+
+
+def _np_with_gradient(x, value, gradient_scale):
+    return value
+
+
+Backend = namedtuple("Backend", ["p_mean", "stack", "gather", "clip", "with_gradient"])
+TF_BACKEND = Backend(tf_p_mean, _tf_stack, tf.gather, tf.clip_by_value, _tf_with_gradient)
+NP_BACKEND = Backend(np_p_mean, _np_stack, _np_gather, np.clip, _np_with_gradient)
+
+
+def evaluate(node, columns, p_objectives, backend: Backend, cache: dict):
+    """
+    The value of node for columns, which holds the objectives along its first axis. Values of
+    nodes already in cache are reused, so every distinct subtree is computed once per call.
+    """
+    if isinstance(node, Objective):
+        return columns[node.index]
+    if node in cache:
+        return cache[node]
+    if isinstance(node, Affine):
+        child = evaluate(node.child, columns, p_objectives, backend, cache)
+        value = child * node.scale + node.shift
+        if node.gradient_scale is not None:
+            value = backend.with_gradient(child, value, node.gradient_scale)
+    elif isinstance(node, Clip):
+        value = backend.clip(evaluate(node.child, columns, p_objectives, backend, cache), 0.0, 1.0)
+    elif isinstance(node, Power):
+        value = evaluate(node.child, columns, p_objectives, backend, cache) ** node.exponent
+    else:
+        if all(isinstance(child, Objective) for child in node.children):
+            # a single gather instead of one slice per objective
+            stacked = backend.gather(columns, [child.index for child in node.children])
+        else:
+            stacked = backend.stack(
+                [evaluate(child, columns, p_objectives, backend, cache) for child in node.children]
+            )
+        weights = (
+            np.reshape(node.weights, (-1,) + (1,) * (len(stacked.shape) - 1))
+            if len(set(node.weights)) > 1
+            else None
+        )
+        p = p_objectives if node.p is None else node.p
+        value = backend.p_mean(stacked, p, axis=0, weights=weights)
+    cache[node] = value
+    return value
+
+
+class Composer:
+    """
+    A q_composer compiled from a composition tree. Called with Q values of shape
+    (batch, objectives) it returns (qs_c, q_c) like the hand-written composers: q_c composes
+    every sample with the tree and then the batch with p_batch (batch_first composes each
+    objective over the batch first instead), qs_c holds the batch compositions of the
+    operands of the tree's top mean. p_batch and p_objectives can be tensors of p values,
+    their results go along a leading configuration axis (see loss_composition.per_config).
+    """
+
+    def __init__(self, tree, batch_first=False, p_batch=0.0, p_objectives=-4.0):
+        self.tree = simplify(tree)
+        self.operands = operands(self.tree)
+        self.batch_first = batch_first
+        self.p_batch = p_batch
+        self.p_objectives = p_objectives
+        self._compose = tf.function(self.compose)
+
+    def __call__(self, q_values, p_batch=None, p_objectives=None):
+        return self._compose(
+            q_values,
+            self.p_batch if p_batch is None else p_batch,
+            self.p_objectives if p_objectives is None else p_objectives,
+        )
+
+    def compose(self, q_values, p_batch, p_objectives):
+        q_values = tf.convert_to_tensor(q_values)
+        # the values of the operands are computed on the way to q_c, the cache hands them back
+        cache = {}
+        if self.batch_first:
+            qs = tf_p_mean(q_values, per_config(p_batch), axis=0)
+            # the objectives go first, configurations (if any) after them
+            columns = tf.experimental.numpy.moveaxis(qs, -1, 0)
+            q_c = evaluate(self.tree, columns, p_objectives, TF_BACKEND, cache)
+            values = [evaluate(node, columns, p_objectives, TF_BACKEND, cache) for node in self.operands]
+            return _tf_stack(values, axis=-1), q_c
+        # one transpose shared by all the leaves, every node then holds a value per sample
+        columns = tf.transpose(q_values)
+        p_objectives = per_config(p_objectives)
+        q_c = tf_p_mean(evaluate(self.tree, columns, p_objectives, TF_BACKEND, cache), p_batch, axis=-1)
+        values = [evaluate(node, columns, p_objectives, TF_BACKEND, cache) for node in self.operands]
+        qs_c = tf_p_mean(_tf_stack(values, axis=-1), per_config(p_batch), axis=-2)
+        return qs_c, q_c
+
+    def reward(self, rewards, p_objectives=None):
+        """The composed reward of a reward vector (objectives,), or of every row of (steps, objectives), in NumPy"""
+        columns = np.moveaxis(np.asarray(rewards), -1, 0)
+        p_objectives = self.p_objectives if p_objectives is None else p_objectives
+        return evaluate(self.tree, columns, p_objectives, NP_BACKEND, {})
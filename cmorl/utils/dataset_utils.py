@@ -0,0 +1,252 @@
+"""
+
+Episodes on disk as shards of raw arrays, used for the warm-start replay library and for
+the episodes a run exports for later analysis.
+
+A shard is a folder with one .npy file per field. The episodes in it are stored back to back:
+``observations`` holds the T+1 observations of every episode, ``actions``, ``rewards`` and
+``cmorl_rewards`` their T steps and ``info.<key>`` the step infos the reward fns read
+(``CMORL.info_keys``), so the rewards can be recomputed for another reward fn. Every writer
+keeps its own manifest listing its shards with the lengths and done flags of their episodes,
+so several runs can write into the same folder without locking, and a shard only shows up
+in a manifest once it's completely written.
+
+"""
+import functools
+import json
+import os
+import time
+import uuid
+from pathlib import Path
+import numpy as np
+from cmorl.utils.reward_utils import Transition
+from cmorl.utils.serialization_utils import ExtraTypesEncoder, hash_it
+
+EPISODE_FIELDS = ("observations", "actions", "rewards", "cmorl_rewards")
+
+
+def describe_callable(fn) -> str | None:
+    """A name for fn that stays the same across processes, partials include their arguments"""
+    if fn is None:
+        return None
+    if isinstance(fn, functools.partial):
+        arguments = [repr(arg) for arg in fn.args] + [
+            f"{key}={value!r}" for key, value in sorted(fn.keywords.items())
+        ]
+        return f"{describe_callable(fn.func)}({', '.join(arguments)})"
+    return f"{getattr(fn, '__module__', '')}.{getattr(fn, '__qualname__', type(fn).__name__)}"
+
+
+def env_spec(env_name, env_args, cmorl=None) -> dict:
+    """What has to match for stored transitions and their CMORL rewards to be reused"""
+    return dict(
+        env_name=env_name,
+        env_args=env_args,
+        reward_fn=None if cmorl is None else describe_callable(cmorl.reward_fn),
+    )
+
+
+def episode_dones(length, done):
+    """The done flags of the steps of an episode, only its last step can be done"""
+    dones = np.zeros(length, dtype=np.float32)
+    dones[-1:] = done
+    return dones
+
+
+def library_folder(library, spec: dict) -> Path:
+    """Where the episodes matching spec are kept inside the library folder"""
+    return Path(library, str(spec["env_name"]), hash_it(json.dumps(spec, sort_keys=True, cls=ExtraTypesEncoder)))
+
+
+class ShardWriter:
+    """
+    Collects finished episodes and writes them into ``folder`` as a new shard whenever
+    shard_steps steps are pending, ``close`` writes the rest.
+    """
+
+    def __init__(self, folder, spec: dict, shard_steps=100_000):
+        self.folder = Path(folder)
+        os.makedirs(self.folder, exist_ok=True)
+        self.spec = spec
+        self.shard_steps = shard_steps
+        self.writer_id = f"{int(time.time())}-{uuid.uuid4().hex[:8]}"
+        self.manifest = dict(spec=spec, shards=[])
+        self.pending = []
+        self.pending_steps = 0
+
+    def add_episode(self, observations, actions, rewards, cmorl_rewards, done, infos=None):
+        """observations holds the T+1 observations of the T steps, infos the stacked step infos"""
+        numeric_infos = {}
+        for key, values in (infos or {}).items():
+            try:
+                numeric_infos[key] = np.asarray(values, dtype=np.float32)
+            except (TypeError, ValueError):
+                pass
+        self.pending.append(
+            dict(
+                observations=np.asarray(observations, dtype=np.float32),
+                actions=np.asarray(actions, dtype=np.float32),
+                rewards=np.asarray(rewards, dtype=np.float32),
+                cmorl_rewards=np.asarray(cmorl_rewards, dtype=np.float32),
+                done=bool(done),
+                infos=numeric_infos,
+            )
+        )
+        self.pending_steps += len(actions)
+        if self.pending_steps >= self.shard_steps:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        name = f"{self.writer_id}-{len(self.manifest['shards']):05d}"
+        tmp_path = self.folder / f"{name}.tmp"
+        os.makedirs(tmp_path)
+        for field in EPISODE_FIELDS:
+            np.save(tmp_path / f"{field}.npy", np.concatenate([episode[field] for episode in self.pending]))
+        # only the info keys every episode of the shard has, with the same shape
+        info_keys = []
+        for key in set(self.pending[0]["infos"]).intersection(*(episode["infos"] for episode in self.pending)):
+            if len({episode["infos"][key].shape[1:] for episode in self.pending}) == 1:
+                np.save(tmp_path / f"info.{key}.npy", np.concatenate([episode["infos"][key] for episode in self.pending]))
+                info_keys.append(key)
+        os.replace(tmp_path, self.folder / name)
+        self.manifest["shards"].append(
+            dict(
+                name=name,
+                lengths=[len(episode["actions"]) for episode in self.pending],
+                dones=[episode["done"] for episode in self.pending],
+                info_keys=sorted(info_keys),
+            )
+        )
+        manifest_path = self.folder / f"manifest-{self.writer_id}.json"
+        with open(manifest_path.with_suffix(".tmp"), "w") as f:
+            json.dump(self.manifest, f, cls=ExtraTypesEncoder)
+        os.replace(manifest_path.with_suffix(".tmp"), manifest_path)
+        self.pending = []
+        self.pending_steps = 0
+
+    def close(self):
+        self.flush()
+
+
+def read_shards(folder, newest_first=True):
+    """The (path, lengths, dones, info_keys) of every shard in folder, ordered by when they were written"""
+    shards = []
+    for manifest_path in Path(folder).glob("manifest-*.json"):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        shards.extend(
+            (Path(folder, shard["name"]), shard["lengths"], shard["dones"], shard.get("info_keys", []))
+            for shard in manifest["shards"]
+        )
+    return sorted(shards, key=lambda shard: os.path.getmtime(shard[0]), reverse=newest_first)
+
+
+def read_episodes(folder, max_steps=np.inf, newest_first=True):
+    """
+    Yields (observations, actions, rewards, cmorl_rewards, done, infos) of the episodes in
+    folder, shard by shard, until max_steps steps were yielded. The arrays are slices of
+    read-only memory maps.
+    """
+    steps = 0
+    for path, lengths, dones, info_keys in read_shards(folder, newest_first):
+        fields = {field: np.load(path / f"{field}.npy", mmap_mode="r") for field in EPISODE_FIELDS}
+        infos = {key: np.load(path / f"info.{key}.npy", mmap_mode="r") for key in info_keys}
+        step_starts = np.concatenate([[0], np.cumsum(lengths)])
+        for i, (length, done) in enumerate(zip(lengths, dones)):
+            if steps >= max_steps:
+                return
+            start, obs_start = step_starts[i], step_starts[i] + i
+            yield (
+                fields["observations"][obs_start : obs_start + length + 1],
+                fields["actions"][start : start + length],
+                fields["rewards"][start : start + length],
+                fields["cmorl_rewards"][start : start + length],
+                done,
+                {key: values[start : start + length] for key, values in infos.items()},
+            )
+            steps += length
+
+
+def read_batches(folder, batch_size, info_keys=(), shuffle=False, np_random=np.random, newest_first=False):
+    """
+    Yields the steps stored in folder as dicts of batch_size transitions (observations,
+    actions, next_observations, rewards, cmorl_rewards, dones and ``info.<key>`` for the
+    requested info_keys), shard by shard, the last batch may be smaller. Every shard is read
+    through memory maps, so only the batches being yielded are loaded. shuffle shuffles the
+    steps within each shard.
+    """
+    leftover = None
+    for path, lengths, dones, _ in read_shards(folder, newest_first):
+        fields = {field: np.load(path / f"{field}.npy", mmap_mode="r") for field in EPISODE_FIELDS}
+        fields.update({f"info.{key}": np.load(path / f"info.{key}.npy", mmap_mode="r") for key in info_keys})
+        # every episode has one more observation than steps
+        obs_idxs = np.arange(sum(lengths)) + np.repeat(np.arange(len(lengths)), lengths)
+        step_dones = np.concatenate([episode_dones(length, done) for length, done in zip(lengths, dones)])
+        order = np_random.permutation(len(obs_idxs)) if shuffle else np.arange(len(obs_idxs))
+        for start in range(0, len(order), batch_size):
+            # sorted indices keep the reads from the memory maps sequential
+            idxs = np.sort(order[start : start + batch_size])
+            batch = dict(
+                observations=fields["observations"][obs_idxs[idxs]],
+                actions=fields["actions"][idxs],
+                next_observations=fields["observations"][obs_idxs[idxs] + 1],
+                rewards=fields["rewards"][idxs],
+                cmorl_rewards=fields["cmorl_rewards"][idxs],
+                dones=step_dones[idxs],
+                **{f"info.{key}": fields[f"info.{key}"][idxs] for key in info_keys},
+            )
+            if leftover is not None:
+                # the end of the previous shard is topped up with the start of this one
+                batch = {key: np.concatenate([leftover[key], values]) for key, values in batch.items()}
+            leftover = {key: values[batch_size:] for key, values in batch.items()}
+            if len(batch["actions"]) >= batch_size:
+                yield {key: values[:batch_size] for key, values in batch.items()}
+            else:
+                leftover = batch
+            if len(leftover["actions"]) == 0:
+                leftover = None
+    if leftover is not None:
+        yield leftover
+
+
+def relabel_shards(source, target, cmorl, env, spec: dict, chunk_size=65536):
+    """
+    Copies the episodes in source to a new shard set in target, with their CMORL rewards
+    recomputed by cmorl.relabel for whole episodes of about chunk_size steps at a time.
+    Returns the number of steps relabeled.
+    """
+    writer = ShardWriter(target, spec)
+    pending = []
+    steps = 0
+
+    def relabel_pending():
+        if not pending:
+            return
+        info_keys = set(pending[0][5]).intersection(*(episode[5] for episode in pending))
+        dones = np.concatenate([episode_dones(len(episode[1]), episode[4]) for episode in pending])
+        transitions = Transition(
+            np.concatenate([episode[0][:-1] for episode in pending]),
+            np.concatenate([episode[1] for episode in pending]),
+            np.concatenate([episode[0][1:] for episode in pending]),
+            dones,
+            {key: np.concatenate([episode[5][key] for episode in pending]) for key in info_keys},
+        )
+        rewards = cmorl.relabel(transitions, env)
+        splits = np.cumsum([len(episode[1]) for episode in pending])[:-1]
+        for (observations, actions, env_rewards, _, done, infos), cmorl_rewards in zip(pending, np.split(rewards, splits)):
+            writer.add_episode(observations, actions, env_rewards, cmorl_rewards, done, infos)
+        pending.clear()
+
+    pending_steps = 0
+    for episode in read_episodes(source, newest_first=False):
+        pending.append(episode)
+        pending_steps += len(episode[1])
+        steps += len(episode[1])
+        if pending_steps >= chunk_size:
+            relabel_pending()
+            pending_steps = 0
+    relabel_pending()
+    writer.close()
+    return steps
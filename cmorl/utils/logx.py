@@ -77,7 +77,7 @@ class Logger:
     state of a training run, and the trained model.
     """
 
-    def __init__(self, output_dir=None, output_fname="progress.txt", exp_name=None):
+    def __init__(self, output_dir=None, output_fname="progress.txt", exp_name=None, resume=False):
         """
         Initialize a Logger.
 
@@ -95,6 +95,9 @@ class Logger:
                 will know to group them. (Use case: if you run the same
                 hyperparameter configuration with multiple random seeds, you
                 should give them all the same ``exp_name``.)
+
+            resume (bool): Append to an existing output file instead of
+                overwriting it, for runs continued from a checkpoint.
         """
         self.output_dir = output_dir or "/tmp/experiments/%i" % int(time.time())
         if osp.exists(self.output_dir):
@@ -104,12 +107,14 @@ class Logger:
             )
         else:
             os.makedirs(self.output_dir)
-        self.output_file = open(osp.join(self.output_dir, output_fname), "w")
+        output_path = osp.join(self.output_dir, output_fname)
+        # a resumed run only writes the header if the file doesn't have one yet
+        self.first_row = not (resume and osp.exists(output_path) and osp.getsize(output_path) > 0)
+        self.output_file = open(output_path, "a" if resume else "w")
         atexit.register(self.output_file.close)
         print(
             colorize("Logging data to %s" % self.output_file.name, "green", bold=True)
         )
-        self.first_row = True
         self.log_headers = []
         self.log_current_row = {}
         self.exp_name = exp_name
@@ -292,6 +297,79 @@ def statistics_scalar(x, with_min_and_max=False):
     return mean, std
 
 
+class MetricsAccumulator:
+    """
+    Running count, sum, sum of squares, min and max per key, kept in tf.Variables.
+
+    Values are accumulated on device without syncing with the host, ``read`` fetches the
+    statistics of every key in one go. Keys are created on their first ``update``, keys
+    that get updated from inside a tf.function should be created beforehand with ``add_key``.
+    """
+
+    def __init__(self):
+        self.stats: dict[str, dict[str, tf.Variable]] = {}
+
+    def add_key(self, key, shape=()):
+        def variable(value):
+            return tf.Variable(np.full(tuple(shape), value, dtype=np.float32), trainable=False)
+
+        self.stats[key] = dict(
+            count=tf.Variable(0.0, trainable=False),
+            sum=variable(0.0),
+            sum_sq=variable(0.0),
+            min=variable(np.inf),
+            max=variable(-np.inf),
+        )
+
+    def update(self, **values):
+        """Accumulates a single sample for each key"""
+        for key, value in values.items():
+            value = tf.cast(value, tf.float32)
+            if key not in self.stats:
+                self.add_key(key, value.shape)
+            self.update_many(**{key: tf.expand_dims(value, 0)})
+
+    def update_many(self, **values):
+        """Accumulates the samples stacked along the first axis of each value"""
+        for key, value in values.items():
+            value = tf.cast(value, tf.float32)
+            if key not in self.stats:
+                self.add_key(key, value.shape[1:])
+            stats = self.stats[key]
+            stats["count"].assign_add(tf.cast(tf.shape(value)[0], tf.float32))
+            stats["sum"].assign_add(tf.reduce_sum(value, axis=0))
+            stats["sum_sq"].assign_add(tf.reduce_sum(value**2.0, axis=0))
+            stats["min"].assign(tf.minimum(stats["min"], tf.reduce_min(value, axis=0)))
+            stats["max"].assign(tf.maximum(stats["max"], tf.reduce_max(value, axis=0)))
+
+    def read(self):
+        """
+        Returns {key: {"mean", "std", "min", "max", "count"}} with NumPy values
+        for every key that received samples.
+        """
+        results = {}
+        for key, stats in tf.nest.map_structure(np.asarray, self.stats).items():
+            if stats["count"] == 0:
+                continue
+            mean = stats["sum"] / stats["count"]
+            results[key] = dict(
+                mean=mean,
+                std=np.sqrt(np.maximum(stats["sum_sq"] / stats["count"] - mean**2.0, 0.0)),
+                min=stats["min"],
+                max=stats["max"],
+                count=stats["count"],
+            )
+        return results
+
+    def reset(self):
+        for stats in self.stats.values():
+            stats["count"].assign(0.0)
+            stats["sum"].assign(tf.zeros_like(stats["sum"]))
+            stats["sum_sq"].assign(tf.zeros_like(stats["sum_sq"]))
+            stats["min"].assign(tf.fill(tf.shape(stats["min"]), np.inf))
+            stats["max"].assign(tf.fill(tf.shape(stats["max"]), -np.inf))
+
+
 class EpochLogger(Logger):
     """
     A variant of Logger tailored for tracking average values over epochs.
@@ -315,11 +393,20 @@ class EpochLogger(Logger):
         epoch_logger.log_tabular(NameOfQuantity, **options)
 
     to record the desired values.
+
+    Quantities computed inside a tf.function can skip the round trip to the
+    host by going through the ``metrics`` accumulator instead, register the key
+    once with ``epoch_logger.metrics.add_key(NameOfQuantity)`` and call
+    ``epoch_logger.metrics.update(NameOfQuantity=tensor)`` from the graph.
+    ``log_tabular`` reads those keys the same way as stored ones.
     """
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.epoch_dict = dict()
+        self.metrics = MetricsAccumulator()
+        # the metrics are read from the device once per dump
+        self.metric_stats = None
 
     def store(self, **kwargs):
         """
@@ -354,6 +441,15 @@ class EpochLogger(Logger):
         """
         if val is not None:
             super().log_tabular(key, val)
+        elif key in self.metrics.stats and key not in self.epoch_dict:
+            stats = self.read_metric(key)
+            super().log_tabular(key if average_only else "Average" + key, stats[0])
+            if not (average_only):
+                super().log_tabular("Std" + key, stats[1])
+            if with_min_and_max:
+                super().log_tabular("Max" + key, stats[3])
+                super().log_tabular("Min" + key, stats[2])
+            return
         else:
             v = self.epoch_dict[key]
             try:
@@ -373,10 +469,26 @@ class EpochLogger(Logger):
                 super().log_tabular("Min" + key, stats[2])
         self.epoch_dict[key] = []
 
+    def read_metric(self, key):
+        """mean, std, min and max of a key of ``metrics``, nan if it got no samples this epoch"""
+        if self.metric_stats is None:
+            self.metric_stats = self.metrics.read()
+        if key not in self.metric_stats:
+            return np.nan, np.nan, np.inf, -np.inf
+        stats = self.metric_stats[key]
+        return stats["mean"], stats["std"], stats["min"], stats["max"]
+
+    def dump_tabular(self):
+        super().dump_tabular()
+        self.metrics.reset()
+        self.metric_stats = None
+
     def get_stats(self, key):
         """
         Lets an algorithm ask the logger for mean/std/min/max of a diagnostic.
         """
+        if key in self.metrics.stats and key not in self.epoch_dict:
+            return self.read_metric(key)[:2]
         v = self.epoch_dict[key]
         vals = (
             np.concatenate(v)
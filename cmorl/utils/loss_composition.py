@@ -1,4 +1,13 @@
-from functools import reduce
+"""
+
+Composition operators for objectives in [0, 1]. ``p_mean``, ``inv_mean``, ``then``,
+``offset``, ``curriculum``, ``weaken`` and ``clip_to`` have a TF implementation (``tf_*``,
+differentiable, used by the Q composers inside tf.functions) and a NumPy one (``np_*``, for
+reward fns running on every env step, where a tf.function call costs far more than the
+math), the plain names pick the NumPy one unless an argument is a TF tensor or variable.
+
+"""
+from functools import partial, reduce, wraps
 import tensorflow as tf # type: ignore
 import numpy as np
 
@@ -52,8 +61,10 @@ def clip_keep_in_range(val, min, max, push_strength):
     return clip_t, grad
 
 @tf.function
-def p_mean(l: tf.Tensor, p: float, slack=1e-7, default_val=0.0, axis=None, dtype=None) -> tf.Tensor:
+def stabilized_p_mean(l: tf.Tensor, p: float, slack=1e-7, default_val=0.0, axis=None, dtype=None) -> tf.Tensor:
     """
+    The previous tf_p_mean, stabilized by the min or max of the whole tensor and clipped to its
+    range, kept to compare and benchmark tf_p_mean against.
     The Generalized mean
     l: a tensor of elements we would like to compute the p_mean with respect to, elements must be > 0.0
     p: the value of the generalized mean, p = -1 is the harmonic mean, p = 1 is the regular mean, p=inf is the max function ...
@@ -80,6 +91,120 @@ def p_mean(l: tf.Tensor, p: float, slack=1e-7, default_val=0.0, axis=None, dtype
     
     return clip_preserve_grads(p_meaned, tf.reduce_min(l), tf.reduce_max(l))
 
+def _config_layout(rank, p_rank, axis):
+    """
+    How the axes of a non-scalar p line up with l: p broadcasts against the result of reducing
+    l along axis (NumPy style, aligned to the right), any leading axes p has beyond that result
+    are configuration axes prepended to l. Returns (extra, axes, p_axes): the number of axes
+    to prepend to l, the axes of the expanded l to reduce and the axes of the expanded l that
+    the axes of p go to.
+    """
+    axes = list(range(rank)) if axis is None else [a % rank for a in np.atleast_1d(axis)]
+    extra = max(p_rank - (rank - len(axes)), 0)
+    axes = [a + extra for a in axes]
+    result_axes = [i for i in range(rank + extra) if i not in axes]
+    return extra, axes, result_axes[len(result_axes) - p_rank:]
+
+def per_config(p, rank=1):
+    """
+    p values of shape [K] laid out to broadcast against p_mean results of the given rank,
+    so p_mean returns its K results along a new leading configuration axis. Scalars stay scalars.
+    """
+    if tf.is_tensor(p):
+        return tf.reshape(p, tf.concat([tf.shape(p), tf.ones([rank], tf.int32)], 0)) if p.shape.rank else p
+    return np.reshape(p, np.shape(p) + (1,) * rank) if np.ndim(p) else p
+
+def _log_power_mean(log_x, p, axis, weights=None):
+    """
+    log(p_mean(x)) from log(x) without overflow for any p: the mean of x**p is taken relative
+    to the largest p*log(x) along axis, and through expm1/log1p so the limit p -> 0 stays
+    accurate. p is a scalar or has size 1 along the reduced axes, weights (if any) are
+    normalized along axis. Returns (log_mean, shift, n) where shift holds that largest
+    p*log(x) with the reduced axes kept and n is the number of elements reduced.
+    """
+    def mean(values):
+        if weights is None:
+            return tf.reduce_mean(values, axis=axis)
+        return tf.reduce_sum(weights * values, axis=axis)
+
+    scaled = p * log_x
+    shift = tf.reduce_max(scaled, axis=axis, keepdims=True)
+    relative = tf.math.log1p(mean(tf.math.expm1(scaled - shift)))
+    shift_reduced = tf.reshape(shift, tf.shape(relative))
+    p_reduced = tf.reshape(tf.broadcast_to(p, tf.shape(shift)), tf.shape(relative))
+    n = tf.size(log_x) // tf.maximum(tf.size(shift), 1)
+    static_p = tf.get_static_value(p)
+    if static_p is not None and np.all(static_p != 0):
+        return (shift_reduced + relative) / p_reduced, shift, n
+    # p = 0 is the geometric mean, the limit of the formula above
+    geometric = mean(log_x)
+    if static_p is not None and np.all(static_p == 0):
+        return geometric, shift, n
+    safe_p = tf.where(p_reduced == 0, tf.ones_like(p_reduced), p_reduced)
+    return tf.where(p_reduced == 0, geometric, (shift_reduced + relative) / safe_p), shift, n
+
+@tf.function
+def tf_p_mean(l: tf.Tensor, p: float, slack=1e-7, default_val=0.0, axis=None, dtype=None, weights=None) -> tf.Tensor:
+    """
+    The Generalized mean
+    l: a tensor of elements we would like to compute the p_mean with respect to, elements must be >= 0.0 (smaller ones count as 0.0)
+    p: the value of the generalized mean, p = -1 is the harmonic mean, p = 0 the geometric mean, p = 1 is the regular mean, large p approach the max function ...
+       a tensor of p values broadcasts against the result (NumPy style), its extra leading axes become leading configuration axes of the result, see per_config
+    slack: allows elements to be at 0.0 with p < 0.0 without collapsing the pmean to 0.0 fully allowing useful gradient information to leak
+    default_val: the result of reducing no elements
+    axis: axis or axese to collapse the pmean with respect to, None would collapse all
+    weights: relative weights of the elements, broadcast against l and normalized along axis, None weighs all the same
+    Computed in log space, stabilized separately for every slice along axis, with the gradient
+    x_i**(p-1) * p_mean**(1-p) / n written out instead of differentiated through the log space ops.
+    Like stabilized_p_mean the result is clamped to the range of the values it means (per slice
+    here, not over the whole tensor), without the clamp touching the gradient.
+    https://www.wolframcloud.com/obj/26a59837-536e-4e9e-8ed1-b1f7e6b58377
+    """
+    l = tf.convert_to_tensor(l)
+    dtype = dtype if dtype else l.dtype
+    slack = tf.cast(slack, dtype)
+    p = tf.cast(p, dtype)
+    default_val = tf.cast(default_val, dtype)
+    l = tf.cast(l, dtype)
+    if p.shape.rank:
+        extra, axis, p_axes = _config_layout(l.shape.rank, p.shape.rank, axis)
+        l = tf.reshape(l, tf.concat([tf.ones([extra], tf.int32), tf.shape(l)], 0))
+        p_shape = [1] * (l.shape.rank)
+        for p_axis, size in zip(p_axes, tf.unstack(tf.shape(p))):
+            p_shape[p_axis] = size
+        p = tf.reshape(p, tf.stack(p_shape))
+        # every configuration gets its own copy of l, their gradients add up through broadcast_to
+        l = tf.broadcast_to(l, tf.broadcast_dynamic_shape(tf.shape(l), tf.shape(p)))
+    if weights is not None:
+        weights = tf.cast(weights, dtype)
+        weights = weights / tf.reduce_sum(tf.broadcast_to(weights, tf.shape(l)), axis=axis, keepdims=True)
+    tiny = tf.constant(np.finfo(tf.as_dtype(dtype).as_numpy_dtype).tiny, dtype=dtype)
+
+    @tf.custom_gradient
+    def fused_p_mean(l):
+        slacked = tf.maximum(l + slack, tiny)
+        log_x = tf.math.log(slacked)
+        log_mean, shift, n = _log_power_mean(log_x, p, axis, weights)
+        p_meaned = tf.exp(log_mean)
+        # rounding in log space can land just outside the range of the slice, the gradient passes the clip unchanged
+        in_range = tf.clip_by_value(
+            p_meaned, tf.reduce_min(slacked, axis=axis), tf.reduce_max(slacked, axis=axis)
+        )
+        result = tf.where(n == 0, default_val, in_range - slack)
+
+        def grad(dy):
+            # the shares w_i * x_i**p / sum(w * x**p) along axis, the weights themselves for p = 0
+            exps = tf.exp(p * log_x - shift)
+            exps = exps if weights is None else weights * exps
+            shares = exps / tf.reduce_sum(exps, axis=axis, keepdims=True)
+            # elements held at tiny don't move the result, like through tf.maximum
+            shares = tf.where(l + slack < tiny, tf.zeros_like(shares), shares)
+            return tf.reshape(dy * p_meaned, tf.shape(shift)) * shares / slacked
+
+        return result, grad
+
+    return fused_p_mean(l)
+
 @tf.function
 def simple_p_mean(l: tf.Tensor, p: float, axis=0) -> tf.Tensor:
     return tf.reduce_mean(l**p, axis=axis)**(1.0/p)
@@ -89,13 +214,13 @@ def simple_p_mean(l: tf.Tensor, p: float, axis=0) -> tf.Tensor:
 #     return p_mean(l, p, slack, default_val, axis, dtype), lambda dy: dy * tf.ones_like(l), None, None, None
 
 @tf.function
-def inv_mean(l, p=0, axis=0):
-    return 1.0 - p_mean(1.0-tf.convert_to_tensor(l), p, axis=axis)
+def tf_inv_mean(l, p=0, axis=0):
+    return 1.0 - tf_p_mean(1.0-tf.convert_to_tensor(l), p, axis=axis)
 
 @tf.function
 def p_to_min(l, p=0, q=0):
-    deformator = p_mean(1.0 - l, q)
-    return p_mean(l, p) * deformator + (1.0 - deformator) * tf.reduce_min(l)
+    deformator = tf_p_mean(1.0 - l, q)
+    return tf_p_mean(l, p) * deformator + (1.0 - deformator) * tf.reduce_min(l)
 
 
 # @tf.function
@@ -151,20 +276,27 @@ def move_towards_range(x, min, max):
 
     return 1.0 / tf.where(in_range, 1.0, tf.abs(normalized)**0.5), grad
 
+def _cast(value, dtype):
+    """value as a tensor of dtype, Python numbers are converted straight to it instead of through float32"""
+    return tf.cast(value, dtype) if tf.is_tensor(value) else tf.constant(np.asarray(value, dtype.as_numpy_dtype))
+
 @tf.custom_gradient
-def offset(x, slack):
-    slack = tf.cast(slack, x.dtype)
+def _offset(x, slack):
     def grad(dx):
         return dx, None  # Gradient is unaffected by slack
     # Positive slack: scales down and adds to bottom (x*(1-slack) + slack)
     # Negative slack: scales down from top (x*(1+slack))
     return x * (1.0 - tf.abs(slack)) + tf.maximum(slack, 0.0), grad
 
+def tf_offset(x, slack):
+    x = tf.convert_to_tensor(x)
+    return _offset(x, _cast(slack, x.dtype))
+
 @tf.function
-def then(x, y, slack=0.5, p=-1.0):
-    slack = tf.cast(slack, x.dtype)
-    min_p_mean = p_mean([0, slack], p=p)
-    return (p_mean([x,offset(y, slack)], p=p)-min_p_mean)/(1.0 - min_p_mean)
+def tf_then(x, y, slack=0.5, p=-1.0):
+    slack = _cast(slack, x.dtype)
+    min_p_mean = tf_p_mean([0, slack], p=p)
+    return (tf_p_mean([x,tf_offset(y, slack)], p=p, axis=0)-min_p_mean)/(1.0 - min_p_mean)
 
 # def curriculum(values, slack=0.3, p=0.0):
 #     values = list(reversed(values))
@@ -173,21 +305,109 @@ def then(x, y, slack=0.5, p=-1.0):
 #         result = then(value, result, slack=slack/2**i, p=p)
 #     return result
 
-def curriculum(values, slack=0.1, p=-1.0):
+def tf_curriculum(values, slack=0.1, p=-1.0):
     values = tf.convert_to_tensor(values)
     slacked = slack*(1-0.5**tf.range(tf.shape(values)[0], dtype=values.dtype))
-    min_curr = p_mean(slacked, p=p)
-    return (p_mean(offset(values, slacked), p=p) - min_curr)/(1.0 - min_curr)
+    min_curr = tf_p_mean(slacked, p=p)
+    return (tf_p_mean(tf_offset(values, slacked), p=p) - min_curr)/(1.0 - min_curr)
 
 
 @tf.function
-def weaken(x, weaken_by=5.0):
-    return 1.0 - (1.0-x)**tf.cast(weaken_by, x.dtype)
+def tf_weaken(x, weaken_by=5.0):
+    return 1.0 - (1.0-x)**_cast(weaken_by, x.dtype)
 
 @tf.function
-def clip_to(val, min, max, to_min=0.0, to_max=1.0):
+def tf_clip_to(val, min, max, to_min=0.0, to_max=1.0):
     return tf.clip_by_value((val-min)/(max-min), 0.0, 1.0)*(to_max-to_min) + to_min
 
+
+def np_p_mean(l, p: float, slack=1e-7, default_val=0.0, axis=None, dtype=None, weights=None) -> np.ndarray:
+    """
+    NumPy version of tf_p_mean, computed the same way in log space, float64 unless l or dtype
+    is another floating type
+    """
+    l = np.asarray(l)
+    dtype = np.dtype(getattr(dtype, "as_numpy_dtype", dtype)) if dtype else l.dtype
+    dtype = dtype if np.issubdtype(dtype, np.floating) else np.dtype(np.float64)
+    l = l.astype(dtype, copy=False)
+    p = np.asarray(p, dtype=dtype)
+    if p.ndim:
+        extra, axis, p_axes = _config_layout(l.ndim, p.ndim, axis)
+        l = np.reshape(l, (1,) * extra + l.shape)
+        p_shape = [1] * l.ndim
+        for p_axis, size in zip(p_axes, p.shape):
+            p_shape[p_axis] = size
+        p = np.reshape(p, p_shape)
+        l = np.broadcast_to(l, np.broadcast_shapes(l.shape, p.shape))
+        axis = tuple(axis)
+    if l.size == 0:
+        return np.full(np.sum(l, axis=axis).shape, default_val, dtype=dtype)
+    if weights is None:
+        mean = partial(np.mean, axis=axis, keepdims=True)
+    else:
+        weights = np.asarray(weights, dtype=dtype)
+        weights = weights / np.sum(np.broadcast_to(weights, l.shape), axis=axis, keepdims=True)
+        mean = lambda values: np.sum(weights * values, axis=axis, keepdims=True)
+    slacked = np.maximum(l + dtype.type(slack), np.finfo(dtype).tiny)
+    log_x = np.log(slacked)
+    # p = 0 is the geometric mean, the limit of the log space formula
+    log_mean = mean(log_x) if np.any(p == 0) else 0.0
+    if np.any(p != 0):
+        safe_p = np.where(p == 0, dtype.type(1.0), p)
+        scaled = safe_p * log_x
+        shift = np.max(scaled, axis=axis, keepdims=True)
+        relative = np.log1p(mean(np.expm1(scaled - shift)))
+        log_mean = np.where(p == 0, log_mean, (shift + relative) / safe_p)
+    p_meaned = np.clip(np.exp(log_mean), np.min(slacked, axis=axis, keepdims=True), np.max(slacked, axis=axis, keepdims=True))
+    return np.squeeze(p_meaned, axis=axis) - dtype.type(slack)
+
+def np_inv_mean(l, p=0, axis=0):
+    return 1.0 - np_p_mean(1.0 - np.asarray(l), p, axis=axis)
+
+def np_offset(x, slack):
+    return x * (1.0 - np.abs(slack)) + np.maximum(slack, 0.0)
+
+def np_then(x, y, slack=0.5, p=-1.0):
+    min_p_mean = np_p_mean([0.0, slack], p=p)
+    return (np_p_mean([x, np_offset(y, slack)], p=p, axis=0)-min_p_mean)/(1.0 - min_p_mean)
+
+def np_curriculum(values, slack=0.1, p=-1.0):
+    values = np.asarray(values, dtype=np.float64)
+    slacked = slack*(1-0.5**np.arange(len(values)))
+    min_curr = np_p_mean(slacked, p=p)
+    return (np_p_mean(np_offset(values, slacked), p=p) - min_curr)/(1.0 - min_curr)
+
+def np_weaken(x, weaken_by=5.0):
+    return 1.0 - (1.0-np.asarray(x))**weaken_by
+
+def np_clip_to(val, min, max, to_min=0.0, to_max=1.0):
+    return np.clip((val-min)/(max-min), 0.0, 1.0)*(to_max-to_min) + to_min
+
+
+def uses_tf(*values) -> bool:
+    """Whether any of values, or of the elements of the lists and tuples among them, is a TF tensor or variable"""
+    return any(
+        uses_tf(*value) if isinstance(value, (list, tuple)) else tf.is_tensor(value)
+        for value in values
+    )
+
+def dual_backend(np_fn, tf_fn):
+    """The operator that runs tf_fn when any argument is a TF tensor or variable, np_fn otherwise"""
+    @wraps(np_fn)
+    def operator(*args, **kwargs):
+        return (tf_fn if uses_tf(*args, *kwargs.values()) else np_fn)(*args, **kwargs)
+    operator.__name__ = operator.__qualname__ = np_fn.__name__[len("np_"):]
+    operator.__doc__ = tf_fn.__doc__ or np_fn.__doc__
+    return operator
+
+p_mean = dual_backend(np_p_mean, tf_p_mean)
+inv_mean = dual_backend(np_inv_mean, tf_inv_mean)
+offset = dual_backend(np_offset, tf_offset)
+then = dual_backend(np_then, tf_then)
+curriculum = dual_backend(np_curriculum, tf_curriculum)
+weaken = dual_backend(np_weaken, tf_weaken)
+clip_to = dual_backend(np_clip_to, tf_clip_to)
+
 # if __name__ == "__main__":
 #     import matplotlib.pyplot as plt
 #     with tf.GradientTape() as gt:
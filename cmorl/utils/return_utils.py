@@ -0,0 +1,103 @@
+"""
+
+Vectorized discounted and truncated (windowed) returns.
+
+Everything works along the time axis of either a single episode, rewards of shape (T, ...),
+or of a padded batch of episodes, rewards of shape (B, T, ...) together with their lengths.
+The returns are computed as reverse cumulative sums inside blocks, the value carried from one
+block into the previous one is again a discounted return over the block starts, so the work
+stays O(T) without a Python loop over the steps.
+
+"""
+import numpy as np
+
+# the smallest power of gamma a block scales its rewards by, so dividing by the powers again
+# never meets an underflow to 0
+_MIN_POWER = 1e-150
+
+
+def _block_length(gamma, block_size):
+    """The largest length up to block_size whose powers gamma**k (k < length) stay above _MIN_POWER"""
+    if gamma >= 1.0:
+        return block_size
+    return int(min(block_size, 1 + np.floor(np.log(_MIN_POWER) / np.log(gamma))))
+
+
+def _reverse_discounted_cumsum(x, gamma, block_size):
+    """G[t] = x[t] + gamma * G[t+1] along axis 0 of x"""
+    if gamma == 0.0 or x.shape[0] == 0:
+        return x.copy()
+    length = x.shape[0]
+    block_size = _block_length(gamma, block_size)
+    if block_size == 1:
+        # gamma itself is below _MIN_POWER, only ever the case for the carries of tiny gammas
+        returns = x.copy()
+        for t in range(length - 2, -1, -1):
+            returns[t] += gamma * returns[t + 1]
+        return returns
+    if length <= block_size:
+        powers = (gamma ** np.arange(length)).reshape(-1, *[1] * (x.ndim - 1))
+        return np.cumsum((x * powers)[::-1], axis=0)[::-1] / powers
+    n_blocks = -(-length // block_size)
+    padded = np.zeros((n_blocks * block_size, *x.shape[1:]), dtype=x.dtype)
+    padded[:length] = x
+    blocks = padded.reshape(n_blocks, block_size, *x.shape[1:])
+    powers = (gamma ** np.arange(block_size)).reshape(1, -1, *[1] * (x.ndim - 1))
+    local = np.cumsum((blocks * powers)[:, ::-1], axis=1)[:, ::-1] / powers
+    # the return at the start of every block, recursing over the (block_size times fewer) blocks
+    block_starts = _reverse_discounted_cumsum(local[:, 0], gamma**block_size, block_size)
+    next_starts = np.concatenate([block_starts[1:], np.zeros_like(block_starts[:1])])
+    returns = local + (gamma * powers[:, ::-1]) * next_starts[:, None]
+    return returns.reshape(-1, *x.shape[1:])[:length]
+
+
+def _prepare(rewards, gamma, bootstrap, lengths):
+    """
+    Moves time to the front, zeroes the padding and adds the discounted bootstrap to the
+    last step of every episode. Returns the rewards and the time axis of the input.
+    """
+    rewards = np.array(rewards, dtype=np.float64)
+    if lengths is None:
+        if bootstrap is not None and rewards.shape[0] > 0:
+            rewards[-1] += gamma * np.asarray(bootstrap, dtype=np.float64)
+        return rewards, 0
+    lengths = np.asarray(lengths)
+    mask = np.arange(rewards.shape[1])[None, :] < lengths[:, None]
+    mask = mask.reshape(*mask.shape, *[1] * (rewards.ndim - 2))
+    rewards = np.where(mask, rewards, 0.0)
+    if bootstrap is not None:
+        episodes = np.flatnonzero(lengths > 0)
+        rewards[episodes, lengths[episodes] - 1] += gamma * np.asarray(
+            bootstrap, dtype=np.float64
+        )[episodes]
+    return np.moveaxis(rewards, 1, 0), 1
+
+
+def discounted_returns(rewards, gamma, bootstrap=None, lengths=None, block_size=64):
+    """
+    Returns G[t] = rewards[t] + gamma * G[t+1] for every step.
+
+    Args:
+        rewards: (T, ...) rewards of one episode, or (B, T, ...) rewards of a padded batch.
+
+        bootstrap: The value of the state after the last step (per episode for a batch),
+            zero when omitted, i.e. the episode terminated.
+
+        lengths: (B,) lengths of the episodes of a padded batch, the returns of the
+            padding are zero.
+    """
+    rewards, axis = _prepare(rewards, gamma, bootstrap, lengths)
+    return np.moveaxis(_reverse_discounted_cumsum(rewards, gamma, block_size), 0, axis)
+
+
+def truncated_returns(rewards, gamma, window, bootstrap=None, lengths=None, block_size=64):
+    """
+    Returns sum_{k<window} gamma**k * rewards[t+k] for every step. Windows reaching past the
+    end of an episode also get the discounted ``bootstrap``, same arguments as discounted_returns.
+    """
+    rewards, axis = _prepare(rewards, gamma, bootstrap, lengths)
+    returns = _reverse_discounted_cumsum(rewards, gamma, block_size)
+    if np.isfinite(window) and window < len(returns):
+        window = int(window)
+        returns[:-window] -= gamma**window * returns[window:]
+    return np.moveaxis(returns, 0, axis)
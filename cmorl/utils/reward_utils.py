@@ -5,7 +5,8 @@ import gymnasium as gym
 from typing import TypeAlias
 
 import tensorflow as tf # type: ignore
-from cmorl.utils.loss_composition import p_mean
+from cmorl.utils.loss_composition import p_mean, per_config
+from cmorl.utils.return_utils import discounted_returns, truncated_returns
 
 
 class Transition(NamedTuple):
@@ -26,6 +27,20 @@ def random_transition(env: gym.Env):
 
 EnvType = TypeVar('EnvType', bound=gym.Env)
 RewardFnType: TypeAlias = Callable[[Transition, EnvType], float|np.ndarray]
+# gets the transitions stacked along a first (T) axis, with the info dicts stacked by stack_infos
+BatchedRewardFnType: TypeAlias = Callable[[Transition, EnvType], np.ndarray]
+
+def stack_infos(infos: list[dict]) -> dict:
+    """The keys every info dict has, with their values stacked along a new first axis"""
+    if not infos:
+        return {}
+    stacked = {}
+    for key in set(infos[0]).intersection(*infos[1:]):
+        try:
+            stacked[key] = np.stack([np.asarray(info[key]) for info in infos])
+        except ValueError:  # values of different shapes
+            pass
+    return stacked
 
 def discounted_sum(gamma, minimum=0, maximum=np.inf):
     return (gamma**minimum)*(1-gamma**(maximum-minimum+1))/(1-gamma)
@@ -34,36 +49,33 @@ def discounted_window(rewards, gamma, axis=0, normalize=True, done=True, window_
     """
         discounts the rewards in the axis dimension of the rewards array by a window of size window_size
         example: rewards = [r1, r2, r3], window_size=2 -> [r1 + gamma*r2, r2 + gamma*r3, r3]
+        an episode that didn't end keeps receiving its last reward forever, the windows reaching its end get that too
     """
-    axis_front = np.swapaxes(np.array(rewards), 0, axis)
-    axis_size = axis_front.shape[0]
-    broadcast_shape = [axis_size] + [1]*(axis_front.ndim-1)
-    indices = np.arange(axis_size).reshape(*broadcast_shape)
+    time_first = np.moveaxis(np.asarray(rewards), axis, 0)
+    bootstrap = None if done else time_first[-1]*discounted_sum(gamma)
     normalization_factor = (1.0 - gamma) if normalize else 1.0
-    with_discounts = axis_front*discounted_sum(gamma, np.maximum(indices-(window_size-1),0), indices)
-    if not done:
-        with_discounts[-1] *= discounted_sum(gamma)
-    unswapped = np.swapaxes(with_discounts, 0, axis)
-    return  unswapped*normalization_factor
+    windows = truncated_returns(time_first, gamma, window_size, bootstrap=bootstrap)
+    return np.moveaxis(windows, 0, axis)*normalization_factor
 
 def values(rewards, gamma, normalize=True, done=True):
-    rev_rewards = rewards[::-1]
-    rev_values = np.zeros_like(rewards)
-    rev_values[0] = rev_rewards[0] * (1 if done else discounted_sum(gamma))
-    for i in range(1, rev_rewards.shape[0]):
-        rev_values[i] = rev_rewards[i] + gamma*rev_values[i-1]
+    rewards = np.asarray(rewards)
+    # an episode that didn't end keeps receiving its last reward forever
+    bootstrap = None if done else rewards[-1]*discounted_sum(gamma)
     normalization_factor = ((1.0 - gamma) if normalize else 1.0)
-    return rev_values[::-1]*normalization_factor
+    returns = discounted_returns(rewards, gamma, bootstrap=bootstrap)*normalization_factor
+    return returns.astype(rewards.dtype if np.issubdtype(rewards.dtype, np.floating) else np.float64)
 
 def estimated_value_fn(rewards, gamma, done=True, normalize=True, axis=0):
-    return np.mean(discounted_window(rewards, gamma, done=done, normalize=normalize, axis=axis, window_size=np.inf), axis=axis)
+    """The mean over the axis dimension of the values from every step of the episode"""
+    time_first = np.moveaxis(np.asarray(rewards), axis, 0)
+    return np.mean(values(time_first, gamma, normalize=normalize, done=done), axis=0)
 
 @tf.function
 def default_q_composer(q_values, p_batch=0, p_objectives=-4.0, scalarize_batch_first=True):
     qs_c = p_mean(q_values,
-                  p=p_batch if scalarize_batch_first else p_objectives,
+                  p=per_config(p_batch if scalarize_batch_first else p_objectives),
                   axis=0 if scalarize_batch_first else 1, slack=1e-7)
-    q_c = p_mean(qs_c, p=p_objectives if scalarize_batch_first else p_batch, slack=1e-7)
+    q_c = p_mean(qs_c, p=p_objectives if scalarize_batch_first else p_batch, axis=-1, slack=1e-7)
     return qs_c, q_c
 
 
@@ -74,11 +86,24 @@ def perf_schedule(t, total_steps, perf):
     return 1.0-perf
 
 class CMORL:
-    def __init__(self, reward_fn: RewardFnType, q_composer: Callable = default_q_composer, shape: int | None = None, randomization_schedule = perf_schedule):
+    """
+    reward_fn computes the reward vector of a single transition. batched_reward_fn optionally
+    computes the (T, rew_dims) rewards of T stacked transitions at once, it can only be given for
+    reward fns that depend on the transition alone and not on the env's current state.
+    info_keys are the keys of the step infos the reward fns read, they are stored with the
+    transitions so the rewards can be recomputed later (see ``relabel``).
+    """
+    def __init__(self, reward_fn: RewardFnType, q_composer: Callable = default_q_composer, shape: int | None = None, randomization_schedule = perf_schedule, batched_reward_fn: BatchedRewardFnType | None = None, info_keys: tuple[str, ...] = ()):
         self.reward_fn = reward_fn
         self.q_composer = q_composer
         self.shape = shape
         self.randomization_schedule = randomization_schedule
+        self.batched_reward_fn = batched_reward_fn
+        self.info_keys = tuple(info_keys)
+
+    @property
+    def batched(self):
+        return self.batched_reward_fn is not None
 
     def calculate_space(self, env):
         if self.shape is not None:
@@ -86,15 +111,57 @@ class CMORL:
         example_rw = self.reward_fn(random_transition(env), env)
         return gym.spaces.Box(low = 0.0, high=1.0, shape=example_rw.shape, dtype=example_rw.dtype) 
 
-    def with_reward_fn(self, reward_fn):
-        return CMORL(reward_fn, self.q_composer, self.shape, self.randomization_schedule)
+    def with_reward_fn(self, reward_fn, batched_reward_fn=None, info_keys=()):
+        return CMORL(reward_fn, self.q_composer, self.shape, self.randomization_schedule, batched_reward_fn, info_keys)
 
     def with_q_composer(self, q_composer):
-        return CMORL(self.reward_fn, q_composer, self.shape, self.randomization_schedule)
+        return CMORL(self.reward_fn, q_composer, self.shape, self.randomization_schedule, self.batched_reward_fn, self.info_keys)
 
     def with_randomization_schedule(self, randomization_schedule):
-        return CMORL(self.reward_fn, self.q_composer, self.shape, randomization_schedule)
+        return CMORL(self.reward_fn, self.q_composer, self.shape, randomization_schedule, self.batched_reward_fn, self.info_keys)
 
     def __call__(self, transition: Transition, env: gym.Env):
         return self.reward_fn(transition, env)
 
+    def batch(self, states, actions, next_states, dones, infos: list[dict], env: gym.Env) -> np.ndarray:
+        """
+        The (T, rew_dims) rewards of T transitions given as stacked arrays and a list of info dicts.
+        Without a batched_reward_fn the reward fn is called once per transition.
+        """
+        if self.batched_reward_fn is not None:
+            transitions = Transition(np.asarray(states), np.asarray(actions), np.asarray(next_states), np.asarray(dones), stack_infos(infos))
+            return np.asarray(self.batched_reward_fn(transitions, env), dtype=np.float32)
+        return np.array([self.reward_fn(Transition(*transition), env) for transition in zip(states, actions, next_states, dones, infos)])
+
+    def relabel(self, transitions: Transition, env: gym.Env) -> np.ndarray:
+        """
+        The (T, rew_dims) rewards of stored transitions, whose info holds the stacked info_keys.
+        Only a batched reward fn can do that, the others may read the env's state at step time.
+        """
+        if self.batched_reward_fn is None:
+            raise ValueError("relabeling stored transitions needs a batched_reward_fn")
+        return np.asarray(self.batched_reward_fn(transitions, env), dtype=np.float32)
+
+
+class CMORLRewardWrapper(gym.Wrapper):
+    """
+    Computes the CMORL reward inside ``step`` and stores it in ``info["cmorl_reward"]``.
+    Vector envs autoreset right after the last step of an episode, so the reward has to be
+    evaluated before that happens for reward fns that read the env's state.
+    """
+    def __init__(self, env: gym.Env, cmorl: CMORL):
+        super().__init__(env)
+        self.cmorl = cmorl
+        self.last_obs = None
+
+    def reset(self, **kwargs):
+        obs, info = self.env.reset(**kwargs)
+        self.last_obs = obs
+        return obs, info
+
+    def step(self, action):
+        obs, reward, done, truncated, info = self.env.step(action)
+        info["cmorl_reward"] = self.cmorl(Transition(self.last_obs, action, obs, done, info), self.env)
+        self.last_obs = obs
+        return obs, reward, done, truncated, info
+
@@ -1,9 +1,11 @@
 import argparse
 import json
 import os
+import shutil
+import threading
 import time
+import numpy as np
 from keras import models, Model, config # type: ignore
-import pickle
 from cmorl.utils.args_utils import Arg_Serializer, get_minified_args_dict
 from pathlib import Path
 from cmorl.utils.serialization_utils import ExtraTypesEncoder
@@ -55,11 +57,34 @@ def concatenate_lists(list_of_lists):
 def get_env_name_from_folder(folder):
     return folder.parents[5].name
 
-def on_save(actor: Model, q_network: Model, epoch:int, save_path:str):
+class ReplaySnapshotWriter:
+    """Writes replay snapshots on a background thread, a new one first waits for the previous"""
+    def __init__(self):
+        self.thread = None
+
+    def save(self, folder, arrays, header):
+        self.wait()
+        self.thread = threading.Thread(target=save_replay, args=(folder, arrays, header))
+        self.thread.start()
+
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+replay_writer = ReplaySnapshotWriter()
+
+def seed_folder(save_path):
+    """The folder above the epoch folders, the latest replay snapshot and checkpoint sit there"""
+    return Path(save_path).parent
+
+def on_save(actor: Model, q_network: Model, epoch:int, save_path:str, replay_snapshot=None):
     epoch_path = Path(save_path, str(epoch))
     os.makedirs(epoch_path, exist_ok=True)
     actor.save(epoch_path / "actor.keras")
     q_network.save(epoch_path / "critic.keras")
+    if replay_snapshot is not None:
+        replay_writer.save(seed_folder(save_path), *replay_snapshot)
 
 def load_critic(folder):
     return models.load_model(Path(folder, "critic.keras"))
@@ -67,5 +92,66 @@ def load_critic(folder):
 def load_actor(folder):
     return models.load_model(Path(folder, "actor.keras"))
 
+def replay_path(folder):
+    """The folder of the latest replay snapshot in folder, named by folder/replay.pointer"""
+    pointer = Path(folder, "replay.pointer")
+    if pointer.exists():
+        return Path(folder, pointer.read_text().strip())
+    # snapshots written before the pointer file
+    return Path(folder, "replay")
+
+def save_replay(folder, arrays: dict[str, np.ndarray], header: dict):
+    """
+    Writes a replay snapshot to a new folder/replay.<version>: a .npy file per field and
+    header.json. Once it's complete the pointer file is atomically replaced to name it, then the
+    older snapshots are deleted, so a crash at any point leaves the previous snapshot readable.
+    """
+    name = f"replay.{time.time_ns()}"
+    path = Path(folder, name)
+    os.makedirs(path)
+    for field, array in arrays.items():
+        np.save(path / f"{field}.npy", array)
+    with open(path / "header.json", "w") as f:
+        json.dump(header, f, cls=ExtraTypesEncoder)
+    tmp_pointer = Path(folder, f"replay.pointer.tmp{os.getpid()}")
+    tmp_pointer.write_text(name)
+    os.replace(tmp_pointer, Path(folder, "replay.pointer"))
+    # the previous snapshot, and any a crash left behind before its pointer was written
+    for stale in [Path(folder, "replay"), *Path(folder).glob("replay.*")]:
+        if stale.is_dir() and stale != path:
+            shutil.rmtree(stale, ignore_errors=True)
+
+def has_replay(folder):
+    return Path(replay_path(folder), "header.json").exists()
+
+def load_replay_header(folder):
+    with open(Path(replay_path(folder), "header.json")) as f:
+        return json.load(f)
+
+def has_checkpoint(folder):
+    """Whether folder holds a full training state to resume, not only a replay snapshot"""
+    return has_replay(folder) and "training" in load_replay_header(folder)
+
+def resume_seed(experiment_name, cmd_args, serializer:Arg_Serializer):
+    """
+    The seed of the run --resume continues: --seed when it's given, otherwise the only seed
+    folder of these hyperparameters that holds a checkpoint. Fails when there's nothing to resume.
+    """
+    hypers = vars(cmd_args)
+    seeds_folder = Path(serializer.get_seed_folder_path(experiment_name, hypers)).parent
+    # the default seed is drawn at random, so a seed equal to it wasn't given
+    if cmd_args.seed != serializer.name_to_args()["seed"].default:
+        if not has_checkpoint(seeds_folder / str(cmd_args.seed)):
+            raise FileNotFoundError(f"--resume found no checkpoint in {seeds_folder / str(cmd_args.seed)}")
+        return cmd_args.seed
+    seeds = sorted(int(folder.name) for folder in seeds_folder.glob("*/") if has_checkpoint(folder))
+    if not seeds:
+        raise FileNotFoundError(f"--resume found no checkpoint in {seeds_folder}")
+    if len(seeds) > 1:
+        raise ValueError(f"--resume found checkpoints of the seeds {seeds} in {seeds_folder}, pick one with --seed")
+    return seeds[0]
+
 def load_replay(folder):
-    return pickle.load(open(Path(folder, "replay.p"), "rb"))
+    """The fields of the latest snapshot in folder as copy-on-write memory maps, and its header"""
+    path = replay_path(folder)
+    return {file.stem: np.load(file, mmap_mode="c") for file in path.glob("*.npy")}, load_replay_header(folder)
@@ -1,7 +1,7 @@
 from collections import deque
 import glob
 from cmorl.configs import ForcedTimeLimit
-from cmorl.rl_algs.ddpg.ddpg import add_noise_to_weights
+from cmorl.rl_algs.ddpg.core import PerturbedActor
 from cmorl.utils import save_utils
 import numpy as np
 import tensorflow as tf
@@ -45,6 +45,10 @@ def test(
     rs = deque()
     cmorl_rs = deque()
     actions = deque()
+    # batched reward fns get the whole episode at once
+    next_os = deque()
+    dones = deque()
+    infos = deque()
     while True:
         action = actor(o, np_random)
         # print(action)
@@ -53,7 +57,11 @@ def test(
         os.append(o)
         o2, r, d, t, i = env.step(action)
         rs.append(r)
-        if cmorl:
+        if cmorl and cmorl.batched:
+            next_os.append(o2)
+            dones.append(d)
+            infos.append(i)
+        elif cmorl:
             transition = Transition(o, action, o2, d, i)
             cmorl_r = cmorl(transition, env)
             cmorl_rs.append(cmorl_r)
@@ -66,13 +74,16 @@ def test(
             # print(f"action: {action}")
             # print(f"o: {o}")
             # print(f"r: {r}")
-            if cmorl and debug:
+            if cmorl and debug and not cmorl.batched:
                 qs, q_c = cmorl.q_composer([cmorl_r])
                 print(f"cmorl_qs: {(np.asarray(q_c), np.asarray(qs))}")
     actions = np.array(actions)
     rs = np.array(rs)
     os = np.array(os)
-    cmorl_rs = np.array(cmorl_rs)
+    if cmorl and cmorl.batched:
+        cmorl_rs = cmorl.batch(os, actions, np.array(next_os), np.array(dones), list(infos), env)
+    else:
+        cmorl_rs = np.array(cmorl_rs)
     qs = np.array(critic(os, actions))
     np.set_printoptions(precision=2)
     rsum = np.sum(rs)
@@ -109,29 +120,31 @@ def folder_to_results(
 ):
     saved_actor = save_utils.load_actor(folder_path)
     saved_critic = save_utils.load_critic(folder_path)
+    perturbed_actor = PerturbedActor(saved_actor, env.action_space)
 
     def actor(x, np_random):
-        return add_noise_to_weights(
-            x, saved_actor, env.action_space, act_noise, np_random
-        )
+        return perturbed_actor.act(x).numpy()
 
     def critic(o, a):
         return saved_critic(np.hstack([o, a], dtype=np.float32))
 
-    runs = [
-        test(
+    def run_test(seed):
+        # one noise sample per test episode
+        perturbed_actor.generator.reset_from_seed(seed)
+        perturbed_actor.resample(act_noise)
+        return test(
             actor,
             critic,
             env,
-            seed=17 + i,
+            seed=seed,
             render=render,
             force_truncate_at=force_truncate_at,
             cmorl=cmorl,
             max_ep_len=max_ep_len,
             debug=debug
         )
-        for i in range(num_tests)
-    ]
+
+    runs = [run_test(17 + i) for i in range(num_tests)]
 
     return runs
 
@@ -8,13 +8,17 @@ def create_train_folder_and_params(env_name, cmd_args, serializer: Arg_Serialize
     Sets up the folders for the experiment and trains the agent.
     """
 
+    experiment_name = f"{env_name}/{cmd_args.experiment_name}"
+    if cmd_args.resume:
+        cmd_args.seed = save_utils.resume_seed(experiment_name, cmd_args, serializer)
     # Create the folders
-    save_path, semantic_name = save_utils.save_hypers(f"{env_name}/{cmd_args.experiment_name}", cmd_args, serializer)
+    save_path, semantic_name = save_utils.save_hypers(experiment_name, cmd_args, serializer)
     generated_params = {
         "env_name": env_name,
         "experiment_name": f"{cmd_args.experiment_name}({semantic_name})",
         "hp": cmd_args,
         "on_save": partial(save_utils.on_save, save_path=save_path),
+        "checkpoint_dir": save_utils.seed_folder(save_path),
         "logger_kwargs": {"output_dir": save_path},
     }
     if cmd_args.prev_folder:
@@ -3,11 +3,7 @@ import gymnasium as gym
 import numpy as np
 import pybullet as p
 import pybullet_data
-
-def p_mean(values, p, axis=None, slack=1e-7):
-    """Calculate mean of values with power p."""
-    array = np.asarray(values) + slack
-    return np.mean(np.abs(array)**p, axis=axis)**(1.0/p) - slack
+from cmorl.utils.loss_composition import p_mean
 
 class OpenCatGymEnv(gym.Env):
     """Gymnasium environment for OpenCat robots."""
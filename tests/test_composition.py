@@ -0,0 +1,137 @@
+import numpy as np
+import pytest
+import tensorflow as tf
+from cmorl import reward_fns
+from cmorl.utils.composition import (
+    AND,
+    CLIP,
+    CURRICULUM,
+    OFFSET,
+    OR,
+    POW,
+    THEN,
+    TF_BACKEND,
+    Composer,
+    evaluate,
+    objective,
+    simplify,
+)
+from cmorl.utils.loss_composition import offset, p_mean, tf_curriculum, tf_then
+
+
+# the hand-written composers the composition trees of reward_fns replaced, as they were
+def old_reacher_composer(q_values, p_batch=0, p_objectives=-1.0):
+    qs_batch = tf.transpose(q_values)
+    reach = qs_batch[0]**2.0
+    smoothness = p_mean(qs_batch[1:], p=0.0, axis=0)
+    combined = p_mean([reach, smoothness], p=p_objectives, axis=0)
+    q_c = p_mean(combined, p=p_batch, axis=0)
+    return p_mean([smoothness, reach], p=p_batch, axis=-1), q_c
+
+
+def old_pendulum_composer(q_values, p_batch=0, p_objectives=-4.0):
+    qs_batch = tf.transpose(q_values)
+    angle = qs_batch[0]**2.0
+    actuation = qs_batch[1]
+    q_c = p_mean(p_mean([angle, actuation], p=p_objectives, axis=0), p=p_batch, axis=0)
+    return p_mean([angle, actuation], p=p_batch, axis=0), q_c
+
+
+def old_lander_composer(q_values, p_batch=0, p_objectives=-4.0):
+    clipped = reward_fns.clip_objectives(tf.transpose(q_values))
+    q_c = p_mean(p_mean(clipped, p=p_objectives, axis=0), p=p_batch, axis=0)
+    qs_c = p_mean(clipped, p=p_batch, axis=1)
+    return qs_c, q_c
+
+
+def old_then_composer(q_values, p_batch=0, p_objectives=-4.0):
+    qs_batch = tf.transpose(q_values)
+    second = offset(tf.clip_by_value(qs_batch[1] / 0.7, 0.0, 1.0), 0.2)
+    combined = tf_then(qs_batch[0], p_mean([second, qs_batch[2]], p=p_objectives, axis=0), slack=0.3)
+    return None, p_mean(combined, p=p_batch, axis=0)
+
+
+PAIRS = {
+    "reacher": (reward_fns.reacher_composer, old_reacher_composer, 3),
+    "pendulum": (reward_fns.pendulum_composer, old_pendulum_composer, 2),
+    "lander": (reward_fns.lander_composer, old_lander_composer, 6),
+    "then": (
+        Composer(THEN(objective(0), AND(OFFSET(CLIP(objective(1), 0.0, 0.7), 0.2), objective(2)), slack=0.3)),
+        old_then_composer,
+        3,
+    ),
+}
+
+
+def value_and_gradient(composer, q_values, **kwargs):
+    with tf.GradientTape() as tape:
+        tape.watch(q_values)
+        qs_c, q_c = composer(q_values, **kwargs)
+    return qs_c, q_c, tape.gradient(q_c, q_values)
+
+
+@pytest.mark.parametrize("name", PAIRS)
+@pytest.mark.parametrize("p_batch, p_objectives", [(0.0, -4.0), (1.0, -1.0), (-2.0, 0.0)])
+def test_composers_match_the_hand_written_ones(name, p_batch, p_objectives):
+    composer, old_composer, objectives = PAIRS[name]
+    q_values = tf.constant(np.random.default_rng(0).uniform(0.0, 1.0, (64, objectives)), tf.float32)
+
+    qs_c, q_c, gradient = value_and_gradient(composer, q_values, p_batch=p_batch, p_objectives=p_objectives)
+    old_qs_c, old_q_c, old_gradient = value_and_gradient(
+        old_composer, q_values, p_batch=p_batch, p_objectives=p_objectives
+    )
+
+    np.testing.assert_allclose(q_c, old_q_c, rtol=1e-5, atol=1e-7)
+    np.testing.assert_allclose(gradient, old_gradient, rtol=1e-4, atol=1e-7)
+    if name == "pendulum":
+        # the old one reduced the objectives of every sample instead of the batch of every
+        # objective, its qs_c had a column per sample
+        assert old_qs_c.shape == (64,)
+        old_qs_c = p_mean(tf.stack([q_values[:, 0] ** 2.0, q_values[:, 1]]), p=p_batch, axis=-1)
+    if old_qs_c is not None:
+        np.testing.assert_allclose(qs_c, old_qs_c, rtol=1e-5, atol=1e-7)
+
+
+def test_offset_passes_the_gradient_through():
+    # offsets on top of affine maps still pass the gradient of the maps below them
+    tree = OFFSET(OFFSET(CLIP(objective(0), 0.0, 0.5, 0.0, 0.8), 0.3), -0.2)
+    columns = tf.constant(np.linspace(0.05, 0.45, 5)[None])
+    with tf.GradientTape() as tape:
+        tape.watch(columns)
+        value = evaluate(simplify(tree), columns, -4.0, TF_BACKEND, {})
+    expected = offset(offset(np.clip(columns.numpy()[0] / 0.5, 0.0, 1.0) * 0.8, 0.3), -0.2)
+    np.testing.assert_allclose(value, expected, rtol=1e-12)
+    np.testing.assert_allclose(tape.gradient(value, columns), np.full((1, 5), 0.8 / 0.5), rtol=1e-12)
+
+
+@pytest.mark.parametrize("p", [-4.0, -1.0, 0.0, 1.0])
+@pytest.mark.parametrize("slack", [0.1, 0.3])
+def test_curriculum_matches_loss_composition(p, slack):
+    rows = np.random.default_rng(1).uniform(0.0, 1.0, (8, 4))
+    tree = simplify(CURRICULUM(*(objective(i) for i in range(4)), slack=slack, p=p))
+    columns = tf.constant(rows.T)
+    with tf.GradientTape() as tape:
+        tape.watch(columns)
+        value = evaluate(tree, columns, -4.0, TF_BACKEND, {})
+    gradient = tape.gradient(value, columns)
+    for row, row_value, row_gradient in zip(rows, value, tf.transpose(gradient)):
+        row = tf.constant(row)
+        with tf.GradientTape() as tape:
+            tape.watch(row)
+            expected = tf_curriculum(row, slack=slack, p=p)
+        np.testing.assert_allclose(row_value, expected, rtol=1e-9)
+        np.testing.assert_allclose(row_gradient, tape.gradient(expected, row), rtol=1e-6)
+
+
+def test_trees_compute_the_same_rewards_in_numpy():
+    tree = OR(
+        THEN(objective(0), POW(objective(1), 0.5)),
+        CURRICULUM(objective(2), OFFSET(objective(3), 0.1), slack=0.2),
+        p=-2.0,
+    )
+    composer = Composer(tree)
+    rewards = np.random.default_rng(2).uniform(0.0, 1.0, (16, 4))
+    columns = tf.constant(rewards.T)
+    np.testing.assert_allclose(
+        composer.reward(rewards), evaluate(composer.tree, columns, -4.0, TF_BACKEND, {}), rtol=1e-9
+    )
@@ -0,0 +1,73 @@
+import numpy as np
+import tensorflow as tf
+from gymnasium import spaces
+from cmorl.rl_algs.ddpg import core
+
+OBS_SPACE = spaces.Box(-2.0, 2.0, (4,))
+ACT_SPACE = spaces.Box(np.array([-1.0, 0.0]), np.array([1.0, 3.0]))
+
+
+def make_actor():
+    return core.actor(OBS_SPACE, ACT_SPACE, [16, 16], OBS_SPACE.high, seed=0)
+
+
+def scaled(actor, obs):
+    minus_1_to_1 = actor(obs).numpy()
+    return minus_1_to_1 * (ACT_SPACE.high - ACT_SPACE.low) / 2.0 + (ACT_SPACE.high + ACT_SPACE.low) / 2.0
+
+
+def test_perturbed_actor_keeps_its_noise_until_resampled():
+    actor = make_actor()
+    obs = np.random.default_rng(0).uniform(-2.0, 2.0, (8, 4)).astype(np.float32)
+    perturbed = core.PerturbedActor(actor, ACT_SPACE, seed=1)
+
+    # without noise it acts like the actor
+    np.testing.assert_allclose(perturbed.act_batch(obs), scaled(actor, obs), rtol=1e-5, atol=1e-6)
+
+    perturbed.resample(0.1)
+    actions = perturbed.act_batch(obs).numpy()
+    assert not np.allclose(actions, scaled(actor, obs))
+    np.testing.assert_array_equal(perturbed.act_batch(obs), actions)
+    np.testing.assert_allclose(perturbed.act(obs[3]), actions[3], rtol=1e-5, atol=1e-6)
+    assert np.all((actions >= ACT_SPACE.low) & (actions <= ACT_SPACE.high))
+    noise = np.concatenate([
+        (perturbed_w - w).numpy().ravel() for w, perturbed_w in zip(actor.weights, perturbed.perturbed.weights)
+    ])
+    np.testing.assert_allclose(noise.std(), 0.1, rtol=0.1)
+
+    # new noise on every resample, around the current weights of the actor
+    perturbed.resample(0.1)
+    assert not np.allclose(perturbed.act_batch(obs), actions)
+    actor.set_weights([w * 0.5 for w in actor.get_weights()])
+    perturbed.resample(0.0)
+    np.testing.assert_allclose(perturbed.act_batch(obs), scaled(actor, obs), rtol=1e-5, atol=1e-6)
+
+
+def test_perturbed_actors_with_the_same_seed_act_the_same():
+    actor = make_actor()
+    obs = np.random.default_rng(1).uniform(-2.0, 2.0, (8, 4)).astype(np.float32)
+    first, second = core.PerturbedActor(actor, ACT_SPACE, seed=3), core.PerturbedActor(actor, ACT_SPACE, seed=3)
+    for _ in range(3):
+        first.resample(0.2)
+        second.resample(0.2)
+        np.testing.assert_array_equal(first.act_batch(obs), second.act_batch(obs))
+
+
+def test_numpy_actor_matches_keras():
+    actor = make_actor()
+    obs = np.random.default_rng(2).uniform(-2.0, 2.0, (32, 4)).astype(np.float32)
+    numpy_actor = core.NumpyActor.from_keras(actor, ACT_SPACE)
+    np.testing.assert_allclose(numpy_actor(obs), scaled(actor, obs), rtol=1e-5, atol=1e-5)
+    np.testing.assert_allclose(numpy_actor(obs[0]), scaled(actor, obs[:1])[0], rtol=1e-5, atol=1e-5)
+
+    # new weights replace the noised ones, noise is drawn from the generator it's given
+    weights = [w + 0.05 for w in actor.get_weights()]
+    actor.set_weights(weights)
+    numpy_actor.resample(0.1, np.random.default_rng(3))
+    numpy_actor.set_weights(weights)
+    np.testing.assert_allclose(numpy_actor(obs), scaled(actor, obs), rtol=1e-5, atol=1e-5)
+    numpy_actor.resample(0.1, np.random.default_rng(3))
+    actions = numpy_actor(obs)
+    assert not np.allclose(actions, scaled(actor, obs))
+    numpy_actor.resample(0.1, np.random.default_rng(3))
+    np.testing.assert_array_equal(numpy_actor(obs), actions)
@@ -0,0 +1,136 @@
+import os
+from functools import partial
+import numpy as np
+import pytest
+from cmorl import reward_fns
+from cmorl.configs import get_env_and_config
+from cmorl.relabel import parse_args_and_relabel
+from cmorl.rl_algs.ddpg.hyperparams import HyperParams, combine, default_hypers
+from cmorl.rl_algs.ddpg.replay_buffer import ReplayBuffer
+from cmorl.rl_algs.ddpg.trainer import preload
+from cmorl.utils import dataset_utils, reward_utils
+
+SPEC = dataset_utils.env_spec("Pendulum-v1", {}, reward_utils.CMORL(partial(reward_fns.multi_dim_pendulum, setpoint=0.0)))
+
+
+def random_episodes(np_random, lengths):
+    """(observations, actions, rewards, cmorl_rewards, done, infos) of Pendulum sized episodes"""
+    return [
+        (
+            np_random.uniform(-1.0, 1.0, (length + 1, 3)).astype(np.float32),
+            np_random.uniform(-2.0, 2.0, (length, 1)).astype(np.float32),
+            np_random.uniform(-10.0, 0.0, length).astype(np.float32),
+            np_random.uniform(0.0, 1.0, (length, 2)).astype(np.float32),
+            bool(i % 2),
+            dict(torque=np_random.uniform(-2.0, 2.0, length)),
+        )
+        for i, length in enumerate(lengths)
+    ]
+
+
+def write_episodes(folder, episodes, shard_steps=100_000, mtime=None):
+    writer = dataset_utils.ShardWriter(folder, SPEC, shard_steps)
+    for episode in episodes:
+        writer.add_episode(*episode)
+    writer.close()
+    if mtime is not None:
+        # shards are ordered by their modification time, which ties for shards written at once
+        for i, shard in enumerate(writer.manifest["shards"]):
+            os.utime(folder / shard["name"], (mtime + i, mtime + i))
+    return writer
+
+
+def assert_same_episode(read, written):
+    for read_field, written_field in zip(read[:4], written[:4]):
+        np.testing.assert_array_equal(read_field, written_field)
+    assert read[4] == written[4]
+    np.testing.assert_allclose(read[5]["torque"], written[5]["torque"], rtol=1e-6)
+
+
+def test_library_folders_are_kept_per_spec():
+    same = dataset_utils.env_spec("Pendulum-v1", {}, reward_utils.CMORL(partial(reward_fns.multi_dim_pendulum, setpoint=0.0)))
+    other_setpoint = dataset_utils.env_spec("Pendulum-v1", {}, reward_utils.CMORL(partial(reward_fns.multi_dim_pendulum, setpoint=0.5)))
+    other_args = dataset_utils.env_spec("Pendulum-v1", {"g": 9.0}, reward_utils.CMORL(partial(reward_fns.multi_dim_pendulum, setpoint=0.0)))
+    folder = dataset_utils.library_folder("library", SPEC)
+    assert folder.parent.name == "Pendulum-v1" and dataset_utils.library_folder("library", same) == folder
+    assert len({folder, dataset_utils.library_folder("library", other_setpoint), dataset_utils.library_folder("library", other_args)}) == 3
+
+
+def test_runs_share_a_library_and_preload_its_newest_episodes(tmp_path):
+    np_random = np.random.default_rng(0)
+    older, newer = random_episodes(np_random, [30, 20, 10]), random_episodes(np_random, [25, 15])
+    write_episodes(tmp_path, older, shard_steps=40, mtime=1_000)
+    write_episodes(tmp_path, newer, mtime=2_000)
+
+    assert len(dataset_utils.read_shards(tmp_path)) == 3
+    for read, written in zip(dataset_utils.read_episodes(tmp_path), newer + older[2:] + older[:2]):
+        assert_same_episode(read, written)
+    # whole episodes up to max_steps, from the newest on
+    assert [len(episode[1]) for episode in dataset_utils.read_episodes(tmp_path, max_steps=41)] == [25, 15, 10]
+
+    hp = combine(default_hypers(), HyperParams(replay_size=45, gamma=0.9))
+    replay_buffer = ReplayBuffer(3, 1, hp.replay_size, rwds_dim=2)
+    assert preload(replay_buffer, tmp_path, hp) == 50
+    # the newest episodes were stored last, the oldest of the 50 steps got overwritten
+    observations, actions, _, cmorl_rewards, done, _ = newer[0]
+    rows = (replay_buffer.ptr - 25 + np.arange(25)) % hp.replay_size
+    np.testing.assert_array_equal(replay_buffer.obs1_buf[rows], observations[:-1])
+    np.testing.assert_array_equal(replay_buffer.acts_buf[rows], actions)
+    np.testing.assert_array_equal(replay_buffer.rews_buf[rows], cmorl_rewards)
+    np.testing.assert_array_equal(replay_buffer.done_buf[rows], dataset_utils.episode_dones(25, done))
+    np.testing.assert_allclose(replay_buffer.estimated_values_buf[rows], reward_utils.values(cmorl_rewards, 0.9, done=done), rtol=1e-6)
+
+
+def test_relabel_writes_the_current_rewards_into_the_library(tmp_path):
+    np_random = np.random.default_rng(1)
+    episodes = random_episodes(np_random, [25, 15, 10, 30])
+    write_episodes(tmp_path / "source", episodes[:2], mtime=1_000)
+    write_episodes(tmp_path / "source", episodes[2:], mtime=2_000)
+
+    # chunks of whole episodes, split between the second and third one
+    steps, target = parse_args_and_relabel(
+        ["Pendulum-v1", str(tmp_path / "source"), "--library", str(tmp_path / "library"), "--chunk_size", "30"]
+    )
+
+    env_fn, config = get_env_and_config("Pendulum-v1")
+    spec = dataset_utils.env_spec("Pendulum-v1", config.hypers.env_args, config.cmorl)
+    assert steps == 80 and target == dataset_utils.library_folder(tmp_path / "library", spec)
+    relabeled = list(dataset_utils.read_episodes(target, newest_first=False))
+    assert len(relabeled) == len(episodes)
+    for (observations, actions, rewards, cmorl_rewards, done, infos), episode in zip(relabeled, episodes):
+        assert_same_episode((observations, actions, rewards, episode[3], done, infos), episode)
+        expected = config.cmorl.batch(
+            observations[:-1], actions, observations[1:], dataset_utils.episode_dones(len(actions), done), [{}] * len(actions), env_fn().unwrapped
+        )
+        np.testing.assert_allclose(cmorl_rewards, expected, rtol=1e-6)
+        assert not np.allclose(cmorl_rewards, episode[3])
+
+
+@pytest.mark.parametrize("batch_size", [16, 50, 64, 200])
+def test_batches_carry_the_end_of_a_shard_over_into_the_next(tmp_path, batch_size):
+    episodes = random_episodes(np.random.default_rng(2), [30, 20, 10, 25, 9, 4])
+    # a shard of 50 steps, one of 44 and the 4 steps close writes
+    writer = write_episodes(tmp_path, episodes, shard_steps=40, mtime=1_000)
+    assert [sum(shard["lengths"]) for shard in writer.manifest["shards"]] == [50, 44, 4]
+
+    batches = list(dataset_utils.read_batches(tmp_path, batch_size, info_keys=("torque",)))
+    assert [len(batch["actions"]) for batch in batches[:-1]] == [batch_size] * (len(batches) - 1)
+    assert 0 < len(batches[-1]["actions"]) <= batch_size and len(batches) == -(-98 // batch_size)
+    steps = {key: np.concatenate([batch[key] for batch in batches]) for key in batches[0]}
+    np.testing.assert_array_equal(steps["observations"], np.concatenate([episode[0][:-1] for episode in episodes]))
+    np.testing.assert_array_equal(steps["next_observations"], np.concatenate([episode[0][1:] for episode in episodes]))
+    np.testing.assert_array_equal(steps["actions"], np.concatenate([episode[1] for episode in episodes]))
+    np.testing.assert_array_equal(steps["rewards"], np.concatenate([episode[2] for episode in episodes]))
+    np.testing.assert_array_equal(steps["cmorl_rewards"], np.concatenate([episode[3] for episode in episodes]))
+    np.testing.assert_array_equal(
+        steps["dones"], np.concatenate([dataset_utils.episode_dones(len(episode[1]), episode[4]) for episode in episodes])
+    )
+    np.testing.assert_allclose(steps["info.torque"], np.concatenate([episode[5]["torque"] for episode in episodes]), rtol=1e-6)
+
+    # shuffled batches hold the same steps
+    shuffled = list(dataset_utils.read_batches(tmp_path, batch_size, shuffle=True, np_random=np.random.default_rng(3)))
+    assert [len(batch["actions"]) for batch in shuffled] == [len(batch["actions"]) for batch in batches]
+    shuffled_steps = {key: np.concatenate([batch[key] for batch in shuffled]) for key in shuffled[0]}
+    order = np.argsort(shuffled_steps["actions"][:, 0])
+    for key, values in shuffled_steps.items():
+        np.testing.assert_array_equal(values[order], steps[key][np.argsort(steps["actions"][:, 0])])
@@ -0,0 +1,50 @@
+import pickle
+import numpy as np
+import pytest
+import tensorflow as tf
+from multiprocess import shared_memory
+from cmorl.configs import get_env_and_config
+from cmorl.rl_algs.ddpg import core
+from cmorl.rl_algs.ddpg.distributed import DistributedActors
+from cmorl.rl_algs.ddpg.hyperparams import HyperParams, combine
+from cmorl.rl_algs.ddpg.replay_buffer import SharedReplayBuffer
+
+
+def test_env_fn_pickles_after_the_composer_was_traced():
+    env_fn, config = get_env_and_config("LunarLanderContinuous-v2")
+    config.cmorl.q_composer(tf.random.uniform((8, 6)))
+    env = pickle.loads(pickle.dumps(env_fn))()
+    assert env.observation_space.shape == env_fn().observation_space.shape
+
+
+def test_spawned_actors_fill_the_shared_replay_buffer():
+    env_fn, config = get_env_and_config("Pendulum-v1")
+    config.cmorl.q_composer(tf.random.uniform((8, 2)))
+    env = env_fn()
+    env.reset(seed=0)
+    rwds_dim = config.cmorl.calculate_space(env).shape[0]
+    hp = combine(
+        config.hypers,
+        HyperParams(num_actor_processes=2, start_steps=50, max_ep_len=50, seed=0),
+    )
+    replay_buffer = SharedReplayBuffer(
+        env.observation_space.shape[0], env.action_space.shape[0], 1000, rwds_dim
+    )
+    pi_network = core.actor(
+        env.observation_space, env.action_space, [8], env.observation_space.high
+    )
+    actors = DistributedActors(
+        env_fn, config.cmorl, replay_buffer, pi_network, env.action_space, hp, total_steps=200
+    )
+    actors.start()
+    actors.close()
+    stats = actors.drain_stats()
+    names = [memory.name for memory in replay_buffer.memories.values()]
+
+    assert all(process.exitcode == 0 for process in actors.processes)
+    assert replay_buffer.size >= 200 and len(stats) >= 4
+    assert np.all(np.isfinite(replay_buffer.rews_buf[: replay_buffer.size]))
+    replay_buffer.close()
+    # the creator's close freed the blocks the actors attached to
+    with pytest.raises(FileNotFoundError):
+        shared_memory.SharedMemory(name=names[0])
@@ -0,0 +1,30 @@
+import pytest
+from cmorl.rl_algs.ddpg.hyperparams import HyperParams, combine, default_hypers, default_serializer, validate
+
+
+@pytest.mark.parametrize(
+    "options",
+    [
+        dict(fused_update=True, num_actor_processes=2),
+        dict(offline="episodes", async_learner=True),
+        dict(offline="episodes", num_actor_processes=2),
+        dict(replay_sampling="greedy"),
+        dict(replay_sampling="prioritized", fused_update=True),
+        dict(replay_dir="replay", num_actor_processes=2),
+        dict(episode_replay=True, replay_sampling="deficit"),
+        dict(n_step=3),
+        dict(replay_dtype="int8"),
+        dict(replay_dtype="uint8", fused_update=True),
+    ],
+)
+def test_incompatible_hyperparameters_raise(options):
+    with pytest.raises(ValueError):
+        validate(combine(default_hypers(), HyperParams(**options)))
+
+
+def test_parsed_hyperparameters_validate():
+    serializer = default_serializer()
+    hp = serializer.parse_arguments(["-n", "test", "--episode_replay", "True", "--n_step", "3"])
+    assert validate(hp) is hp
+    with pytest.raises(ValueError):
+        validate(serializer.parse_arguments(["-n", "test", "--n_step", "3"]))
@@ -0,0 +1,71 @@
+import gymnasium as gym
+import numpy as np
+import tensorflow as tf
+from cmorl import reward_fns
+from cmorl.rl_algs.ddpg import core
+from cmorl.rl_algs.ddpg.hyperparams import HyperParams, combine, default_hypers
+from cmorl.rl_algs.ddpg.learner import Learner
+from cmorl.rl_algs.ddpg.replay_buffer import TensorflowReplayBuffer
+
+HP = combine(
+    default_hypers(),
+    HyperParams(batch_size=16, train_steps=6, ac_kwargs=dict(actor_hidden_sizes=[8], critic_hidden_sizes=[16, 16])),
+)
+
+
+class ReplayIndices:
+    """A stand in for np_random that draws the same indices as the replay buffer's generator from its current state"""
+
+    def __init__(self, generator):
+        self.generator = tf.random.Generator.from_state(generator.state.numpy(), generator.algorithm)
+
+    def integers(self, low, high, size):
+        return self.generator.uniform([size], low, high, dtype=tf.int32).numpy()
+
+
+def make_learner(replay_buffer, fused_update):
+    env = gym.make("Pendulum-v1")
+    networks = [
+        network
+        for _ in range(2)
+        for network in core.mlp_actor_critic(env.observation_space, env.action_space, 2, seed=0, **HP.ac_kwargs)
+    ]
+    hp = combine(HP, HyperParams(fused_update=fused_update))
+    return Learner(hp, *networks, replay_buffer, 2, q_composer=reward_fns.pendulum_composer)
+
+
+def filled_buffer(size=100):
+    rng = np.random.default_rng(0)
+    replay_buffer = TensorflowReplayBuffer(3, 1, size, rwds_dim=2, seed=0)
+    obs = rng.uniform(-1.0, 1.0, (size + 1, 3))
+    dones = np.zeros(size)
+    dones[-1] = 1.0
+    rews = rng.uniform(0.0, 1.0, (size, 2))
+    replay_buffer.store_episode(obs, rng.uniform(-1.0, 1.0, (size, 1)), rews, dones, rews)
+    replay_buffer.flush()
+    return replay_buffer
+
+
+def test_fused_and_unfused_updates_train_the_same():
+    replay_buffer = filled_buffer()
+    fused, unfused = make_learner(replay_buffer, True), make_learner(replay_buffer, False)
+    for network in ["pi_network", "q_network", "pi_targ_network", "q_targ_network"]:
+        getattr(unfused, network).set_weights(getattr(fused, network).get_weights())
+    indices = ReplayIndices(replay_buffer.generator)
+
+    metrics = fused.fused_update(tf.constant(HP.train_steps))
+    qs_c, q_c = unfused.update(indices)
+
+    for network in ["pi_network", "q_network", "pi_targ_network", "q_targ_network"]:
+        for fused_weight, weight in zip(getattr(fused, network).get_weights(), getattr(unfused, network).get_weights()):
+            np.testing.assert_allclose(fused_weight, weight, rtol=1e-5, atol=1e-6)
+    # a row per step and phase, the last one is the step update returned
+    assert metrics["q"].shape == (HP.train_steps, 4) and metrics["pi"].shape == (HP.train_steps, 3)
+    np.testing.assert_allclose(metrics["qs_c"][-1], qs_c, rtol=1e-5)
+    np.testing.assert_allclose(metrics["pi"][-1, 1], q_c, rtol=1e-5)
+    # both paths accumulated the same losses
+    fused_stats, stats = fused.update_metrics.read(), unfused.update_metrics.read()
+    np.testing.assert_allclose(np.mean(metrics["q"][:, 0]), stats["Q-Loss"]["mean"], rtol=1e-5)
+    for key in ["Q-Loss", "Q-composed", "Q"]:
+        np.testing.assert_allclose(fused_stats[key]["mean"], stats[key]["mean"], rtol=1e-5)
+        assert fused_stats[key]["count"] == HP.train_steps
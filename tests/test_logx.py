@@ -0,0 +1,69 @@
+import numpy as np
+import tensorflow as tf
+from cmorl.utils.logx import EpochLogger, MetricsAccumulator, statistics_scalar
+
+
+def test_accumulated_statistics_match_numpy():
+    samples = np.random.default_rng(0).normal(size=(50, 3)).astype(np.float32)
+    metrics = MetricsAccumulator()
+    metrics.add_key("loss")
+    metrics.add_key("qs", (3,))
+
+    @tf.function
+    def accumulate(batch):
+        metrics.update(loss=tf.reduce_mean(batch))
+        metrics.update_many(qs=batch)
+
+    for batch in np.split(samples, 5):
+        accumulate(tf.constant(batch))
+    stats = metrics.read()
+
+    assert stats["qs"]["count"] == 50 and stats["loss"]["count"] == 5
+    np.testing.assert_allclose(stats["qs"]["mean"], samples.mean(axis=0), rtol=1e-5, atol=1e-6)
+    np.testing.assert_allclose(stats["qs"]["std"], samples.std(axis=0), rtol=1e-4)
+    np.testing.assert_array_equal(stats["qs"]["min"], samples.min(axis=0))
+    np.testing.assert_array_equal(stats["qs"]["max"], samples.max(axis=0))
+    np.testing.assert_allclose(stats["loss"]["mean"], samples.mean(), rtol=1e-4, atol=1e-6)
+
+    metrics.reset()
+    # keys without samples since the reset are left out
+    assert metrics.read() == {}
+    accumulate(tf.constant(samples[:2]))
+    stats = metrics.read()
+    np.testing.assert_array_equal(stats["qs"]["min"], samples[:2].min(axis=0))
+    np.testing.assert_array_equal(stats["qs"]["max"], samples[:2].max(axis=0))
+
+
+def test_keys_are_created_on_their_first_update():
+    metrics = MetricsAccumulator()
+    metrics.update(reward=2.0)
+    metrics.update(reward=4.0)
+    stats = metrics.read()["reward"]
+    assert (stats["mean"], stats["std"], stats["min"], stats["max"]) == (3.0, 1.0, 2.0, 4.0)
+
+
+def test_epoch_logger_logs_in_graph_metrics_like_stored_ones(tmp_path):
+    logger = EpochLogger(output_dir=str(tmp_path))
+    logger.metrics.add_key("LossQ")
+
+    @tf.function
+    def train_step(loss):
+        logger.metrics.update(LossQ=loss)
+
+    for epoch_losses in ([0.5, 1.5, 4.0], [2.0]):
+        for loss in epoch_losses:
+            train_step(tf.constant(loss))
+            logger.store(LossPi=loss)
+        logger.log_tabular("LossQ", with_min_and_max=True)
+        logger.log_tabular("LossPi", with_min_and_max=True)
+        row = dict(logger.log_current_row)
+        logger.dump_tabular()
+
+        expected = statistics_scalar(epoch_losses, with_min_and_max=True)
+        for prefix, value in zip(("Average", "Std", "Min", "Max"), expected):
+            # every epoch only sees its own samples
+            np.testing.assert_allclose(row[prefix + "LossQ"], value, rtol=1e-6)
+            np.testing.assert_allclose(row[prefix + "LossPi"], value, rtol=1e-6)
+
+    header = (tmp_path / "progress.txt").read_text().splitlines()[0].split("\t")
+    assert "AverageLossQ" in header and "MinLossQ" in header
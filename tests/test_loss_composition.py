@@ -0,0 +1,189 @@
+import numpy as np
+import pytest
+import tensorflow as tf
+from cmorl.utils import loss_composition as lc
+
+PS = [-20.0, -4.0, -1.0, 0.0, 0.5, 1.0, 2.0, 20.0]
+
+
+def reference_p_mean(x, p, axis=None, weights=None, slack=1e-7):
+    """The generalized mean straight from its definition, in float64"""
+    x = np.asarray(x, dtype=np.float64) + slack
+    weights = np.ones_like(x) if weights is None else np.broadcast_to(weights, x.shape)
+    weights = weights / np.sum(weights, axis=axis, keepdims=True)
+    if p == 0:
+        return np.exp(np.sum(weights * np.log(x), axis=axis)) - slack
+    return np.sum(weights * x**p, axis=axis) ** (1.0 / p) - slack
+
+
+@pytest.fixture
+def values():
+    return np.random.default_rng(0).uniform(0.0, 1.0, (16, 5))
+
+
+@pytest.mark.parametrize("p", PS)
+@pytest.mark.parametrize("axis", [0, 1, -1, None, (0, 1)])
+def test_p_mean_backends_match_the_definition(values, p, axis):
+    expected = reference_p_mean(values, p, axis=axis)
+    np.testing.assert_allclose(lc.np_p_mean(values, p, axis=axis), expected, rtol=1e-9, atol=1e-12)
+    np.testing.assert_allclose(lc.tf_p_mean(tf.constant(values), p, axis=axis), expected, rtol=1e-9, atol=1e-12)
+    np.testing.assert_allclose(
+        lc.tf_p_mean(tf.constant(values, tf.float32), p, axis=axis), expected, rtol=1e-4, atol=1e-6
+    )
+
+
+@pytest.mark.parametrize("p", PS)
+def test_weighted_p_mean(values, p):
+    weights = np.random.default_rng(1).uniform(0.1, 2.0, (1, 5))
+    expected = reference_p_mean(values, p, axis=-1, weights=weights)
+    np.testing.assert_allclose(lc.np_p_mean(values, p, axis=-1, weights=weights), expected, rtol=1e-9)
+    np.testing.assert_allclose(lc.tf_p_mean(tf.constant(values), p, axis=-1, weights=weights), expected, rtol=1e-9)
+
+
+@pytest.mark.parametrize("p", [-20.0, -4.0, 4.0, 20.0])
+def test_p_mean_doesnt_overflow(p):
+    # x**p overflows float32 (and for p = 20 float64) for every one of these
+    values = np.array([[1e-30, 1e-20, 1e-10], [1e20, 1e25, 1e30]])
+    for result in [
+        lc.np_p_mean(values, p, axis=-1),
+        lc.tf_p_mean(tf.constant(values), p, axis=-1),
+        lc.tf_p_mean(tf.constant(values, tf.float32), p, axis=-1),
+    ]:
+        assert np.all(np.isfinite(result))
+    np.testing.assert_allclose(lc.np_p_mean(values, p, axis=-1), lc.tf_p_mean(tf.constant(values), p, axis=-1), rtol=1e-9)
+    np.testing.assert_allclose(
+        lc.tf_p_mean(tf.constant(values, tf.float32), p, axis=-1), lc.np_p_mean(values, p, axis=-1), rtol=1e-4, atol=1e-12
+    )
+    # every value is within the range of its row
+    result = lc.np_p_mean(values, p, axis=-1)
+    assert np.all(result >= values.min(axis=-1) * (1 - 1e-9)) and np.all(result <= values.max(axis=-1) * (1 + 1e-9))
+
+
+@pytest.mark.parametrize("p", PS)
+def test_p_mean_gradient(values, p):
+    x = tf.constant(values)
+    with tf.GradientTape() as tape:
+        tape.watch(x)
+        result = lc.tf_p_mean(x, p, axis=0)
+    gradient = tape.gradient(result, x)
+    # d/dx_i of the mean of n values: x_i**(p-1) * p_mean**(1-p) / n, with the slack added to both
+    slacked = values + 1e-7
+    expected = slacked ** (p - 1) * (result.numpy() + 1e-7) ** (1 - p) / len(values)
+    np.testing.assert_allclose(gradient, expected, rtol=1e-6)
+
+
+def test_p_mean_per_config(values):
+    ps = np.array([-4.0, 0.0, 1.0])
+    expected = np.stack([reference_p_mean(values, p, axis=0) for p in ps])
+    np.testing.assert_allclose(lc.np_p_mean(values, lc.per_config(ps), axis=0), expected, rtol=1e-9)
+    np.testing.assert_allclose(
+        lc.tf_p_mean(tf.constant(values), lc.per_config(tf.constant(ps)), axis=0), expected, rtol=1e-9
+    )
+
+
+@pytest.mark.parametrize("p", [-4.0, -1.0, 0.0, 1.0])
+@pytest.mark.parametrize("slack", [0.1, 0.5, -0.3])
+def test_then_and_offset_backends_match(values, p, slack):
+    x, y = values[:, 0], values[:, 1]
+    np.testing.assert_allclose(lc.tf_offset(tf.constant(y), slack), lc.np_offset(y, slack), rtol=1e-12)
+    y_tensor = tf.constant(y)
+    with tf.GradientTape() as tape:
+        tape.watch(y_tensor)
+        offset = lc.tf_offset(y_tensor, slack)
+    # the offset passes the gradient through unscaled
+    np.testing.assert_array_equal(tape.gradient(offset, y_tensor), np.ones_like(y))
+    if slack > 0:
+        np.testing.assert_allclose(
+            lc.tf_then(tf.constant(x), tf.constant(y), slack=slack, p=p), lc.np_then(x, y, slack=slack, p=p), rtol=1e-9
+        )
+
+
+@pytest.mark.parametrize("p", [-4.0, -1.0, 0.0, 1.0])
+@pytest.mark.parametrize("slack", [0.1, 0.3])
+def test_curriculum_backends_match(values, p, slack):
+    rows = values[0]
+    np.testing.assert_allclose(
+        lc.tf_curriculum(tf.constant(rows), slack=slack, p=p), lc.np_curriculum(rows, slack=slack, p=p), rtol=1e-9
+    )
+    # satisfying everything is 1, the first objective alone at 0 is 0
+    assert lc.np_curriculum(np.ones(4), slack=slack, p=p) == pytest.approx(1.0)
+    assert lc.np_curriculum(np.array([0.0, 1.0, 1.0]), slack=slack, p=-1.0) == pytest.approx(0.0, abs=1e-6)
+
+
+@pytest.mark.parametrize("weaken_by", [0.5, 2.0, 5.0])
+def test_weaken_backends_match(values, weaken_by):
+    np.testing.assert_allclose(lc.tf_weaken(tf.constant(values), weaken_by), lc.np_weaken(values, weaken_by), rtol=1e-12)
+
+
+def test_clip_to_backends_match(values):
+    scaled = values * 3.0 - 1.0
+    expected = lc.np_clip_to(scaled, -0.5, 1.5, 0.2, 0.8)
+    np.testing.assert_allclose(lc.tf_clip_to(tf.constant(scaled), -0.5, 1.5, 0.2, 0.8), expected, rtol=1e-12)
+    assert np.min(expected) == pytest.approx(0.2) and np.max(expected) == pytest.approx(0.8)
+
+
+def test_dispatch_follows_the_arguments(values):
+    assert isinstance(lc.p_mean(values, -4.0), np.ndarray | np.floating)
+    assert tf.is_tensor(lc.p_mean(tf.constant(values), -4.0))
+    # a tensor anywhere among the arguments, or inside a list of them, picks TF
+    assert tf.is_tensor(lc.p_mean(values, tf.constant(-4.0)))
+    assert tf.is_tensor(lc.then(values[:, 0], tf.constant(values[:, 1])))
+    assert tf.is_tensor(lc.p_mean([values[:, 0], tf.constant(values[:, 1])], 0.0, axis=0))
+    assert not tf.is_tensor(lc.clip_to(values, 0.0, 0.5))
+    assert tf.is_tensor(lc.weaken(tf.Variable(values)))
+    assert lc.p_mean.__name__ == "p_mean"
+
+
+
+@pytest.mark.parametrize("p", [-4.0, -1.0, 0.0, 1.0, 4.0])
+@pytest.mark.parametrize("axis", [0, -1, None])
+def test_p_mean_matches_the_stabilized_one(values, p, axis):
+    # without slack, stabilized_p_mean takes off the slack times its stabilizer
+    x = tf.constant(values)
+    with tf.GradientTape(persistent=True) as tape:
+        tape.watch(x)
+        result = lc.tf_p_mean(x, p, slack=0.0, axis=axis)
+        expected = lc.stabilized_p_mean(x, p, slack=0.0, axis=axis)
+    # stabilized_p_mean stands in for the geometric mean with p = 1e-4
+    rtol = 1e-3 if p == 0 else 1e-8
+    np.testing.assert_allclose(result, expected, rtol=rtol, atol=1e-12)
+    np.testing.assert_allclose(tape.gradient(result, x), tape.gradient(expected, x), rtol=rtol, atol=1e-12)
+
+
+@pytest.mark.parametrize("p", [-4.0, 1.0, 4.0])
+def test_weights_repeat_elements(values, p):
+    # integer weights mean the same as repeating every element that many times
+    counts = np.array([1, 3, 2, 1, 4])
+    x = tf.constant(values)
+    with tf.GradientTape(persistent=True) as tape:
+        tape.watch(x)
+        result = lc.tf_p_mean(x, p, slack=0.0, axis=-1, weights=counts[None])
+        expected = lc.stabilized_p_mean(tf.repeat(x, counts, axis=-1), p, slack=0.0, axis=-1)
+    np.testing.assert_allclose(result, expected, rtol=1e-8)
+    np.testing.assert_allclose(tape.gradient(result, x), tape.gradient(expected, x), rtol=1e-8, atol=1e-12)
+
+
+@pytest.mark.parametrize("p", [-4.0, 0.0, 1.0])
+def test_values_below_the_slack_are_held_at_tiny(values, p):
+    values = np.concatenate([values, np.full((16, 1), -1e-3)], axis=-1)
+    x = tf.constant(values)
+    with tf.GradientTape() as tape:
+        tape.watch(x)
+        result = lc.tf_p_mean(x, p, axis=-1)
+    gradient = tape.gradient(result, x).numpy()
+    np.testing.assert_allclose(result, lc.np_p_mean(values, p, axis=-1), rtol=1e-9, atol=1e-12)
+    # the slack goes through float32 on its way in
+    assert np.all(result >= -1e-7 * (1 + 1e-6)) and np.all(result <= values.max(axis=-1))
+    assert np.all(np.isfinite(gradient))
+    np.testing.assert_array_equal(gradient[:, -1], 0.0)
+
+
+@pytest.mark.parametrize("p", PS)
+def test_p_mean_stays_in_range(p):
+    # equal values mean to themselves exactly, however the log space rounds
+    values = np.full((4, 7), 0.3) * np.array([[1.0], [1e-6], [1e6], [3.0]])
+    for result in [
+        lc.np_p_mean(values, p, axis=-1),
+        lc.tf_p_mean(tf.constant(values), p, axis=-1),
+    ]:
+        assert np.all(result >= values.min(axis=-1)) and np.all(result <= values.max(axis=-1))
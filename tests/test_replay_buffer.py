@@ -0,0 +1,248 @@
+import gymnasium as gym
+import numpy as np
+import pytest
+from cmorl.rl_algs.ddpg.replay_buffer import (
+    DeficitReplayBuffer,
+    Episode,
+    EpisodeReplayBuffer,
+    FieldCodec,
+    PrioritizedReplayBuffer,
+    ReplayBuffer,
+    make_codecs,
+)
+
+
+def random_episode(np_random, length, obs_dim=3, act_dim=2, rwds_dim=2):
+    obs = np_random.uniform(size=(length + 1, obs_dim)).astype(np.float32)
+    acts = np_random.uniform(size=(length, act_dim)).astype(np.float32)
+    rews = np_random.uniform(size=(length, rwds_dim)).astype(np.float32)
+    return obs, acts, rews
+
+
+def test_store_buffers_transitions_into_episodes():
+    np_random = np.random.default_rng(0)
+    stepwise = EpisodeReplayBuffer(3, 2, 64, rwds_dim=2)
+    whole = EpisodeReplayBuffer(3, 2, 64, rwds_dim=2)
+    # a terminated episode, then a truncated one that only ends when the next one starts
+    for length, done in [(5, True), (7, False), (4, True)]:
+        obs, acts, rews = random_episode(np_random, length)
+        dones = np.zeros(length, dtype=np.float32)
+        dones[-1] = float(done)
+        whole.store_episode(obs, acts, rews, dones)
+        for t in range(length):
+            stepwise.store(obs[t], acts[t], rews[t], obs[t + 1], dones[t])
+
+    assert (stepwise.ptr, stepwise.size) == (whole.ptr, whole.size)
+    for name in whole.fields:
+        np.testing.assert_array_equal(getattr(stepwise, name), getattr(whole, name))
+    np.testing.assert_allclose(stepwise.estimated_values(), whole.estimated_values())
+
+
+def test_n_step_targets():
+    gamma = 0.9
+    buffer = EpisodeReplayBuffer(3, 2, 64, rwds_dim=2, gamma=gamma)
+    obs, acts, rews = random_episode(np.random.default_rng(1), 5)
+    dones = np.array([0, 0, 0, 0, 1], dtype=np.float32)
+    buffer.store_episode(obs, acts, rews, dones)
+
+    rews_n, obs_n, discounts = buffer.n_step(np.array([0, 3]), 3)
+
+    np.testing.assert_allclose(rews_n[0], (1 - gamma) * (rews[0] + gamma * rews[1] + gamma**2 * rews[2]), rtol=1e-6)
+    np.testing.assert_allclose(rews_n[1], (1 - gamma) * (rews[3] + gamma * rews[4]), rtol=1e-6)
+    np.testing.assert_array_equal(obs_n, obs[[3, 5]])
+    np.testing.assert_allclose(discounts, [gamma**3, 0.0], rtol=1e-6)
+    # a single step is the usual target
+    rews_1, obs_1, discounts_1 = buffer.n_step(np.array([1]), 1)
+    np.testing.assert_allclose(rews_1[0], (1 - gamma) * rews[1], rtol=1e-6)
+    np.testing.assert_allclose(discounts_1, [gamma], rtol=1e-6)
+
+
+@pytest.mark.parametrize("lengths", [[7, 6], [3, 25, 4], [10, 10]])
+def test_whole_episodes_wrap_around_like_single_steps(lengths):
+    np_random = np.random.default_rng(4)
+    stepwise = ReplayBuffer(3, 2, 10, rwds_dim=2)
+    whole = ReplayBuffer(3, 2, 10, rwds_dim=2)
+    for length in lengths:
+        obs, acts, rews = random_episode(np_random, length)
+        dones = np.zeros(length, dtype=np.float32)
+        dones[-1] = 1.0
+        values = rews * 0.5
+        whole.store_episode(obs, acts, rews, dones, values)
+        for t in range(length):
+            stepwise.store(obs[t], acts[t], rews[t], obs[t + 1], dones[t], values[t])
+
+        assert (stepwise.ptr, stepwise.size) == (whole.ptr, whole.size)
+        for name in whole.fields:
+            np.testing.assert_array_equal(getattr(stepwise, name), getattr(whole, name))
+
+
+def test_episodes_grow_past_their_capacity():
+    np_random = np.random.default_rng(5)
+    obs, acts, rews = random_episode(np_random, 11)
+    episode = Episode(obs[0], 2, 2, capacity=4)
+    for t in range(11):
+        episode.append(acts[t], obs[t + 1], rews[t, 0], rews[t])
+
+    assert episode.length == 11 and len(episode.observations) == len(episode.actions) + 1
+    np.testing.assert_array_equal(episode.observations[:12], obs)
+    np.testing.assert_array_equal(episode.actions[:11], acts)
+    np.testing.assert_array_equal(episode.rewards[:11], rews[:, 0])
+    np.testing.assert_array_equal(episode.cmorl_rewards[:11], rews)
+    np.testing.assert_array_equal(episode.dones(True), [0.0] * 10 + [1.0])
+
+
+def store_episodes(buffer, np_random, lengths):
+    for length in lengths:
+        obs, acts, rews = random_episode(np_random, length)
+        dones = np.zeros(length, dtype=np.float32)
+        buffer.store_episode(obs, acts, rews, dones, rews)
+
+
+def test_prioritized_tree_follows_wraparound_and_updates():
+    np_random = np.random.default_rng(2)
+    buffer = PrioritizedReplayBuffer(3, 2, 10, rwds_dim=2, alpha=0.5)
+    store_episodes(buffer, np_random, [7])
+    buffer.update_priorities(np.arange(7), np.arange(7, dtype=np.float64))
+    # wraps around, the new transitions get the largest priority so far
+    store_episodes(buffer, np_random, [6])
+
+    expected = (np.arange(10) + buffer.eps) ** 0.5
+    expected[[7, 8, 9, 0, 1, 2]] = (6.0 + buffer.eps) ** 0.5
+    assert buffer.ptr == 3 and buffer.size == 10
+    np.testing.assert_allclose(buffer.tree[np.arange(10)], expected)
+    assert buffer.tree.total() == pytest.approx(np.sum(expected))
+    np.testing.assert_array_equal(
+        buffer.tree.find(np.cumsum(expected) - 1e-9), np.arange(10)
+    )
+
+
+def test_prioritized_sampling_follows_the_priorities():
+    np_random = np.random.default_rng(3)
+    buffer = PrioritizedReplayBuffer(3, 2, 8, rwds_dim=2, alpha=0.7, beta=0.4)
+    store_episodes(buffer, np_random, [8])
+    errors = np.array([0.1, 2.0, 0.5, 0.0, 1.0, 3.0, 0.2, 0.8])
+    buffer.update_priorities(np.arange(8), errors)
+    probabilities = (errors + buffer.eps) ** 0.7 / np.sum((errors + buffer.eps) ** 0.7)
+
+    counts = np.zeros(8)
+    for _ in range(2000):
+        batch = buffer.sample_batch(32, np_random)
+        counts += np.bincount(batch["idxs"], minlength=8)
+        # (size * P(i))**-beta scaled so the largest weight of the batch is 1
+        expected = (8 * probabilities[batch["idxs"]]) ** -0.4
+        np.testing.assert_allclose(batch["weights"], expected / np.max(expected), rtol=1e-5)
+        assert np.max(batch["weights"]) == 1.0
+        np.testing.assert_array_equal(batch["obs1"], buffer.obs1_buf[batch["idxs"]])
+    np.testing.assert_allclose(counts / np.sum(counts), probabilities, atol=5e-3)
+
+
+def test_deficit_sampling_follows_the_documented_distribution():
+    np_random = np.random.default_rng(4)
+    buffer = DeficitReplayBuffer(3, 2, 6, rwds_dim=2, uniform_fraction=0.3, eps=1e-3)
+    estimated_values = np.array([[0.9, 0.0], [0.1, 0.5], [-0.2, 0.2], [0.4, 1.0], [0.0, 0.3], [0.6, 0.1]])
+    # the first episode is overwritten by the second as it wraps around
+    store_episodes(buffer, np_random, [4])
+    obs, acts, rews = random_episode(np_random, 6)
+    buffer.store_episode(obs, acts, rews, np.zeros(6, dtype=np.float32), estimated_values)
+    buffer.objective_weights = np.array([1.0, 3.0])
+
+    values = np.clip(np.roll(estimated_values, 4, axis=0), 0.0, None) + 1e-3
+    probabilities = 0.3 / 6 + 0.7 * (values / np.sum(values, axis=0)) @ np.array([0.25, 0.75])
+    for objective, tree in enumerate(buffer.trees):
+        np.testing.assert_allclose(tree[np.arange(6)], values[:, objective], rtol=1e-6)
+
+    samples = np.concatenate([
+        np.argmax(np.all(buffer.sample_batch(32, np_random)["obs1"][:, None] == buffer.obs1_buf[None], axis=-1), axis=1)
+        for _ in range(3000)
+    ])
+    np.testing.assert_allclose(np.bincount(samples, minlength=6) / len(samples), probabilities, atol=5e-3)
+
+
+def test_memory_mapped_buffers_are_picked_up_again(tmp_path):
+    np_random = np.random.default_rng(5)
+    buffer = ReplayBuffer(3, 2, 16, rwds_dim=2, storage_dir=tmp_path)
+    in_memory = ReplayBuffer(3, 2, 16, rwds_dim=2)
+    for length in [9, 11]:
+        obs, acts, rews = random_episode(np_random, length)
+        dones = np.zeros(length, dtype=np.float32)
+        buffer.store_episode(obs, acts, rews, dones, rews)
+        in_memory.store_episode(obs, acts, rews, dones, rews)
+    buffer.flush()
+    del buffer
+
+    reopened = ReplayBuffer(3, 2, 16, rwds_dim=2, storage_dir=tmp_path)
+    assert isinstance(reopened.obs1_buf, np.memmap)
+    assert (reopened.ptr, reopened.size) == (in_memory.ptr, in_memory.size) == (4, 16)
+    for name in in_memory.fields:
+        np.testing.assert_array_equal(getattr(reopened, name), getattr(in_memory, name))
+    # a buffer of another size starts over in the same directory
+    resized = ReplayBuffer(3, 2, 8, rwds_dim=2, storage_dir=tmp_path)
+    assert (resized.ptr, resized.size) == (0, 0) and resized.obs1_buf.shape == (8, 3)
+
+
+def test_memory_mapped_gather_keeps_the_order_of_the_indices(tmp_path):
+    np_random = np.random.default_rng(6)
+    buffer = ReplayBuffer(3, 2, 32, rwds_dim=2, storage_dir=tmp_path)
+    in_memory = ReplayBuffer(3, 2, 32, rwds_dim=2)
+    obs, acts, rews = random_episode(np_random, 32)
+    for replay in (buffer, in_memory):
+        replay.store_episode(obs, acts, rews, np.zeros(32, dtype=np.float32), rews)
+
+    # unsorted, with repeats
+    idxs = np.array([17, 3, 31, 3, 0, 17, 9])
+    batch, expected = buffer.gather(idxs), in_memory.gather(idxs)
+    for key in expected:
+        np.testing.assert_array_equal(batch[key], expected[key])
+    np.testing.assert_array_equal(batch["obs1"], obs[idxs])
+
+
+@pytest.mark.parametrize("dtype", [np.uint8, np.uint16])
+def test_quantized_codecs_stay_within_half_a_level(dtype):
+    low, high = np.array([-2.0, 0.0, 5.0]), np.array([2.0, 1.0, 5.0])
+    codec = FieldCodec(dtype, low, high)
+    values = np.random.default_rng(7).uniform(low, high, (1000, 3)).astype(np.float32)
+    stored = codec.encode(values)
+    assert stored.dtype == dtype
+    decoded = codec.decode(stored)
+    assert decoded.dtype == np.float32
+    step = (high - low) / np.iinfo(dtype).max
+    assert np.all(np.abs(decoded - values)[:, :2] <= step[:2] / 2 + 1e-6)
+    # a dimension with low == high only ever holds low
+    np.testing.assert_array_equal(decoded[:, 2], 5.0)
+    # values outside the bounds are clipped to them
+    np.testing.assert_allclose(codec.decode(codec.encode([[-3.0, 1.5, 7.0]])), [[-2.0, 1.0, 5.0]], atol=1e-6)
+
+
+def test_make_codecs_picks_a_codec_per_field():
+    observation_space = gym.spaces.Box(np.array([-1.0, -np.inf]), np.array([1.0, np.inf]))
+    action_space = gym.spaces.Box(-2.0, 2.0, (1,))
+    reward_space = gym.spaces.Box(0.0, 1.0, (2,))
+    assert make_codecs("float32", observation_space, action_space, reward_space) == {}
+    halves = make_codecs("float16", observation_space, action_space, reward_space)
+    assert all(halves[field].dtype == np.float16 for field in ("obs", "acts", "rews", "estimated_values"))
+
+    codecs = make_codecs("uint8", observation_space, action_space, reward_space)
+    # unbounded observations fall back to float16, unless the obs normalizer bounds them
+    assert codecs["obs"].dtype == np.float16 and not codecs["obs"].quantized
+    assert codecs["acts"].quantized and codecs["rews"].quantized and codecs["estimated_values"].quantized
+    assert make_codecs("uint8", gym.spaces.Box(-np.inf, np.inf, (2,)), action_space, reward_space, 10.0)["obs"].quantized
+    # no reward space keeps the rewards unquantized
+    assert not make_codecs("uint8", observation_space, action_space)["rews"].quantized
+
+
+def test_buffers_decode_what_they_stored():
+    observation_space = gym.spaces.Box(-1.0, 1.0, (3,))
+    action_space = gym.spaces.Box(-1.0, 1.0, (2,))
+    reward_space = gym.spaces.Box(0.0, 1.0, (2,))
+    buffer = ReplayBuffer(3, 2, 16, rwds_dim=2, codecs=make_codecs("uint16", observation_space, action_space, reward_space))
+    obs, acts, rews = random_episode(np.random.default_rng(8), 10)
+    dones = np.zeros(10, dtype=np.float32)
+    dones[-1] = 1.0
+    buffer.store_episode(obs, acts, rews, dones, rews)
+
+    assert buffer.obs1_buf.dtype == np.uint16 and buffer.done_buf.dtype == np.uint8
+    batch = buffer.gather(np.arange(10))
+    np.testing.assert_allclose(batch["obs1"], obs[:-1], atol=2.0 / 65535)
+    np.testing.assert_allclose(batch["obs2"], obs[1:], atol=2.0 / 65535)
+    np.testing.assert_allclose(batch["rews"], rews, atol=1.0 / 65535)
+    np.testing.assert_array_equal(batch["done"], dones)
@@ -0,0 +1,71 @@
+import numpy as np
+import pytest
+from cmorl.utils import reward_utils
+from cmorl.utils.return_utils import discounted_returns, truncated_returns
+
+
+def reference_returns(rewards, gamma, bootstrap=0.0):
+    """G[t] = rewards[t] + gamma * G[t+1], the loop reward_utils.values used to run"""
+    returns = np.zeros_like(rewards, dtype=np.float64)
+    following = np.asarray(bootstrap, dtype=np.float64)
+    for t in reversed(range(len(rewards))):
+        following = rewards[t] + gamma * following
+        returns[t] = following
+    return returns
+
+
+def reference_windows(rewards, gamma, window):
+    return np.stack([
+        sum(gamma**k * rewards[t + k] for k in range(min(window, len(rewards) - t)))
+        for t in range(len(rewards))
+    ])
+
+
+@pytest.mark.parametrize("gamma", [0.99, 0.8, 0.5, 0.1, 1e-3, 1e-200])
+@pytest.mark.parametrize("length", [1, 63, 64, 65, 5000])
+def test_discounted_returns_match_the_loop(gamma, length):
+    rewards = np.random.default_rng(0).uniform(-1.0, 1.0, (length, 2))
+    returns = discounted_returns(rewards, gamma, bootstrap=np.array([0.5, -0.5]))
+    assert np.all(np.isfinite(returns))
+    np.testing.assert_allclose(returns, reference_returns(rewards, gamma, np.array([0.5, -0.5])), rtol=1e-9, atol=1e-12)
+
+
+@pytest.mark.parametrize("gamma", [0.99, 0.8])
+def test_long_episodes_stay_finite(gamma):
+    rewards = np.random.default_rng(1).uniform(0.0, 1.0, (300_000, 1))
+    values = reward_utils.values(rewards, gamma, done=True)
+    assert np.all(np.isfinite(values))
+    np.testing.assert_allclose(values[-3000:], (1 - gamma) * reference_returns(rewards[-3000:], gamma), rtol=1e-9)
+    np.testing.assert_allclose(values[:100], (1 - gamma) * reference_returns(rewards, gamma)[:100], rtol=1e-6)
+
+
+def test_padded_batches_match_single_episodes():
+    rng = np.random.default_rng(2)
+    lengths = np.array([5, 130, 0, 64])
+    rewards = rng.uniform(0.0, 1.0, (4, 130, 3))
+    bootstrap = rng.uniform(0.0, 1.0, (4, 3))
+    returns = discounted_returns(rewards, 0.9, bootstrap=bootstrap, lengths=lengths)
+    for episode, length in enumerate(lengths):
+        np.testing.assert_allclose(
+            returns[episode, :length], reference_returns(rewards[episode, :length], 0.9, bootstrap[episode]), rtol=1e-9
+        )
+        np.testing.assert_array_equal(returns[episode, length:], 0.0)
+
+
+@pytest.mark.parametrize("gamma", [0.9, 0.2])
+@pytest.mark.parametrize("window", [1, 3, 100])
+def test_truncated_returns(gamma, window):
+    rewards = np.random.default_rng(3).uniform(0.0, 1.0, (200, 2))
+    np.testing.assert_allclose(truncated_returns(rewards, gamma, window), reference_windows(rewards, gamma, window), rtol=1e-9)
+
+
+def test_discounted_window():
+    rewards = np.array([1.0, 2.0, 3.0])
+    np.testing.assert_allclose(
+        reward_utils.discounted_window(rewards, 0.5, normalize=False, window_size=2), [1.0 + 0.5 * 2.0, 2.0 + 0.5 * 3.0, 3.0]
+    )
+    # an episode that didn't end keeps its last reward, the window reaching the end gets it
+    np.testing.assert_allclose(
+        reward_utils.discounted_window(rewards, 0.5, normalize=False, done=False, window_size=2),
+        [1.0 + 0.5 * 2.0, 2.0 + 0.5 * 3.0 + 0.25 * 6.0, 3.0 + 0.5 * 6.0],
+    )
@@ -0,0 +1,101 @@
+from types import SimpleNamespace
+import gymnasium as gym
+import numpy as np
+import pytest
+import tensorflow as tf
+from cmorl import reward_fns
+from cmorl.configs import get_env_and_config
+from cmorl.utils.reward_utils import CMORLRewardWrapper, Transition, default_q_composer
+
+# every composer with the number of objectives of the Q values it composes
+COMPOSERS = {
+    "default": (default_q_composer, 4),
+    "mujoco": (reward_fns.mujoco_CMORL(num_actions=6).q_composer, 13),
+    "halfcheetah": (reward_fns.halfcheetah_CMORL().q_composer, 8),
+    "walker": (reward_fns.walker_CMORL().q_composer, 12),
+    "reacher": (reward_fns.reacher_composer, 3),
+    "pendulum": (reward_fns.pendulum_composer, 2),
+    "lander": (reward_fns.lander_composer, 6),
+    "lander2": (reward_fns.lander_composer2, 6),
+}
+P_BATCH = [0.0, 1.0, -1.0]
+P_OBJECTIVES = [-4.0, 0.0, 1.0]
+
+
+@pytest.mark.parametrize("name", COMPOSERS)
+@pytest.mark.parametrize("batch_config, objectives_config", [(True, False), (False, True), (True, True)])
+def test_composers_take_a_p_per_config(name, batch_config, objectives_config):
+    composer, objectives = COMPOSERS[name]
+    q_values = tf.constant(np.random.default_rng(0).uniform(0.05, 1.0, (32, objectives)), tf.float32)
+    p_batch = tf.constant(P_BATCH) if batch_config else 0.0
+    p_objectives = tf.constant(P_OBJECTIVES) if objectives_config else -4.0
+
+    qs_c, q_c = composer(q_values, p_batch=p_batch, p_objectives=p_objectives)
+
+    assert q_c.shape == (3,)
+    for k in range(3):
+        # every configuration composes like a call with its own p values
+        qs_c_k, q_c_k = composer(
+            q_values,
+            p_batch=P_BATCH[k] if batch_config else 0.0,
+            p_objectives=P_OBJECTIVES[k] if objectives_config else -4.0,
+        )
+        np.testing.assert_allclose(q_c[k], q_c_k, rtol=1e-4, atol=1e-6)
+        # qs_c only has a configuration axis when it depends on p_batch
+        configured = qs_c.shape.rank > qs_c_k.shape.rank
+        np.testing.assert_allclose(qs_c[k] if configured else qs_c, qs_c_k, rtol=1e-4, atol=1e-6)
+
+
+
+def test_batched_pendulum_rewards_match_the_step_rewards():
+    # the batched reward fn reads the angle from the observations instead of env.state
+    env_fn, config = get_env_and_config("Pendulum-v1")
+    env = CMORLRewardWrapper(env_fn(), config.cmorl)
+    env.action_space.seed(0)
+    o, _ = env.reset(seed=0)
+    steps = dict(states=[], actions=[], next_states=[], dones=[], infos=[], rewards=[])
+    for _ in range(80):
+        a = env.action_space.sample()
+        o2, _, done, truncated, info = env.step(a)
+        for name, value in zip(steps, (o, a, o2, done, info, info["cmorl_reward"])):
+            steps[name].append(value)
+        o = env.reset()[0] if done or truncated else o2
+    rewards = np.array(steps.pop("rewards"))
+    np.testing.assert_allclose(config.cmorl.batch(*steps.values(), env.unwrapped), rewards, rtol=1e-5, atol=1e-6)
+
+
+@pytest.mark.parametrize("env_name, obs_dim, act_dim", [("Reacher-v4", 11, 2), ("LunarLanderContinuous-v2", 8, 2)])
+def test_batched_rewards_match_the_transition_rewards(env_name, obs_dim, act_dim):
+    env_fn, config = get_env_and_config(env_name)
+    cmorl = config.cmorl
+    # the reacher's reward fns don't read the env, the lander's only its observation space
+    env = None if env_name == "Reacher-v4" else env_fn().unwrapped
+    np_random = np.random.default_rng(1)
+    states, next_states = np_random.uniform(-1.0, 1.0, (2, 50, obs_dim)).astype(np.float32)
+    # the lander's last two observations are leg contacts
+    next_states[:, -2:] = np_random.integers(0, 2, (50, 2))
+    actions = np_random.uniform(-1.0, 1.0, (50, act_dim)).astype(np.float32)
+    dones, infos = np.zeros(50), [{}] * 50
+    expected = np.array([
+        cmorl.reward_fn(Transition(*transition), env)
+        for transition in zip(states, actions, next_states, dones, infos)
+    ])
+    batched = cmorl.batch(states, actions, next_states, dones, infos, env)
+    assert batched.shape == expected.shape
+    np.testing.assert_allclose(batched, expected, rtol=1e-5, atol=1e-6)
+    # without a batched reward fn the reward fn is called per transition
+    unbatched = cmorl.with_reward_fn(cmorl.reward_fn)
+    np.testing.assert_allclose(unbatched.batch(states, actions, next_states, dones, infos, env), expected, rtol=1e-6)
+
+
+def test_batched_rewards_read_the_stacked_infos():
+    env = SimpleNamespace(action_space=gym.spaces.Box(-1.0, 1.0, (3,)))
+    np_random = np.random.default_rng(2)
+    infos = [dict(forward=np_random.uniform(), change_direction=np_random.uniform(size=3)) for _ in range(20)]
+    states = actions = np.zeros((20, 3))
+    expected = np.array([
+        reward_fns.bittle_rw(Transition(state, action, state, False, info), env)
+        for state, action, info in zip(states, actions, infos)
+    ])
+    batched = get_env_and_config("Bittle-custom")[1].cmorl.batch(states, actions, states, np.zeros(20), infos, env)
+    np.testing.assert_allclose(batched, expected, rtol=1e-6)
@@ -0,0 +1,83 @@
+import os
+from pathlib import Path
+import numpy as np
+import pytest
+from cmorl.rl_algs.ddpg import hyperparams
+from cmorl.utils import save_utils, train_utils
+
+
+def test_save_replay_replaces_the_snapshot(tmp_path):
+    save_utils.save_replay(tmp_path, dict(rews_buf=np.zeros((4, 2))), dict(ptr=0, size=4))
+    first = save_utils.replay_path(tmp_path)
+    save_utils.save_replay(tmp_path, dict(rews_buf=np.ones((4, 2))), dict(ptr=1, size=4))
+
+    arrays, header = save_utils.load_replay(tmp_path)
+    np.testing.assert_array_equal(arrays["rews_buf"], np.ones((4, 2)))
+    assert header == dict(ptr=1, size=4)
+    assert not first.exists()
+    assert sorted(os.listdir(tmp_path)) == sorted([save_utils.replay_path(tmp_path).name, "replay.pointer"])
+
+
+def test_an_interrupted_save_keeps_the_previous_snapshot(tmp_path):
+    save_utils.save_replay(tmp_path, dict(rews_buf=np.zeros((4, 2))), dict(ptr=0, size=4))
+    # a save that crashed before swapping the pointer leaves its folder unreferenced
+    os.makedirs(tmp_path / "replay.1")
+    np.save(tmp_path / "replay.1" / "rews_buf.npy", np.ones((2, 2)))
+
+    arrays, header = save_utils.load_replay(tmp_path)
+    np.testing.assert_array_equal(arrays["rews_buf"], np.zeros((4, 2)))
+    save_utils.save_replay(tmp_path, dict(rews_buf=np.ones((4, 2))), dict(ptr=1, size=4))
+    assert not (tmp_path / "replay.1").exists()
+
+
+def test_snapshots_without_a_pointer_file_still_load(tmp_path):
+    os.makedirs(tmp_path / "replay")
+    np.save(tmp_path / "replay" / "rews_buf.npy", np.ones((4, 2)))
+    (tmp_path / "replay" / "header.json").write_text('{"ptr": 0, "size": 4}')
+
+    assert save_utils.has_replay(tmp_path)
+    arrays, header = save_utils.load_replay(tmp_path)
+    np.testing.assert_array_equal(arrays["rews_buf"], np.ones((4, 2)))
+
+
+def save_checkpoint(serializer, cmd_args, seed):
+    seed_folder = Path(serializer.get_seed_folder_path("Pendulum-v1/test", {**vars(cmd_args), "seed": seed}))
+    save_utils.save_replay(seed_folder, {}, dict(training=dict(t=100)))
+
+
+def test_resume_picks_the_seed_with_a_checkpoint(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    serializer = hyperparams.default_serializer()
+    cmd_args = serializer.parse_arguments(["--experiment_name", "test", "--resume", "True"])
+    save_checkpoint(serializer, cmd_args, 7)
+    os.makedirs(Path(serializer.get_seed_folder_path("Pendulum-v1/test", {**vars(cmd_args), "seed": 8})))
+
+    params = train_utils.create_train_folder_and_params("Pendulum-v1", cmd_args, serializer)
+
+    assert params["hp"].seed == 7
+    assert params["checkpoint_dir"].name == "7"
+
+
+def test_resume_fails_without_a_checkpoint(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    serializer = hyperparams.default_serializer()
+    with pytest.raises(FileNotFoundError):
+        train_utils.create_train_folder_and_params(
+            "Pendulum-v1", serializer.parse_arguments(["--experiment_name", "test", "--resume", "True"]), serializer
+        )
+    cmd_args = serializer.parse_arguments(["--experiment_name", "test", "--resume", "True", "--seed", "3"])
+    save_checkpoint(serializer, cmd_args, 4)
+    with pytest.raises(FileNotFoundError):
+        train_utils.create_train_folder_and_params("Pendulum-v1", cmd_args, serializer)
+
+
+def test_resume_needs_a_seed_when_several_have_checkpoints(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    serializer = hyperparams.default_serializer()
+    cmd_args = serializer.parse_arguments(["--experiment_name", "test", "--resume", "True"])
+    save_checkpoint(serializer, cmd_args, 1)
+    save_checkpoint(serializer, cmd_args, 2)
+    with pytest.raises(ValueError):
+        train_utils.create_train_folder_and_params("Pendulum-v1", cmd_args, serializer)
+    cmd_args.seed = 2
+    assert train_utils.create_train_folder_and_params("Pendulum-v1", cmd_args, serializer)["hp"].seed == 2
@@ -0,0 +1,31 @@
+import numpy as np
+import pytest
+from cmorl.rl_algs.ddpg.sum_tree import SumTree
+
+
+@pytest.mark.parametrize("capacity", [1, 2, 37, 64])
+def test_totals_and_lookups_follow_the_updates(capacity):
+    np_random = np.random.default_rng(0)
+    tree = SumTree(capacity)
+    values = np.zeros(capacity)
+    for _ in range(20):
+        idxs = np_random.integers(0, capacity, size=np_random.integers(1, 8))
+        updates = np_random.uniform(0.0, 2.0, size=len(idxs))
+        tree.update(idxs, updates)
+        # like NumPy's assignment, a repeated index keeps the last value written to it
+        values[idxs] = updates
+
+        assert tree.total() == pytest.approx(np.sum(values))
+        np.testing.assert_array_equal(tree[np.arange(capacity)], values)
+        # the leaf a value falls into is the first whose prefix sum exceeds it
+        queries = np_random.uniform(0.0, tree.total(), size=50)
+        np.testing.assert_array_equal(tree.find(queries), np.searchsorted(np.cumsum(values), queries, side="right"))
+
+
+def test_sampling_is_proportional_to_the_values():
+    values = np.array([1.0, 0.0, 3.0, 6.0, 0.5, 0.0, 2.5])
+    tree = SumTree(len(values))
+    tree.update(np.arange(len(values)), values)
+    samples = np.concatenate([tree.sample(64, np.random.default_rng(seed)) for seed in range(500)])
+    frequencies = np.bincount(samples, minlength=len(values)) / len(samples)
+    np.testing.assert_allclose(frequencies, values / np.sum(values), atol=5e-3)
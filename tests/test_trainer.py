@@ -0,0 +1,166 @@
+import numpy as np
+import pytest
+from cmorl.configs import get_env_and_config
+from cmorl.rl_algs.ddpg import core
+from cmorl.rl_algs.ddpg.hyperparams import HyperParams, combine, default_hypers
+from cmorl.rl_algs.ddpg.learner import Learner
+from cmorl.rl_algs.ddpg.replay_buffer import ReplayBuffer
+from cmorl.rl_algs.ddpg.trainer import Trainer, make_vector_env, preload
+from cmorl.utils import dataset_utils
+from cmorl.utils.logx import TensorflowLogger
+
+HP = combine(
+    default_hypers(),
+    HyperParams(
+        steps_per_epoch=60,
+        epochs=2,
+        start_steps=30,
+        max_ep_len=20,
+        train_every=15,
+        train_steps=2,
+        batch_size=16,
+        replay_size=1000,
+        offline_test_episodes=1,
+        ac_kwargs=dict(actor_hidden_sizes=[8], critic_hidden_sizes=[16, 16]),
+    ),
+)
+
+
+class Run:
+    """A stand in for the wandb run, keeps the rows logged to it"""
+
+    id = "test"
+
+    def __init__(self):
+        self.rows = []
+
+    def log(self, row, step=None):
+        self.rows.append(row)
+
+    def finish(self):
+        pass
+
+
+@pytest.fixture
+def make_trainer(tmp_path, monkeypatch):
+    # TensorflowLogger writes its summaries into the working directory
+    monkeypatch.chdir(tmp_path)
+
+    def make(**hypers):
+        hp = combine(HP, HyperParams(**hypers))
+        env_fn, config = get_env_and_config("Pendulum-v1")
+        envs, vector_env = make_vector_env(env_fn, hp.num_envs, config.cmorl, hp.max_ep_len)
+        o, _ = vector_env.reset(seed=hp.seed)
+        env = envs[0]
+        rew_dims = config.cmorl.calculate_space(env).shape[0]
+        networks = [
+            network
+            for _ in range(2)
+            for network in core.mlp_actor_critic(
+                env.observation_space, env.action_space, rew_dims, seed=hp.seed, **hp.ac_kwargs
+            )
+        ]
+        logger = TensorflowLogger(output_dir=str(tmp_path / "output"))
+        replay_buffer = ReplayBuffer(3, 1, hp.replay_size, rwds_dim=rew_dims)
+        learner = Learner(
+            hp, *networks, replay_buffer, rew_dims, q_composer=config.cmorl.q_composer, logger_metrics=logger.metrics
+        )
+        trainer = Trainer(
+            hp,
+            env_fn,
+            envs,
+            vector_env,
+            learner,
+            core.PerturbedActor(networks[0], env.action_space, seed=hp.seed),
+            np.random.default_rng(hp.seed),
+            logger,
+            Run(),
+            cmorl=config.cmorl,
+        )
+        return trainer, o
+
+    return make
+
+
+def stored(replay_buffer):
+    return {name: getattr(replay_buffer, name)[: replay_buffer.size] for name in replay_buffer.fields}
+
+
+def assert_pendulum_steps(obs1, acts, obs2):
+    """Every transition is a step of the pendulum's dynamics, none of them crosses a reset"""
+    th, th2, thdot2 = np.arctan2(obs1[:, 1], obs1[:, 0]), np.arctan2(obs2[:, 1], obs2[:, 0]), obs2[:, 2]
+    np.testing.assert_allclose(np.cos(th + thdot2 * 0.05), np.cos(th2), atol=1e-4)
+    np.testing.assert_allclose(np.sin(th + thdot2 * 0.05), np.sin(th2), atol=1e-4)
+
+
+def progress_rows(trainer):
+    with open(trainer.logger.output_file.name) as f:
+        return f.read().splitlines()[1:]
+
+
+@pytest.mark.parametrize("num_envs", [1, 3])
+def test_learn_collects_from_every_sub_env(make_trainer, num_envs):
+    trainer, o = make_trainer(num_envs=num_envs)
+    trainer.train(o)
+
+    # every sub env ran whole episodes of max_ep_len steps, each stored once
+    total_steps = HP.steps_per_epoch * HP.epochs
+    buffers = stored(trainer.replay_buffer)
+    assert trainer.replay_buffer.size == total_steps
+    assert_pendulum_steps(buffers["obs1_buf"], buffers["acts_buf"], buffers["obs2_buf"])
+    assert np.sum(buffers["done_buf"]) == 0.0
+    episode_lengths = [row["EpLen"] for row in trainer.weights_and_biases.rows if "EpLen" in row]
+    assert episode_lengths == [HP.max_ep_len] * (total_steps // HP.max_ep_len)
+    # the batched CMORL rewards were computed from the stored transitions
+    np.testing.assert_allclose(
+        buffers["rews_buf"],
+        trainer.cmorl.batch(
+            buffers["obs1_buf"], buffers["acts_buf"], buffers["obs2_buf"], buffers["done_buf"], [{}] * total_steps, trainer.env
+        ),
+        rtol=1e-6,
+    )
+    # an epoch is wrapped up on the first step of the next one, as the loop always did
+    assert len(progress_rows(trainer)) == HP.epochs - 1
+
+
+def test_async_learner_keeps_to_the_update_to_data_ratio(make_trainer):
+    # a queue of one episode keeps the collector blocked on the learner most of the time
+    trainer, o = make_trainer(async_learner=True, update_to_data=0.5, queue_size=1, num_envs=2)
+    trainer.train(o)
+
+    total_steps = HP.steps_per_epoch * HP.epochs
+    buffers = stored(trainer.replay_buffer)
+    assert trainer.replay_buffer.size == total_steps
+    assert_pendulum_steps(buffers["obs1_buf"], buffers["acts_buf"], buffers["obs2_buf"])
+    update_blocks = [row for row in trainer.weights_and_biases.rows if "Q-composed" in row]
+    assert len(update_blocks) == int(0.5 * (total_steps - HP.start_steps)) // HP.train_steps
+    assert trainer.learner.update_metrics.read() == {}
+
+
+def test_offline_training_only_learns_from_the_dataset(make_trainer, tmp_path):
+    # a dataset recorded by an online run
+    recorder, o = make_trainer(num_envs=2)
+    recorder.episode_writers.append(dataset_utils.ShardWriter(tmp_path / "dataset", {}))
+    recorder.train(o)
+
+    trainer, o = make_trainer(offline=str(tmp_path / "dataset"))
+    assert preload(trainer.replay_buffer, tmp_path / "dataset", trainer.hp) == recorder.replay_buffer.size
+    before = {name: np.copy(values) for name, values in stored(trainer.replay_buffer).items()}
+    weights = trainer.learner.pi_network.get_weights()
+
+    def step(actions):
+        raise AssertionError("offline training stepped the env")
+
+    trainer.vector_env.step = step
+    trainer.train(o)
+
+    for name, values in stored(trainer.replay_buffer).items():
+        np.testing.assert_array_equal(values, before[name])
+    assert any(np.any(w != w0) for w, w0 in zip(trainer.learner.pi_network.get_weights(), weights))
+    total_steps = HP.steps_per_epoch * HP.epochs
+    update_blocks = [row for row in trainer.weights_and_biases.rows if "Q-composed" in row]
+    assert len(update_blocks) == total_steps // HP.train_every
+    # every epoch is evaluated and wrapped up after its last update
+    episode_lengths = [row["EpLen"] for row in trainer.weights_and_biases.rows if "EpLen" in row]
+    assert episode_lengths == [HP.max_ep_len] * HP.epochs * HP.offline_test_episodes
+    assert [row.split("\t")[0] for row in progress_rows(trainer)] == [str(epoch) for epoch in range(HP.epochs)]